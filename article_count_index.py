@@ -1,20 +1,17 @@
 #!/usr/bin/env python
 """Article Count Sentiment Indexer
 
-A script to create a sentiment index which is simply the number of news articles articles per month
+A script to create a sentiment index which is simply the number of news articles articles per month (or week or quarter,
+or over rolling windows of those)
 """
-import os
-import re
-import sys
-import pandas as pd
 import contextlib
-from datetime import datetime
-from calendar import monthrange
 
-from dateutil.relativedelta import relativedelta
 import sqlite3
 from pathlib import Path
 
+from process import create_tables as create_article_tables, term_filter, term_filter_label
+from metrics import peak_memory_mb
+
 __author__ = 'Andre Bodo'
 __copyright__ = 'Copyright 2020, Andre Bodo'
 __credits__ = ['Andre Bodo']
@@ -24,35 +21,76 @@ __maintainer__ = 'Andre Bodo'
 __email__ = 'bodo1184@mylaurier.ca'
 __status__ = 'Prototype'
 
+# Control variables
+# 'W' (weeks ending sunday), 'M' (calendar months) or 'Q' (calendar quarters), optionally preceded by a window
+# length for rolling sums, e.g. ['M', 'Q', '3M'] for monthly, quarterly and rolling three month counts
+PERIODS = ['M']
+DROP_NEAR_DUPLICATES = True  # leave out articles flagged by near_duplicates.py
+TERM_FILTER = None  # FTS5 query for a sub-index of one theme, e.g. '"tar sands" OR "oil sands"', None for all articles
+
 # Directories and file paths needed
 base_path = Path(__file__).parent
-dbase_loc = str(base_path) + '\\articles.db'
+dbase_loc = str(base_path / 'articles.db')
+
+
+# Articles and words per day summed from the DAILY_COUNTS table maintained by process.py. Near-duplicates are subtracted
+# per day with a join on the primary key, so neither query touches more than the flagged articles. With a term_query
+# the daily totals come from the articles matching it in the full-text index instead.
+def daily_counts(conn, drop_near_duplicates=DROP_NEAR_DUPLICATES, term_query=TERM_FILTER):
+    if term_query is not None:
+        conditions = [term_filter(term_query, 'a.ID')]
+        if drop_near_duplicates:
+            from near_duplicates import near_duplicate_filter
+            conditions.append(near_duplicate_filter('a.ID'))
+        return conn.execute(f"""
+        SELECT a.DATE, COUNT(*), SUM(a.WORDCOUNT) FROM ARTICLES a WHERE {' AND '.join(conditions)} GROUP BY a.DATE
+        """).fetchall()
+
+    duplicates = "SELECT NULL AS DATE, 0 AS N, 0 AS WORDS"
+    if drop_near_duplicates:
+        duplicates = """
+        SELECT a.DATE, COUNT(*) AS N, SUM(a.WORDCOUNT) AS WORDS FROM DUPLICATE_CLUSTERS d
+        JOIN ARTICLES a ON a.ID = d.ID
+        WHERE d.ID != d.CLUSTER_ID
+        GROUP BY a.DATE
+        """
+    return conn.execute(f"""
+    SELECT c.DATE, c.ARTICLES - IFNULL(d.N, 0), c.WORDS - IFNULL(d.WORDS, 0) FROM DAILY_COUNTS c
+    LEFT JOIN ({duplicates}) d ON d.DATE = c.DATE
+    WHERE c.ARTICLES > 0
+    ORDER BY c.DATE
+    """).fetchall()
+
 
-with contextlib.closing(sqlite3.connect(dbase_loc)) as conn:
-    df = pd.read_sql('SELECT DATE FROM ARTICLES', conn, parse_dates={'DATE': '%Y-%m-%d'})
+def output_loc(term_query=TERM_FILTER):
+    if term_query is None:
+        return str(base_path / 'count_based_index.xlsx')
+    return str(base_path / f'count_based_index_{term_filter_label(term_query)}.xlsx')
 
-df['article_count'] = 0
-df = df.groupby(by=['DATE'], as_index=False).count()
-df.columns = list(map(str.lower, df.columns))
-df.set_index('date', inplace=True, drop=True)
-df = df.resample('M').sum()
-df.sort_index(inplace=True)
 
-# # download OVX data from yahoo finance
-period1 = int(datetime.timestamp(pd.Timestamp(df.index.values[0]) - relativedelta(months=1)))
-period2 = '9999999999'
-base_url = 'https://query1.finance.yahoo.com/v7/finance/download'
-url = f'{base_url}/^OVX?period1={period1}&period2=9999999999&interval=1d&events=history'
-ovx_data = pd.read_csv(url, parse_dates=['Date'], index_col=['Date'], usecols=['Date', 'Adj Close'])
-ovx_data.index.names = ['date']
-ovx_data.columns = ['OVX']
-ovx_data.sort_index(inplace=True)
-ovx_data = ovx_data.reindex(df.index, method='ffill')
+# Build the count index at every period in periods and write them side by side next to this script, returns the path
+# of the output. pandas, numpy (through near_duplicates) and the price cache are imported here so importing this module
+# stays cheap.
+def main(periods=PERIODS, drop_near_duplicates=DROP_NEAR_DUPLICATES, term_query=TERM_FILTER):
+    from periods import daily_frame, period_frames, with_benchmark, write_frames
+    from near_duplicates import create_tables as create_duplicate_tables
 
-df = df.merge(ovx_data, how='inner', left_index=True, right_index=True).dropna()
+    with contextlib.closing(sqlite3.connect(dbase_loc)) as conn:
+        create_article_tables(conn)
+        create_duplicate_tables(conn)
+        counts = daily_counts(conn, drop_near_duplicates, term_query)
 
-df.to_excel('count_based_index.xlsx')
+    daily = daily_frame(counts, ['article_count', 'words'])
+    frames = period_frames(daily, periods, ratios={'words_per_article': ('words', 'article_count')})
 
+    peak_main, _ = peak_memory_mb()
+    if peak_main is not None:
+        print(f'Peak memory: {peak_main:,.0f} MB')
 
+    # OVX prices from the local cache, topped up from yahoo finance when it is out of date
+    write_frames(with_benchmark(frames), output_loc(term_query))
+    return output_loc(term_query)
 
 
+if __name__ == '__main__':
+    main()
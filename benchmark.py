@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Pipeline Benchmarks
+
+A script to time the main stages of the pipeline on a synthetic corpus written by synthetic_corpus.py: parsing article
+files and archives (files/sec), inserting with de-duplication (inserts/sec), full scans of the stored bodies in each
+body compression (articles/sec, printed with the size of the bodies and of the database) and cleaning and scoring tone
+(articles/sec). Rates are compared with a stored baseline and any stage slower than the baseline by more than
+TOLERANCE is reported as a regression. Run with --save-baseline to store the current rates as the new baseline.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import tempfile
+import contextlib
+
+from pathlib import Path
+
+import synthetic_corpus
+import process
+import bodies
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# Control variables
+N_ARTICLES = 5000
+N_TONE_ARTICLES = 1000  # tone scoring is much slower than parsing, so it runs on a subset
+REPEATS = 3  # each stage is timed this many times and the best run is kept
+TOLERANCE = 0.15  # a rate more than 15% below the baseline is a regression
+SEED = 1
+
+# Directories and file paths needed
+base_path = Path(__file__).parent
+baseline_loc = str(base_path / 'benchmark_baseline.json')
+
+
+def best_time(func, repeats=REPEATS):
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# Parsing runs in this process only, so the rate measures the parsing code rather than the number of cores
+def bench_parse(corpus_path):
+    files = sorted(f for f in (corpus_path / 'txt').rglob('*.txt') if not process.is_placeholder(f.name))
+    archives = sorted((corpus_path / 'zip').glob('*.ZIP'))
+
+    elapsed, results = best_time(lambda: [r for f in files for r in process.parse_file(f)])
+    records = [record for _, record, error in results if error is None]
+    archive_elapsed, archive_results = best_time(lambda: [r for f in archives for r in process.parse_archive(f)])
+
+    return {
+        'parse_txt_files_per_sec': len(files) / elapsed,
+        'parse_zip_articles_per_sec': len(archive_results) / archive_elapsed,
+    }, records
+
+
+# Inserts into a new database each time, in BATCH_SIZE transactions, duplicates included
+def bench_insert(records, work_path):
+    def insert():
+        db_path = work_path / 'bench.db'
+        if db_path.exists():
+            db_path.unlink()
+        with contextlib.closing(sqlite3.connect(str(db_path))) as conn:
+            process.create_tables(conn)
+            duplicates = 0
+            for i in range(0, len(records), process.BATCH_SIZE):
+                duplicates += process.insert_articles(conn, records[i:i + process.BATCH_SIZE])
+        return duplicates
+
+    elapsed, duplicates = best_time(insert)
+    return {'insert_records_per_sec': len(records) / elapsed}, duplicates
+
+
+# Size of the stored bodies and read throughput of a full scan through UNPACK_BODY for each body compression. The
+# database is built the way process.py builds it, so the full-text index and count table are included in the file size.
+def bench_storage(records, work_path):
+    rates, sizes = {}, {}
+    for compression in ('plain', 'zlib', 'zstd'):
+        if compression == 'zstd' and bodies.zstandard is None:
+            print('Skipping zstd storage benchmark: the zstandard package is not installed')
+            continue
+        db_path = work_path / f'storage_{compression}.db'
+        with contextlib.closing(sqlite3.connect(str(db_path))) as conn:
+            codec = process.create_tables(conn, None if compression == 'plain' else compression)
+            for i in range(0, len(records), process.BATCH_SIZE):
+                process.insert_articles(conn, records[i:i + process.BATCH_SIZE], codec)
+            conn.execute("VACUUM")
+            body_bytes = conn.execute("SELECT TOTAL(LENGTH(CAST(BODY AS BLOB))) FROM ARTICLES").fetchall()[0][0]
+
+            def scan():
+                return sum(len(body) for body, in conn.execute("SELECT UNPACK_BODY(BODY) FROM ARTICLES"))
+
+            elapsed, _ = best_time(scan)
+        n_articles = len(records)
+        rates[f'scan_{compression}_articles_per_sec'] = n_articles / elapsed
+        sizes[compression] = (body_bytes, db_path.stat().st_size)
+
+    plain_bodies, plain_file = sizes['plain']
+    for compression, (body_bytes, file_bytes) in sizes.items():
+        print(f'{compression:<6} bodies {body_bytes / 2 ** 20:8,.2f} MB ({body_bytes / plain_bodies:6.1%}), '
+              f'file {file_bytes / 2 ** 20:8,.2f} MB ({file_bytes / plain_file:6.1%})')
+    return rates
+
+
+# Cleaning and Harvard IV-4 scoring in this process. Needs the NLTK data, SCOWL dictionary and lexicon used by
+# tone_index.py, the stage is skipped when they are not available.
+def bench_tone(records):
+    try:
+        import tone_index
+        cleaner = tone_index.TextCleaner()
+        lexicon = tone_index.HarvardLexicon()
+    except (ImportError, LookupError, OSError) as ex:
+        print(f'Skipping tone scoring benchmark: {ex}')
+        return {}
+    bodies = [record[4] for record in records[:N_TONE_ARTICLES]]
+
+    elapsed, _ = best_time(lambda: [lexicon.score(cleaner.clean(body)) for body in bodies])
+    return {'tone_articles_per_sec': len(bodies) / elapsed}
+
+
+def environment():
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'system': platform.system(),
+            'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def load_baseline(path=baseline_loc):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_baseline(rates, path=baseline_loc):
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(), 'n_articles': N_ARTICLES, 'rates': rates}, f, indent=2)
+
+
+# Names of the stages more than tolerance slower than the baseline, with their change in rate
+def regressions(rates, baseline, tolerance=TOLERANCE):
+    slower = []
+    for name, rate in rates.items():
+        base_rate = baseline['rates'].get(name)
+        if base_rate and rate < base_rate * (1 - tolerance):
+            slower.append((name, rate / base_rate - 1))
+    return slower
+
+
+def run_benchmarks(n_articles=N_ARTICLES, seed=SEED):
+    work_path = Path(tempfile.mkdtemp(prefix='nexis_bench_'))
+    try:
+        for fmt in ('txt', 'zip'):
+            synthetic_corpus.write_corpus(work_path / fmt, n_articles, fmt, seed)
+        print()
+        rates, records = bench_parse(work_path)
+        insert_rates, duplicates = bench_insert(records, work_path)
+        rates.update(insert_rates)
+        rates.update(bench_storage(records, work_path))
+        rates.update(bench_tone(records))
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    print(f'{len(records):d} articles parsed, {duplicates:d} rejected as duplicates')
+    return rates
+
+
+if __name__ == '__main__':
+    rates = run_benchmarks()
+    baseline = load_baseline()
+
+    for name, rate in rates.items():
+        base_rate = baseline['rates'].get(name) if baseline else None
+        change = f' ({rate / base_rate - 1:+.1%} vs baseline)' if base_rate else ''
+        print(f'{name:<30}{rate:>12,.0f}{change}')
+
+    if '--save-baseline' in sys.argv:
+        save_baseline(rates)
+        print(f'Saved baseline to {baseline_loc}')
+    elif baseline is None:
+        print('No baseline stored yet, run with --save-baseline to create one')
+    else:
+        if baseline.get('environment') != environment():
+            print('Baseline was recorded on a different machine or python version, rates may not be comparable')
+        slower = regressions(rates, baseline)
+        for name, change in slower:
+            print(f'REGRESSION: {name} is {-change:.1%} slower than the baseline')
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Compressed Article Bodies
+
+Optional compression of the BODY column of articles.db. Plain bodies are stored as TEXT, compressed ones as a BLOB
+starting with a one byte tag for the codec: zlib from the standard library, or zstd with a dictionary trained on the
+corpus when the optional zstandard package is installed. Plain and compressed bodies can be mixed in one database, so
+compression can be switched on for an existing corpus and the old rows migrated later.
+
+Every connection that reads or writes bodies registers the UNPACK_BODY SQL function through BodyCodec. Readers select
+UNPACK_BODY(BODY) and get the text back whatever the storage, and the full-text index triggers use it to index the text
+rather than the compressed bytes.
+"""
+import zlib
+import struct
+import sqlite3
+
+try:
+    import zstandard
+except ImportError:  # zstd is not available, zlib still is
+    zstandard = None
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# Control variables
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+DICTIONARY_SIZE = 112 * 1024  # bytes, the zstd default
+DICTIONARY_SAMPLES = 5000  # bodies the zstd dictionary is trained on
+
+ZLIB_TAG = 1
+ZSTD_TAG = 2
+compressions = (None, 'zlib', 'zstd')
+
+
+def create_tables(conn):
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS BODY_DICTIONARIES(ID INTEGER PRIMARY KEY, DATA BLOB NOT NULL)")
+
+
+class BodyCodec:
+    """Packs bodies for one database in the chosen compression and unpacks any stored body again.
+
+    Creating a codec registers UNPACK_BODY on the connection. zstd bodies record the ID of the dictionary they were
+    compressed with (0 for none), dictionaries are read from BODY_DICTIONARIES when first needed.
+    """
+
+    def __init__(self, conn, compression=None):
+        if compression not in compressions:
+            raise ValueError(f'unknown body compression {compression!r}, expected one of {compressions}')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd body compression needs the zstandard package')
+        self.conn = conn
+        self.compression = compression
+        self.compressor = None
+        self.dictionary_id = 0
+        self.decompressors = {}
+        conn.create_function('UNPACK_BODY', 1, self.unpack, deterministic=True)
+
+    def dictionary(self, dictionary_id):
+        res = self.conn.execute("SELECT DATA FROM BODY_DICTIONARIES WHERE ID=?", [dictionary_id]).fetchall()
+        if not res:
+            raise ValueError(f'zstd dictionary {dictionary_id:d} is missing from BODY_DICTIONARIES')
+        return zstandard.ZstdCompressionDict(res[0][0])
+
+    # Train a zstd dictionary on sample bodies and store it, later bodies are compressed with it. Too few or too
+    # short samples leave zstd without a dictionary.
+    def train(self, samples):
+        samples = [s.encode('utf-8') for s in samples[:DICTIONARY_SAMPLES] if s]
+        try:
+            trained = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+        except zstandard.ZstdError as ex:
+            print(f'Could not train a zstd dictionary ({ex}), compressing without one')
+            return 0
+        with self.conn:
+            cursor = self.conn.execute("INSERT INTO BODY_DICTIONARIES VALUES (NULL, ?)", [trained.as_bytes()])
+        return cursor.lastrowid
+
+    # Set up the zstd compressor with the newest stored dictionary, training one on samples when there is none
+    def prepare(self, samples=()):
+        if self.compression != 'zstd' or self.compressor is not None:
+            return
+        try:
+            res = self.conn.execute("SELECT MAX(ID) FROM BODY_DICTIONARIES").fetchall()
+        except sqlite3.OperationalError:  # table not created yet
+            res = [(None,)]
+        self.dictionary_id = res[0][0] or (self.train(list(samples)) if samples else 0)
+        if self.dictionary_id:
+            dictionary = self.dictionary(self.dictionary_id)
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary)
+            # ready before the full-text trigger unpacks the first body packed with it
+            self.decompressors[self.dictionary_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+
+    def pack(self, body):
+        if self.compression is None:
+            return body
+        data = body.encode('utf-8')
+        if self.compression == 'zlib':
+            return bytes([ZLIB_TAG]) + zlib.compress(data, ZLIB_LEVEL)
+        self.prepare()
+        return bytes([ZSTD_TAG]) + struct.pack('<I', self.dictionary_id) + self.compressor.compress(data)
+
+    def unpack(self, value):
+        if not isinstance(value, bytes):
+            return value
+        if value[0] == ZLIB_TAG:
+            return zlib.decompress(value[1:]).decode('utf-8')
+        if value[0] == ZSTD_TAG:
+            if zstandard is None:
+                raise ImportError('reading zstd compressed bodies needs the zstandard package')
+            dictionary_id = struct.unpack_from('<I', value, 1)[0]
+            if dictionary_id not in self.decompressors:
+                if dictionary_id:
+                    self.decompressors[dictionary_id] = zstandard.ZstdDecompressor(
+                        dict_data=self.dictionary(dictionary_id))
+                else:
+                    self.decompressors[dictionary_id] = zstandard.ZstdDecompressor()
+            return self.decompressors[dictionary_id].decompress(value[5:]).decode('utf-8')
+        raise ValueError(f'unknown body compression tag {value[0]:d}')
+
+    # Records of (title, date, publisher, author, body, word_count) with their bodies packed
+    def pack_records(self, records):
+        if self.compression is None:
+            return records
+        self.prepare([record[4] for record in records])
+        return [record[:4] + (self.pack(record[4]),) + record[5:] for record in records]
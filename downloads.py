@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Download Completion and Integrity Checks
+
+Helpers used by the scraper to find out when a batch archive has finished downloading and whether it actually holds the
+articles that were selected. Completion is detected from filesystem events when the optional watchdog package is
+installed (inotify on Linux, ReadDirectoryChangesW on Windows) and by polling the download directory otherwise.
+"""
+import os
+import time
+import zipfile
+import threading
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # fall back to polling
+    Observer = None
+    FileSystemEventHandler = object
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Development'
+
+# Control variables
+POLL_INTERVAL = 0.5  # seconds between checks when watchdog is not installed
+EVENT_SAFETY_INTERVAL = 5  # seconds between checks when waiting on filesystem events, in case one is missed
+
+
+class DownloadError(Exception):
+    pass
+
+
+# Nexis Uni sometimes delivers a placeholder instead of the articles, named after the batch and ending in
+# deliverynotification.txt. These can be loose files or members of a downloaded archive.
+def is_placeholder(name):
+    return name.lower().endswith('deliverynotification.txt')
+
+
+def article_members(archive):
+    return [info for info in archive.infolist() if not info.is_dir() and not is_placeholder(info.filename)]
+
+
+# Raise DownloadError unless path is a readable zip of expected_members articles with no delivery notification inside
+def check_archive(path, expected_members=None):
+    if not zipfile.is_zipfile(path):
+        raise DownloadError(f'{os.path.basename(path)} is not a valid zip archive')
+    try:
+        with zipfile.ZipFile(path) as archive:
+            if any(is_placeholder(name) for name in archive.namelist()):
+                raise DownloadError(f'{os.path.basename(path)} contains a delivery notification placeholder')
+            bad_member = archive.testzip()
+            if bad_member is not None:
+                raise DownloadError(f'{os.path.basename(path)} is truncated or corrupt at {bad_member}')
+            n_members = len(article_members(archive))
+    except zipfile.BadZipFile as ex:
+        raise DownloadError(f'{os.path.basename(path)} is not a valid zip archive: {ex}')
+    if n_members == 0 or (expected_members is not None and n_members != expected_members):
+        raise DownloadError(f'{os.path.basename(path)} has {n_members:d} articles, expected {expected_members}')
+
+
+class DirectoryEvents(FileSystemEventHandler):
+    """Sets an event whenever anything in the watched directory changes."""
+
+    def __init__(self, directory):
+        super().__init__()
+        self.changed = threading.Event()
+        self.observer = None
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(self, directory, recursive=False)
+
+    def __enter__(self):
+        if self.observer is not None:
+            self.observer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+    def on_any_event(self, event):
+        self.changed.set()
+
+    def wait(self, timeout):
+        self.changed.wait(timeout)
+        self.changed.clear()
+
+
+# Wait until directory holds filename.ZIP and no filename.ZIP.part, then check the archive before reporting success.
+# A bad archive is removed so the batch gets downloaded again on the next attempt. A placeholder delivered in place of
+# the archive fails straight away instead of waiting for the timeout.
+def wait_for_download(directory, filename, timeout, expected_members=None):
+    archive = os.path.join(directory, filename + '.ZIP')
+    placeholder = os.path.join(directory, filename + '_deliverynotification.txt')
+    deadline = time.time() + timeout
+
+    with DirectoryEvents(directory) as events:
+        interval = POLL_INTERVAL if events.observer is None else EVENT_SAFETY_INTERVAL
+        while True:
+            if os.path.exists(placeholder):
+                os.remove(placeholder)
+                raise DownloadError(f'{filename} was delivered as a notification placeholder')
+            if os.path.exists(archive) and not os.path.exists(archive + '.part'):
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DownloadError('download timeout')
+            events.wait(min(interval, remaining))
+
+    try:
+        check_archive(archive, expected_members)
+    except DownloadError:
+        os.remove(archive)
+        raise
+    return archive
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Scrape Manifest
+
+A small SQLite database recording, for every search url index, the url, its number of result pages and which download
+batches have been completed along with the checksum of each archive. The scraper uses it to skip finished urls and to
+resume a url at its first incomplete batch, and process.py marks batches whose archives turned out to be delivery
+notification placeholders so that only those get scraped again.
+"""
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Development'
+
+# Control variables
+BATCH_PAGES = 10  # result pages selected into each downloaded batch
+
+# Directories and file paths needed
+base_path = Path(__file__).parent
+manifest_loc = str(base_path / 'scrape_manifest.db')
+
+
+def file_checksum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def batch_count(total_pages, batch_pages=BATCH_PAGES):
+    return -(-total_pages // batch_pages)
+
+
+# First result page of a batch, batches are numbered from 1
+def batch_first_page(batch, batch_pages=BATCH_PAGES):
+    return batch_pages * (batch - 1) + 1
+
+
+class ScrapeManifest:
+    """Thread safe record of scrape progress shared by all scraper workers and process.py."""
+
+    def __init__(self, path=manifest_loc):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS URLS(
+            UIDX INTEGER PRIMARY KEY,
+            URL TEXT NOT NULL,
+            TOTAL_PAGES INTEGER)
+            """)
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS BATCHES(
+            UIDX INTEGER NOT NULL,
+            BATCH INTEGER NOT NULL,
+            FIRST_PAGE INTEGER NOT NULL,
+            LAST_PAGE INTEGER NOT NULL,
+            FILENAME TEXT NOT NULL,
+            CHECKSUM TEXT,
+            COMPLETE INTEGER NOT NULL,
+            PRIMARY KEY (UIDX, BATCH))
+            """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def execute(self, sql, data=()):
+        with self.lock:
+            with self.conn:
+                return self.conn.execute(sql, data).fetchall()
+
+    # A url index that now points at a different search (e.g. a new window plan) starts over
+    def record_url(self, uidx, url, total_pages=None):
+        res = self.execute("SELECT URL FROM URLS WHERE UIDX=?", [uidx])
+        if res and res[0][0] != url:
+            self.execute("DELETE FROM BATCHES WHERE UIDX=?", [uidx])
+        self.execute("""
+        INSERT INTO URLS VALUES (?, ?, ?)
+        ON CONFLICT(UIDX) DO UPDATE SET URL=excluded.URL, TOTAL_PAGES=IFNULL(excluded.TOTAL_PAGES, TOTAL_PAGES)
+        """, [uidx, url, total_pages])
+
+    def record_batch(self, uidx, batch, last_page, filename, path):
+        self.execute("INSERT OR REPLACE INTO BATCHES VALUES (?, ?, ?, ?, ?, ?, 1)",
+                     [uidx, batch, batch_first_page(batch), last_page, filename, file_checksum(path)])
+
+    def invalidate_batch(self, uidx, batch, filename):
+        self.execute("""
+        INSERT INTO BATCHES VALUES (?, ?, ?, ?, ?, NULL, 0)
+        ON CONFLICT(UIDX, BATCH) DO UPDATE SET COMPLETE=0, CHECKSUM=NULL
+        """, [uidx, batch, batch_first_page(batch), batch_first_page(batch + 1) - 1, filename])
+
+    # True or False once the batch is known to the manifest, None when it has never been recorded
+    def batch_complete(self, uidx, batch):
+        res = self.execute("SELECT COMPLETE FROM BATCHES WHERE UIDX=? AND BATCH=?", [uidx, batch])
+        return bool(res[0][0]) if res else None
+
+    def first_incomplete_batch(self, uidx, total_pages):
+        done = {row[0] for row in self.execute("SELECT BATCH FROM BATCHES WHERE UIDX=? AND COMPLETE=1", [uidx])}
+        for batch in range(1, batch_count(total_pages) + 1):
+            if batch not in done:
+                return batch
+        return None
+
+    def url_complete(self, uidx, url):
+        res = self.execute("SELECT URL, TOTAL_PAGES FROM URLS WHERE UIDX=?", [uidx])
+        if not res or res[0][0] != url or res[0][1] is None:
+            return False
+        return self.first_incomplete_batch(uidx, res[0][1]) is None
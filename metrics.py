@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Run Metrics
+
+Lightweight instrumentation shared by the pipeline scripts: named stage timers, counters and throughput rates, a
+progress line with the current rate, an optional cProfile hook and a JSON report written at the end of each run.
+
+Worker processes keep their own Metrics and hand back a snapshot with each task, which the main process merges, so
+stage times are summed over all workers (CPU time spent in a stage) while rates are over the wall time of the run.
+"""
+import sys
+import json
+import time
+import pstats
+import cProfile
+import platform
+import contextlib
+from datetime import datetime
+from collections import defaultdict
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# Control variables
+PROGRESS_INTERVAL = 0.5  # minimum seconds between progress line updates
+PROFILE_LINES = 25  # functions listed when a profile is printed
+
+
+class Metrics:
+    """Stage timers and counters for one run (or one worker's share of it)."""
+
+    def __init__(self, name=''):
+        self.name = name
+        self.started = time.perf_counter()
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.last_progress = 0.0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @property
+    def wall_time(self):
+        return time.perf_counter() - self.started
+
+    def rate(self, name):
+        wall_time = self.wall_time
+        return self.counters[name] / wall_time if wall_time > 0 else 0.0
+
+    def snapshot(self):
+        return {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+    # Add a worker's snapshot to these totals
+    def merge(self, snapshot):
+        for name, seconds in snapshot['seconds'].items():
+            self.seconds[name] += seconds
+        for name, calls in snapshot['calls'].items():
+            self.calls[name] += calls
+        for name, n in snapshot['counters'].items():
+            self.counters[name] += n
+
+    # Single line status with the rate of the counter being tracked, in place of the old progress bar. Updates are
+    # throttled to PROGRESS_INTERVAL so printing never shows up in the timings.
+    def progress(self, count, total, prefix='', counter=None, unit='items'):
+        now = time.perf_counter()
+        if count < total and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        rate = self.rate(counter) if counter is not None else count / max(self.wall_time, 1e-9)
+        sys.stdout.write(f'{prefix}{count:,d}/{total:,d} ({100.0 * count / max(total, 1):.1f}%) '
+                         f'{rate:,.1f} {unit}/s, {self.wall_time:,.1f}s elapsed   \r')
+        sys.stdout.flush()
+        if count >= total:
+            sys.stdout.write('\n')
+
+    def report(self, **extra):
+        wall_time = self.wall_time
+        return {
+            'script': self.name,
+            'started': self.started_at,
+            'wall_seconds': wall_time,
+            'python': platform.python_version(),
+            'stages': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]}
+                       for name in sorted(self.seconds, key=self.seconds.get, reverse=True)},
+            'counters': dict(sorted(self.counters.items())),
+            'rates_per_second': {name: n / wall_time for name, n in sorted(self.counters.items())} if wall_time else {},
+            **extra,
+        }
+
+    def write(self, path, **extra):
+        with open(path, 'w') as f:
+            json.dump(self.report(**extra), f, indent=2)
+
+    def summary(self, top=8):
+        lines = [f'{self.name} finished in {self.wall_time:,.1f}s']
+        for name in sorted(self.seconds, key=self.seconds.get, reverse=True)[:top]:
+            lines.append(f'  {name:<28}{self.seconds[name]:>10,.2f}s {self.calls[name]:>12,d} calls')
+        return '\n'.join(lines)
+
+
+# Hit rate of a counter pair such as lemma_cache_hits / lemma_cache_misses, None before any lookups
+def hit_rate(metrics, hits, misses):
+    total = metrics.counters[hits] + metrics.counters[misses]
+    return metrics.counters[hits] / total if total else None
+
+
+# High-water mark of resident memory in MB for this process and, separately, the largest of its finished children
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:  # not available on windows
+        return None, None
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss is bytes on macOS, kilobytes on linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+# Run the block under cProfile when enabled, dumping the stats to path (readable with pstats or snakeviz) and printing
+# the most expensive functions. Only the calling process is profiled, not pool workers.
+@contextlib.contextmanager
+def profiled(enabled=False, path=None):
+    if not enabled:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(PROFILE_LINES)
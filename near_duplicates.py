@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""Near-Duplicate Article Detector
+
+A script to find clusters of near-duplicate articles (wire service rewrites, lightly edited reprints) in the article
+database using MinHash signatures and locality-sensitive hashing over the article bodies. Signatures are stored in the
+database so each run only has to sign and check the articles added since the last run.
+"""
+import re
+import zlib
+import hashlib
+import contextlib
+
+import sqlite3
+import numpy as np
+from pathlib import Path
+
+from bodies import BodyCodec
+from metrics import Metrics
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# Control variables
+SIMILARITY_THRESHOLD = 0.8  # estimated jaccard similarity of body shingles for two articles to be near-duplicates
+NUM_PERM = 128  # number of hash permutations in a signature
+SHINGLE_SIZE = 5  # words per shingle
+BATCH_SIZE = 1000
+SEED = 1
+
+# Directories and file paths needed
+base_path = Path(__file__).parent
+dbase_loc = str(base_path / 'articles.db')
+
+MERSENNE_PRIME = (1 << 31) - 1
+word_pattern = re.compile(r'\w+')
+
+
+# SQL condition leaving out every member of a duplicate cluster except its first (lowest ID) article, for use by the
+# index builders
+def near_duplicate_filter(id_column='ID'):
+    return f"{id_column} NOT IN (SELECT ID FROM DUPLICATE_CLUSTERS WHERE ID != CLUSTER_ID)"
+
+
+# Pick the number of bands and rows per band so that the LSH s-curve (1 / bands) ** (1 / rows) crosses the threshold
+def lsh_params(threshold=SIMILARITY_THRESHOLD, num_perm=NUM_PERM):
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """MinHash signatures over word shingles using universal hashing modulo a Mersenne prime.
+
+    Shingles are hashed with crc32 rather than the builtin hash, which is salted per process, so signatures stay
+    comparable between runs.
+    """
+
+    def __init__(self, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, threshold=SIMILARITY_THRESHOLD, seed=SEED):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+
+    @property
+    def params(self):
+        return f'perm={self.num_perm};shingle={self.shingle_size};threshold={self.threshold};seed={SEED}'
+
+    def shingles(self, body):
+        words = word_pattern.findall(body.lower())
+        n = self.shingle_size
+        grams = [' '.join(words[i:i + n]) for i in range(len(words) - n + 1)]
+        return np.unique(np.fromiter((zlib.crc32(g.encode()) for g in grams), dtype=np.uint64, count=len(grams)))
+
+    # Bodies shorter than one shingle get no signature, they carry too little text to call them duplicates
+    def signature(self, body):
+        x = self.shingles(body) % MERSENNE_PRIME
+        if x.size == 0:
+            return None
+        hashed = (self.a[:, None] * x[None, :] + self.b[:, None]) % MERSENNE_PRIME
+        return hashed.min(axis=1).astype(np.uint32)
+
+    def band_hashes(self, signature):
+        hashes = []
+        for band in range(self.bands):
+            chunk = signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            hashes.append(int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), 'little', signed=True))
+        return hashes
+
+    def similarity(self, sig_a, sig_b):
+        return float(np.mean(sig_a == sig_b))
+
+
+def create_tables(conn):
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS ARTICLE_SIGNATURES(
+        ID INTEGER PRIMARY KEY,
+        SIGNATURE BLOB NOT NULL)
+        """)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS LSH_BANDS(
+        BAND INTEGER NOT NULL,
+        HASH INTEGER NOT NULL,
+        ID INTEGER NOT NULL)
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS LSH_BANDS_HASH ON LSH_BANDS(BAND, HASH)")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS DUPLICATE_CLUSTERS(
+        ID INTEGER PRIMARY KEY,
+        CLUSTER_ID INTEGER NOT NULL)
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS NEAR_DUPLICATE_META(KEY TEXT PRIMARY KEY, VALUE TEXT NOT NULL)")
+
+
+# Signatures are only comparable when they were built with the same parameters, otherwise start over
+def reset_if_params_changed(conn, hasher):
+    res = conn.execute("SELECT VALUE FROM NEAR_DUPLICATE_META WHERE KEY='params'").fetchall()
+    if res and res[0][0] == hasher.params:
+        return False
+    with conn:
+        for table in ('ARTICLE_SIGNATURES', 'LSH_BANDS', 'DUPLICATE_CLUSTERS'):
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("INSERT OR REPLACE INTO NEAR_DUPLICATE_META VALUES ('params', ?)", [hasher.params])
+    return bool(res)
+
+
+def sign_new_articles(conn, hasher, batch_size=BATCH_SIZE):
+    BodyCodec(conn)  # registers UNPACK_BODY for compressed bodies
+    metrics = Metrics('near_duplicates')
+    cursor = conn.execute("""
+    SELECT ID FROM ARTICLES WHERE ID NOT IN (SELECT ID FROM ARTICLE_SIGNATURES) ORDER BY ID
+    """)
+    new_ids = [row[0] for row in cursor.fetchall()]
+    for i in range(0, len(new_ids), batch_size):
+        chunk = new_ids[i:i + batch_size]
+        placeholders = ','.join(['?'] * len(chunk))
+        rows = conn.execute(f"SELECT ID, UNPACK_BODY(BODY) FROM ARTICLES WHERE ID IN ({placeholders})",
+                            chunk).fetchall()
+        signatures, bands = [], []
+        for article_id, body in rows:
+            sig = hasher.signature(body)
+            if sig is None:
+                signatures.append((article_id, b''))
+            else:
+                signatures.append((article_id, sig.tobytes()))
+                bands.extend((band, h, article_id) for band, h in enumerate(hasher.band_hashes(sig)))
+        with conn:
+            conn.executemany("INSERT INTO ARTICLE_SIGNATURES VALUES (?, ?)", signatures)
+            conn.executemany("INSERT INTO LSH_BANDS VALUES (?, ?, ?)", bands)
+        metrics.progress(i + len(chunk), len(new_ids), prefix='Signing articles: ', unit='articles')
+    return new_ids
+
+
+# Candidate pairs are articles sharing at least one band bucket with a newly signed article. Only these pairs are
+# compared, which keeps the work roughly linear in the number of new articles instead of quadratic in the corpus.
+def candidate_pairs(conn, new_ids):
+    with conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS NEW_IDS(ID INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM NEW_IDS")
+        conn.executemany("INSERT INTO NEW_IDS VALUES (?)", [(i,) for i in new_ids])
+    cursor = conn.execute("""
+    SELECT DISTINCT n.ID, o.ID FROM LSH_BANDS n
+    JOIN LSH_BANDS o ON o.BAND = n.BAND AND o.HASH = n.HASH AND o.ID != n.ID
+    WHERE n.ID IN (SELECT ID FROM NEW_IDS)
+    """)
+    return {(min(a, b), max(a, b)) for a, b in cursor.fetchall()}
+
+
+def load_signatures(conn, ids, batch_size=BATCH_SIZE):
+    ids = list(ids)
+    signatures = {}
+    for i in range(0, len(ids), batch_size):
+        chunk = ids[i:i + batch_size]
+        placeholders = ','.join(['?'] * len(chunk))
+        cursor = conn.execute(f"SELECT ID, SIGNATURE FROM ARTICLE_SIGNATURES WHERE ID IN ({placeholders})", chunk)
+        for article_id, blob in cursor.fetchall():
+            signatures[article_id] = np.frombuffer(blob, dtype=np.uint32)
+    return signatures
+
+
+def find_root(parent, i):
+    while parent.setdefault(i, i) != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+# Merge verified pairs into the stored clusters. Each cluster is labelled by its lowest article ID, which is the copy
+# kept by near_duplicate_filter.
+def update_clusters(conn, pairs):
+    parent = {}
+    for article_id, cluster_id in conn.execute("SELECT ID, CLUSTER_ID FROM DUPLICATE_CLUSTERS").fetchall():
+        parent[article_id] = cluster_id
+        parent.setdefault(cluster_id, cluster_id)
+    for a, b in pairs:
+        root_a, root_b = find_root(parent, a), find_root(parent, b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    clusters = [(i, find_root(parent, i)) for i in parent]
+    with conn:
+        conn.execute("DELETE FROM DUPLICATE_CLUSTERS")
+        conn.executemany("INSERT INTO DUPLICATE_CLUSTERS VALUES (?, ?)", clusters)
+    return len({c for i, c in clusters if i != c})
+
+
+def update_near_duplicates(conn, hasher=None):
+    if hasher is None:
+        hasher = MinHasher()
+    create_tables(conn)
+    if reset_if_params_changed(conn, hasher):
+        print('Near-duplicate parameters changed, rebuilding all signatures')
+
+    new_ids = sign_new_articles(conn, hasher)
+    pairs = candidate_pairs(conn, new_ids)
+    signatures = load_signatures(conn, {i for pair in pairs for i in pair})
+    verified = [(a, b) for a, b in pairs if hasher.similarity(signatures[a], signatures[b]) >= hasher.threshold]
+    n_clusters = update_clusters(conn, verified)
+    n_duplicates = conn.execute("SELECT COUNT(*) FROM DUPLICATE_CLUSTERS WHERE ID != CLUSTER_ID").fetchall()[0][0]
+    return len(new_ids), len(pairs), len(verified), n_clusters, n_duplicates
+
+
+def main():
+    with contextlib.closing(sqlite3.connect(dbase_loc)) as conn:
+        n_new, n_candidates, n_verified, n_clusters, n_duplicates = update_near_duplicates(conn)
+
+    print(f'Signed {n_new:d} new articles, checked {n_candidates:d} candidate pairs ({n_verified:d} above the '
+          f'{SIMILARITY_THRESHOLD:.2f} threshold). {n_duplicates:d} near-duplicates in {n_clusters:d} clusters.')
+    return n_duplicates
+
+
+if __name__ == '__main__':
+    main()
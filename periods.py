@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Index Periods
+
+Turns the daily base aggregate built by the index scripts (articles, score and word totals per day) into the requested
+set of frequencies and rolling windows, aligns each with the benchmark prices and writes them side by side, one sheet
+per frequency or window, into a single workbook. Only sums are stored per day, so any period can be derived without
+going back to the articles.
+
+Periods are given as a frequency letter, 'W' (weeks ending sunday), 'M' (calendar months) or 'Q' (calendar quarters),
+optionally preceded by a window length for rolling sums over that many periods, e.g. '3M' for rolling three months.
+"""
+import re
+
+import pandas as pd
+
+from prices import benchmark_frame
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# Offsets rather than aliases, the month and quarter end aliases were renamed in newer pandas versions
+offsets = {
+    'W': pd.offsets.Week(weekday=6),
+    'M': pd.offsets.MonthEnd(),
+    'Q': pd.offsets.QuarterEnd(startingMonth=12),
+}
+spec_pattern = re.compile(r'([0-9]*)([WMQ])')
+
+
+# Split a period like '3M' into its window length and frequency, (3, 'M')
+def parse_period(period):
+    match = spec_pattern.fullmatch(period.strip().upper())
+    if match is None or (match.group(1) and int(match.group(1)) == 0):
+        raise ValueError(f"unknown period {period!r}, expected W, M or Q optionally preceded by a window length")
+    return int(match.group(1) or 1), match.group(2)
+
+
+# Frame of daily totals indexed by date from rows of (date string, total, ...)
+def daily_frame(rows, columns):
+    daily = pd.DataFrame(rows, columns=['date'] + list(columns))
+    daily['date'] = pd.to_datetime(daily['date'], format='%Y-%m-%d')
+    return daily.set_index('date').sort_index()
+
+
+# Sum the daily totals into every requested period. Each frequency is resampled once and its rolling windows are
+# summed from that, periods without articles count as zero. ratios maps new columns to a (numerator, denominator)
+# pair of totals, computed after summing so rolling windows are weighted by their articles, e.g. the mean score.
+def period_frames(daily, periods, ratios=None):
+    resampled = {}
+    frames = {}
+    for period in periods:
+        window, freq = parse_period(period)
+        if freq not in resampled:
+            resampled[freq] = daily.resample(offsets[freq]).sum()
+        frame = resampled[freq]
+        if window > 1:
+            frame = frame.rolling(window, min_periods=window).sum().dropna(how='all')
+        frame = frame.copy()
+        for name, (numerator, denominator) in (ratios or {}).items():
+            frame[name] = frame[numerator] / frame[denominator].where(frame[denominator] > 0)
+        frames[period] = frame
+    return frames
+
+
+# Merge every frame with the benchmark series. Prices are loaded once for the union of the period ends.
+def with_benchmark(frames):
+    index = None
+    for frame in frames.values():
+        index = frame.index if index is None else index.union(frame.index)
+    if index is None or index.empty:
+        return frames
+    benchmark = benchmark_frame(index)
+    return {period: frame.merge(benchmark, how='inner', left_index=True, right_index=True).dropna(subset=list(
+        benchmark.columns)) for period, frame in frames.items()}
+
+
+def write_frames(frames, path):
+    with pd.ExcelWriter(path) as writer:
+        for period, frame in frames.items():
+            frame.to_excel(writer, sheet_name=period)
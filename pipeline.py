@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""Pipeline Command Line
+
+A single entry point for the pipeline stages: scrape, process, dedup, index count and index tone, or run-all for the
+stages after scraping in order. Each stage module is imported only when its command runs, so the command line starts
+quickly and does not load NLTK or pandas for stages that do not need them.
+
+The inputs of each finished stage (its script, its options, the source files or the state of the database it reads)
+are hashed and stored in pipeline_state.json. A stage whose inputs have not changed since its last run, and whose
+outputs still exist, is skipped. Use --force to run it anyway.
+"""
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import argparse
+import contextlib
+from pathlib import Path
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# Directories and file paths needed
+base_path = Path(__file__).parent
+dbase_loc = base_path / 'articles.db'
+state_loc = base_path / 'pipeline_state.json'
+raw_path = base_path / 'data' / 'raw'
+data_path = base_path / 'data' / 'txt'
+prices_path = base_path / 'data' / 'prices'
+# The word list and lexicon tone_index.py reads, kept here so a stage signature does not import nltk and pandas
+scowl_loc = base_path / '2of12inf.txt'
+hiv_loc = base_path / 'HIV-4.csv'
+scripts = {
+    'process': ['process.py', 'rtf.py', 'manifest.py', 'bodies.py', 'downloads.py'],
+    'dedup': ['near_duplicates.py', 'bodies.py'],
+    'index count': ['article_count_index.py', 'process.py', 'bodies.py', 'near_duplicates.py', 'periods.py',
+                    'prices.py'],
+    'index tone': ['tone_index.py', 'process.py', 'bodies.py', 'near_duplicates.py', 'periods.py', 'prices.py'],
+}
+
+
+def load_state(path=state_loc):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state, path=state_loc):
+    tmp = str(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+def file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [str(path), stat.st_size, stat.st_mtime_ns]
+
+
+# Size and modification time of every file under the given folders, cheaper than hashing the whole corpus
+def tree_listing(*paths):
+    return [file_stat(f) for path in paths if path.is_dir() for f in sorted(path.rglob('*')) if f.is_file()]
+
+
+# Aggregates that change whenever articles or near-duplicate clusters are added or removed. The database is opened
+# read only so a missing database is not created by checking it.
+def database_state(path=dbase_loc):
+    if not path.is_file():
+        return None
+    queries = {
+        'articles': "SELECT COUNT(*), MAX(ID) FROM ARTICLES",
+        'daily_counts': "SELECT TOTAL(ARTICLES) FROM DAILY_COUNTS",
+        'clusters': "SELECT COUNT(*), TOTAL(ID), TOTAL(CLUSTER_ID) FROM DUPLICATE_CLUSTERS",
+    }
+    conn = sqlite3.connect(f'{path.as_uri()}?mode=ro', uri=True)
+    try:
+        state = {}
+        for name, sql in queries.items():
+            try:
+                state[name] = conn.execute(sql).fetchall()[0]
+            except sqlite3.OperationalError:  # table not created yet
+                state[name] = None
+        return state
+    finally:
+        conn.close()
+
+
+# Everything the output of a stage depends on, hashed into one signature
+def stage_signature(stage, options):
+    inputs = {'options': options}
+    for script in scripts[stage]:
+        with open(base_path / script, 'rb') as f:
+            inputs[script] = hashlib.sha1(f.read()).hexdigest()
+    if stage == 'process':
+        inputs['sources'] = tree_listing(raw_path, data_path)
+    else:
+        inputs['database'] = database_state()
+    if stage.startswith('index'):
+        inputs['prices'] = tree_listing(prices_path)
+    if stage == 'index tone':
+        inputs['lexicon'] = [file_stat(scowl_loc), file_stat(hiv_loc)]
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Run stage unless its signature matches the last run and its outputs exist. run returns the output paths.
+def run_stage(stage, options, run, force=False):
+    state = load_state()
+    signature = stage_signature(stage, options)
+    previous = state.get(stage)
+    if not force and previous and previous['signature'] == signature and all(
+            Path(p).exists() for p in previous['outputs']):
+        print(f'{stage}: up to date, skipping (use --force to run it anyway)')
+        return previous['outputs']
+
+    print(f'{stage}: running')
+    outputs = [str(p) for p in run()]
+    # The stage itself changes the database, so the signature is taken again after it has run
+    state = load_state()
+    state[stage] = {'signature': stage_signature(stage, options), 'outputs': outputs}
+    save_state(state)
+    return outputs
+
+
+def scrape_command(args):
+    import scrape
+    failed = scrape.main(ingest=args.ingest or scrape.INGEST_WHILE_SCRAPING)
+    return 1 if failed else 0
+
+
+def process_command(args):
+    import process
+    source = args.source or process.SOURCE
+    run_stage('process', {'source': source}, lambda: [process.main(source)], args.force)
+    return 0
+
+
+def dedup_command(args):
+    import near_duplicates
+
+    def run():
+        near_duplicates.main()
+        return [near_duplicates.dbase_loc]
+
+    run_stage('dedup', {'threshold': near_duplicates.SIMILARITY_THRESHOLD}, run, args.force)
+    return 0
+
+
+def count_command(args):
+    import article_count_index
+    periods = args.periods or article_count_index.PERIODS
+    term_query = args.term_filter or article_count_index.TERM_FILTER
+    drop_near_duplicates = article_count_index.DROP_NEAR_DUPLICATES
+    options = {'periods': periods, 'term_filter': term_query, 'drop_near_duplicates': drop_near_duplicates}
+    run_stage('index count', options, lambda: [article_count_index.main(periods, drop_near_duplicates, term_query)],
+              args.force)
+    return 0
+
+
+def tone_command(args):
+    import tone_index
+    periods = args.periods or tone_index.PERIODS
+    term_query = args.term_filter or tone_index.TERM_FILTER
+    options = {'periods': periods, 'term_filter': term_query, 'score_from_dtm': tone_index.SCORE_FROM_DTM}
+    run_stage('index tone', options, lambda: [tone_index.main(term_query, periods)], args.force)
+    return 0
+
+
+# One-off rewrite of the stored bodies, not a stage, so it always runs
+def compress_command(args):
+    import process
+    compression = None if args.compression == 'none' else args.compression
+    with contextlib.closing(sqlite3.connect(str(dbase_loc))) as conn:
+        changed = process.compress_bodies(conn, compression, vacuum=not args.no_vacuum)
+    print(f'Rewrote {changed:d} bodies as {args.compression}, '
+          f'articles.db is now {dbase_loc.stat().st_size / 2 ** 20:,.1f} MB')
+    return 0
+
+
+# Every stage after scraping, in order. Scraping needs a browser and credentials, so it is always run on its own.
+def run_all_command(args):
+    for command in (process_command, dedup_command, count_command, tone_command):
+        status = command(args)
+        if status:
+            return status
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Scrape Nexis Uni and build article count and tone indices.')
+    parser.add_argument('--force', action='store_true', help='run stages even when their inputs have not changed')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    scrape_parser = commands.add_parser('scrape', help='download search results')
+    scrape_parser.add_argument('--ingest', action='store_true',
+                               help='parse each archive into articles.db as soon as it has been downloaded')
+    scrape_parser.set_defaults(func=scrape_command)
+
+    process_parser = commands.add_parser('process', help='parse downloads into articles.db')
+    process_parser.add_argument('--source', choices=['zip', 'txt'],
+                                help='read archives from data/raw or DocFrac .txt files from data/txt')
+    process_parser.set_defaults(func=process_command)
+
+    commands.add_parser('dedup', help='cluster near-duplicate articles').set_defaults(func=dedup_command)
+
+    compress_parser = commands.add_parser('compress', help='rewrite the bodies in articles.db in another compression')
+    compress_parser.add_argument('compression', choices=['zlib', 'zstd', 'none'])
+    compress_parser.add_argument('--no-vacuum', action='store_true', help='skip shrinking the file afterwards')
+    compress_parser.set_defaults(func=compress_command)
+
+    index_parser = commands.add_parser('index', help='build an index')
+    indices = index_parser.add_subparsers(dest='index', metavar='index')
+    indices.required = True
+    count_parser = indices.add_parser('count', help='article count index')
+    count_parser.set_defaults(func=count_command)
+    tone_parser = indices.add_parser('tone', help='Harvard IV-4 tone index')
+    tone_parser.set_defaults(func=tone_command)
+
+    run_all_parser = commands.add_parser('run-all', help='process, dedup and build both indices')
+    run_all_parser.add_argument('--source', choices=['zip', 'txt'])
+    run_all_parser.set_defaults(func=run_all_command)
+
+    # Options left out fall back to the control variables of the stage script
+    for sub_parser in (count_parser, tone_parser, run_all_parser):
+        sub_parser.add_argument('--periods', nargs='+', metavar='PERIOD',
+                                help="W, M or Q, or a window length and one of them for rolling sums such as 3M")
+        sub_parser.add_argument('--term-filter', help='FTS5 query selecting the articles to index')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    sys.exit(args.func(args))
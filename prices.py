@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Benchmark Price Cache
+
+A small file backed store for the daily benchmark series (^OVX by default) that the index builders are compared
+against. Prices are kept as one csv per symbol in data/prices and only the missing dates are requested from Yahoo
+Finance, so repeated runs hit the network at most once a day and runs without network access use the cached series.
+Prices exported from elsewhere can be loaded from a local csv with Date and Adj Close (or Close) columns.
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+from pathlib import Path
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# Control variables
+SYMBOL = '^OVX'
+TOP_UP = True  # request dates missing from the cache from Yahoo Finance, set False on machines without network access
+SOURCE_CSV = None  # optional local csv of prices merged into the cache before any download
+
+# Directories and file paths needed
+base_path = Path(__file__).parent
+prices_path = base_path / 'data' / 'prices'
+
+base_url = 'https://query1.finance.yahoo.com/v7/finance/download'
+
+
+def cache_path(symbol):
+    return prices_path / (symbol.strip('^').upper() + '.csv')
+
+
+# Earliest date already requested from the source. Series that start later than that (OVX begins in 2007) would
+# otherwise be downloaded again on every run that asks for earlier dates.
+def covered_from(symbol):
+    path = cache_path(symbol).with_suffix('.start')
+    if path.is_file():
+        return pd.Timestamp(path.read_text().strip())
+    return None
+
+
+def write_covered_from(symbol, start):
+    cache_path(symbol).with_suffix('.start').write_text(f'{pd.Timestamp(start):%Y-%m-%d}\n')
+
+
+# Day of the last request for the latest prices, successful or not. A cache that is still behind after it (the close
+# of the last weekday is often published late) is not requested again before the next day.
+def last_requested(symbol):
+    path = cache_path(symbol).with_suffix('.requested')
+    if path.is_file():
+        return pd.Timestamp(path.read_text().strip())
+    return None
+
+
+def write_last_requested(symbol):
+    path = cache_path(symbol).with_suffix('.requested')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(f'{pd.Timestamp.today():%Y-%m-%d}\n')
+
+
+# Read a price csv into a series of adjusted closes indexed by date. Falls back to Close for files without adjustments.
+def load_csv(path):
+    data = pd.read_csv(path, parse_dates=['Date'], index_col=['Date'])
+    column = 'Adj Close' if 'Adj Close' in data.columns else 'Close'
+    prices = pd.to_numeric(data[column], errors='coerce').dropna()
+    prices.index.names = ['date']
+    prices.name = 'Adj Close'
+    return prices.sort_index()
+
+
+def read_cache(symbol):
+    path = cache_path(symbol)
+    if path.is_file():
+        return load_csv(path)
+    return pd.Series(dtype='float64', name='Adj Close', index=pd.DatetimeIndex([], name='date'))
+
+
+# Written to a temporary file first so an interrupted run never leaves a truncated cache behind
+def write_cache(symbol, prices):
+    path = cache_path(symbol)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = str(path) + '.tmp'
+    prices.rename_axis('Date').to_frame('Adj Close').to_csv(tmp)
+    os.replace(tmp, path)
+
+
+def fetch_yahoo(symbol, start):
+    period1 = int(datetime.timestamp(pd.Timestamp(start)))
+    period2 = int(time.time())
+    url = f'{base_url}/{symbol}?period1={period1}&period2={period2}&interval=1d&events=history'
+    return load_csv(url)
+
+
+def combine(prices, new_prices):
+    if new_prices.empty:
+        return prices
+    if prices.empty:
+        return new_prices
+    return new_prices.combine_first(prices).sort_index()
+
+
+# The cache covers start when it reaches back that far or start has been requested before
+def covers_start(prices, start, first_requested=None):
+    start = pd.Timestamp(start)
+    if prices.empty:
+        return False
+    return prices.index[0] <= start or (first_requested is not None and first_requested <= start)
+
+
+# The cache is current once it covers start and holds the last weekday before today
+def is_current(prices, start, first_requested=None):
+    if not covers_start(prices, start, first_requested):
+        return False
+    return prices.index[-1] >= pd.Timestamp.today().normalize() - pd.offsets.BDay(1)
+
+
+# Return the cached daily prices of symbol from start onwards, merging in source_csv and topping up from Yahoo Finance
+# when the cache does not cover the requested range. Recent prices are requested at most once a day, dates before the
+# cache are requested whenever they are missing. A failed download keeps the cached prices and only raises if there is
+# nothing cached at all.
+def load_prices(start, symbol=SYMBOL, top_up=TOP_UP, source_csv=SOURCE_CSV):
+    prices = read_cache(symbol)
+    changed = False
+
+    if source_csv is not None:
+        prices = combine(prices, load_csv(source_csv))
+        changed = True
+
+    first_requested = covered_from(symbol)
+    covered = covers_start(prices, start, first_requested)
+    requested_today = last_requested(symbol) == pd.Timestamp.today().normalize()
+    if top_up and not is_current(prices, start, first_requested) and not (covered and requested_today):
+        fetch_from = prices.index[-1] if covered else pd.Timestamp(start)
+        write_last_requested(symbol)
+        try:
+            prices = combine(prices, fetch_yahoo(symbol, fetch_from))
+            changed = True
+            if first_requested is None or fetch_from < first_requested:
+                first_requested = fetch_from
+        except (OSError, ValueError) as ex:  # urllib errors are OSErrors, bad responses fail to parse
+            sys.stdout.write(f'Could not update {symbol} prices ({ex}), using the cached series\n')
+
+    if changed:
+        write_cache(symbol, prices)
+        if first_requested is not None:
+            write_covered_from(symbol, first_requested)
+    if prices.empty:
+        raise OSError(f'no cached prices for {symbol} in {cache_path(symbol)} and no source available')
+    return prices[prices.index >= pd.Timestamp(start)]
+
+
+# Benchmark prices as of each date in index (last available close on or before that date), as a one column frame ready
+# to merge with an index
+def benchmark_frame(index, symbol=SYMBOL, column='OVX', lookback=pd.DateOffset(months=1)):
+    prices = load_prices(index.min() - lookback, symbol)
+    return prices.to_frame(column).reindex(index, method='ffill')
+
+
+if __name__ == '__main__':
+    start = sys.argv[1] if len(sys.argv) > 1 else '2000-01-01'
+    prices = load_prices(start)
+    print(f'{len(prices):d} {SYMBOL} prices cached from {prices.index[0]:%Y-%m-%d} to {prices.index[-1]:%Y-%m-%d} '
+          f'in {cache_path(SYMBOL)}')
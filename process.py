@@ -6,11 +6,27 @@ A script to parse .txt files of news articles and cleanup the data for storage i
 import os
 import re
 import sys
+import csv
+import queue
+import threading
+import mmap
+import zlib
+import zipfile
+import uuid
+import datetime
+import functools
 import contextlib
+import collections
+import multiprocessing
 
 import sqlite3
 from pathlib import Path
-from dateutil.parser import parse as dateparser
+
+from rtf import rtf_to_text
+from downloads import is_placeholder
+from manifest import ScrapeManifest, file_checksum
+from metrics import Metrics, profiled
+from bodies import BodyCodec, DICTIONARY_SAMPLES, create_tables as create_body_tables
 
 __author__ = 'Andre Bodo'
 __copyright__ = 'Copyright 2020, Andre Bodo'
@@ -21,159 +37,844 @@ __maintainer__ = 'Andre Bodo'
 __email__ = 'bodo1184@mylaurier.ca'
 __status__ = 'Prototype'
 
+# Control variables
+BATCH_SIZE = 5000
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_CHUNK_SIZE = 32
+HEADER_GAP = 3  # blank lines between the header and the body of an article
+TXT_ENCODING = 'utf-8-sig'  # encoding of the DocFrac .txt files, undecodable bytes are replaced
+BODY_COMPRESSION = None  # None stores bodies as plain text, 'zlib' or 'zstd' (needs zstandard) compresses them
+INGEST_QUEUE_SIZE = 8  # downloaded archives waiting to be ingested before the scraper has to wait for the ingester
+PROFILE = False  # run under cProfile and save the stats next to the metrics report
+
+# Where the articles are read from: 'zip' reads the archives downloaded by scrape.py straight from data/raw and converts
+# the RTF in memory, 'txt' reads files already extracted and converted with DocFrac into data/txt
+SOURCE = 'zip'
+
 # Directories and file paths needed
 base_path = Path(__file__).parent
-data_path = Path(str(base_path) + '\\data\\txt\\')
-dbase_loc = str(base_path) + '\\articles.db'
-
-
-def extract_header(s):
-    match = re.search(r'\n{4,}', s, re.IGNORECASE)
-    if match:
-        return s[:match.start()]
-    return None
-
-
-# This function is to handle the various inconsistencies with Nexis Uni data formatting.
-def extract_primary_metadata(s):
-    match = re.search(r'\n\scorrection\sappended', s, re.IGNORECASE)
-    if match:
-        return s[:match.start()]
-    match = re.search(r'\ncopyright', s, re.IGNORECASE)
-    if match:
-        return s[:match.start()]
-    return None
-
-
-def extract_body(s):
-    match_start = re.search(r'\n{4,}', s, re.IGNORECASE)
-    match_end = re.search(r'\nlanguage:|\nclassification', s, re.IGNORECASE)
-    if match_start and match_end:
-        return s[match_start.end():match_end.start()]
-    return None
-
-
-def execute_statement(statement, data=None):
-    with contextlib.closing(sqlite3.connect(dbase_loc)) as conn:
-        with conn:  # auto-commit
-            with contextlib.closing(conn.cursor()) as cursor:
-                if data is not None:
-                    cursor.execute(statement, data)
-                    return cursor.fetchall()
-                else:
-                    cursor.execute(statement)
-                    return cursor.fetchall()
+raw_path = base_path / 'data' / 'raw'
+data_path = base_path / 'data' / 'txt'
+dbase_loc = str(base_path / 'articles.db')
+error_report_loc = str(base_path / 'parse_errors.csv')
+metrics_loc = str(base_path / 'process_metrics.json')
+ingest_metrics_loc = str(base_path / 'ingest_metrics.json')  # the ingester running alongside scrape.py
+profile_loc = str(base_path / 'process.prof')
+
+# Stage timers and counters of the parsing code in this process, pool workers each have their own copy
+parse_metrics = Metrics('parse')
+
+
+# Lines that start the metadata block following the body of a Nexis Uni document. Load-Date and Language are fields
+# followed by a colon, Classification is a heading on its own line, so body paragraphs starting with those words are
+# kept.
+body_end_pattern = re.compile(r'(load-date|language)\s*:|classification$', re.IGNORECASE)
+month_pattern = re.compile(r'\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)', re.IGNORECASE)
+year_pattern = re.compile(r'\b[0-9]{4}\b')
+day_pattern = re.compile(r'\b[0-9]{1,2}\b')
+months = {m: i for i, m in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov',
+                                      'dec'], start=1)}
+
+# Version of the parser that filled a database, stored in its user_version. Bump it whenever parsing changes a
+# de-duplication field (title, date, publisher, author or word count) or the body, since articles parsed by two versions
+# no longer match as duplicates. 0 is every database built before the version was recorded.
+PARSER_VERSION = 2
+
+
+class ParseError(ValueError):
+    """An article with fields that could not be parsed, failures maps each field to what was wrong with it."""
+
+    def __init__(self, failures):
+        super().__init__('; '.join(f'{field}: {message}' for field, message in failures.items()))
+        self.failures = failures
+
+
+class StaleDatabaseError(ValueError):
+    """A database holding articles parsed by another version of the parser, which has to be rebuilt."""
+
+
+# Split a stream of lines into documents at the End of Document line that follows every article, so an export holding
+# many articles is parsed one article at a time
+def split_documents(lines):
+    document = []
+    has_text = False
+    for line in lines:
+        if line.strip().lower() == 'end of document':
+            if has_text:
+                yield document
+            document = []
+            has_text = False
+        else:
+            document.append(line)
+            has_text = has_text or bool(line.strip())
+    if has_text:
+        yield document
+
+
+# One pass over the lines of a document. The header runs up to the first HEADER_GAP blank lines and starts with the
+# primary metadata (title, publisher and date, up to the Copyright or Correction Appended line), the byline is
+# somewhere in the header and the body runs from the gap up to the Load-Date, Language or Classification line.
+# Returns the primary metadata lines, the byline and the body lines, and whether each block was closed.
+def scan_article(lines):
+    meta, body = [], []
+    byline = None
+    state = 'meta'
+    meta_closed = body_closed = False
+    blank_run = 0
+
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            blank_run += 1
+            if state != 'body' and blank_run >= HEADER_GAP:
+                state = 'body'
+            elif state == 'body' and body:
+                body.append('')
+            continue
+        blank_run = 0
+        lowered = stripped.lower()
+
+        if state == 'body':
+            if body_end_pattern.match(lowered):
+                body_closed = True
+                break
+            body.append(stripped)
+            continue
+
+        if lowered.startswith('byline'):
+            byline = stripped
+        if state == 'meta':
+            if lowered.startswith('correction appended') or lowered.startswith('copyright'):
+                state = 'header'
+                meta_closed = True
+            else:
+                meta.append(stripped)
+
+    return meta, meta_closed, byline, body, body_closed
+
+
+def parse_date(line):
+    year = year_pattern.search(line)
+    month = month_pattern.search(line)
+    day = day_pattern.search(line)
+    if not (year and month and day):
+        raise ValueError(f'no day, month and year in {line!r}')
+    return datetime.date(int(year.group(0)), months[month.group(0).lower()], int(day.group(0))).strftime('%Y-%m-%d')
+
+
+# Parse the lines of one document into a (title, date, publisher, author, body, word_count) record. Every field is
+# tried, so a ParseError lists all the fields that failed rather than the first one.
+def parse_article(lines):
+    failures = {}
+    with parse_metrics.stage('parse.scan'):
+        meta, meta_closed, byline, body, body_closed = scan_article(lines)
+
+    title = publisher = date = None
+    if not meta_closed:
+        failures['metadata'] = 'no Copyright or Correction Appended line in the header'
+    elif len(meta) < 3:
+        failures['metadata'] = f'expected title, publisher and date lines, found {len(meta):d}'
+    else:
+        title, publisher = meta[0], meta[1]
+        with parse_metrics.stage('parse.date'):
+            try:
+                date = parse_date(meta[-1])
+            except ValueError as ex:
+                failures['date'] = str(ex)
+
+    author = None
+    if byline is not None:
+        author = re.sub(r'^byline:?', '', byline, flags=re.IGNORECASE).strip() or None
 
-# Text based progress bar from StackOverflow user Vladimir Ignatyev: https://stackoverflow.com/a/27871113 If you are
-# using pycharm this function may not work as expected. To ensure it prints correctly, go to Run and make sure the
-# Emulate terminal in output console is selected
-def progress(count, total, prefix=''):
-    bar_len = 60
-    filled_len = int(round(bar_len * count / float(total)))
+    if not body_closed:
+        failures['body'] = 'no Load-Date, Language or Classification line after the body'
+    body = '\n'.join(body).strip()
+    if body_closed and not body:
+        failures['body'] = 'empty body'
 
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
+    if failures:
+        raise ParseError(failures)
+    return title, date, publisher, author, body, len(body.split())
 
-    sys.stdout.write(f'{prefix}[{bar}] {percents}%\r')
-    sys.stdout.flush()  # As suggested by Rom Ruben
 
+def is_archive(filepath):
+    return filepath.suffix.lower() == '.zip'
 
-# Main work follows
-incomplete_uidx = []
-incomplete_files = [f for f in data_path.rglob('idx_*_batch_*_deliverynotification.txt')]
-for filepath in incomplete_files:
-    m = re.match(r'(?:idx_)([0-9]+)(?:.+)', filepath.name)
-    if m:
-        incomplete_uidx.append(m.group(1))
 
-print(f'There were {len(incomplete_uidx)} incomplete download files detected. ')
-if incomplete_uidx:
+# Placeholder files for downloads that failed, loose placeholders get deleted and the url indices of all of them are
+# reported for re-scraping
+def find_incomplete_downloads():
+    incomplete_uidx = []
+    pattern = 'idx_*_batch_*_deliverynotification.txt'
+    incomplete_files = [f for path in (data_path, raw_path) for f in path.rglob(pattern)]
+    incomplete_names = [f.name for f in incomplete_files]
+    for filepath in raw_path.rglob('*'):
+        if is_archive(filepath):
+            try:
+                with zipfile.ZipFile(filepath) as archive:
+                    if any(is_placeholder(name) for name in archive.namelist()):
+                        incomplete_names.append(filepath.name)
+            except zipfile.BadZipFile:
+                incomplete_names.append(filepath.name)
+    for name in incomplete_names:
+        m = re.match(r'(?:idx_)([0-9]+)(?:.+)', name)
+        if m and m.group(1) not in incomplete_uidx:
+            incomplete_uidx.append(m.group(1))
+
+    # mark the batches in the scrape manifest so the next scrape only fetches these again
+    with ScrapeManifest() as manifest:
+        for name in incomplete_names:
+            m = re.match(r'idx_([0-9]+)_batch_([0-9]+)', name)
+            if m:
+                manifest.invalidate_batch(int(m.group(1)), int(m.group(2)), f'idx_{m.group(1)}_batch_{m.group(2)}')
+
+    print(f'There were {len(incomplete_uidx)} incomplete downloads detected. ')
+    if incomplete_uidx:
+        try:
+            for i in range(len(incomplete_files)):
+                incomplete_files[i].unlink(missing_ok=True)
+        except (TypeError, ValueError) as ex:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_tb.tb_lineno)
+
+        print(f'Re-scraping recommended for url indicies:\n{", ".join(incomplete_uidx)}\n'
+              f'Incomplete download notification files have been deleted')
+    return incomplete_uidx
+
+
+# Create a dbase if it does not exist. Duplicates are rejected by a unique index over the de-duplication fields rather
+# than a SELECT per article. AUTHOR is wrapped in IFNULL because SQLite treats NULLs as distinct in unique indices,
+# which would otherwise let articles without a byline through more than once. Returns the BodyCodec that packs bodies
+# in compression for insert_articles.
+def create_tables(conn, compression=None):
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS ARTICLES(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT, 
+        TITLE TEXT NOT NULL,
+        DATE TEXT NOT NULL, 
+        PUBLISHER TEXT NOT NULL,
+        AUTHOR TEXT, 
+        BODY TEXT NOT NULL,
+        WORDCOUNT INTEGER NOT NULL)
+        """)
+        res = conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='ARTICLES_DEDUP'").fetchall()
+        if not res:
+            # databases built before the index existed can hold duplicates, keep the first copy of each
+            conn.execute("""
+            DELETE FROM ARTICLES WHERE ID NOT IN (
+            SELECT MIN(ID) FROM ARTICLES GROUP BY TITLE, DATE, PUBLISHER, IFNULL(AUTHOR, ''), WORDCOUNT)
+            """)
+            conn.execute("""
+            CREATE UNIQUE INDEX ARTICLES_DEDUP ON ARTICLES(TITLE, DATE, PUBLISHER, IFNULL(AUTHOR, ''), WORDCOUNT)
+            """)
+        conn.execute("CREATE INDEX IF NOT EXISTS ARTICLES_DATE ON ARTICLES(DATE)")
+    create_body_tables(conn)
+    codec = BodyCodec(conn, compression)
+    create_count_table(conn)
+    create_search_table(conn, unpack=True if compression is not None else None)
+    create_ingest_table(conn)
+    create_identity_table(conn)
+    return codec
+
+
+# Number of articles and their total word count per day, kept up to date by triggers on ARTICLES so the index builders
+# never have to scan the articles themselves. Rows rejected by INSERT OR IGNORE do not fire the insert trigger, so
+# duplicates are never counted. A database created before the table (or its WORDS column) existed is backfilled from
+# ARTICLES once.
+def create_count_table(conn):
+    with conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(DAILY_COUNTS)").fetchall()]
+        if columns and 'WORDS' not in columns:
+            # the triggers of the old table only count articles, they are recreated below
+            for trigger in ('ARTICLES_COUNT_INSERT', 'ARTICLES_COUNT_DELETE', 'ARTICLES_COUNT_UPDATE'):
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.execute("DROP TABLE DAILY_COUNTS")
+            columns = []
+        if not columns:
+            conn.execute("""
+            CREATE TABLE DAILY_COUNTS(
+            DATE TEXT PRIMARY KEY,
+            ARTICLES INTEGER NOT NULL,
+            WORDS INTEGER NOT NULL)
+            """)
+            conn.execute("INSERT INTO DAILY_COUNTS SELECT DATE, COUNT(*), SUM(WORDCOUNT) FROM ARTICLES GROUP BY DATE")
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS ARTICLES_COUNT_INSERT AFTER INSERT ON ARTICLES
+        BEGIN
+            INSERT OR IGNORE INTO DAILY_COUNTS VALUES (new.DATE, 0, 0);
+            UPDATE DAILY_COUNTS SET ARTICLES = ARTICLES + 1, WORDS = WORDS + new.WORDCOUNT WHERE DATE = new.DATE;
+        END
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS ARTICLES_COUNT_DELETE AFTER DELETE ON ARTICLES
+        BEGIN
+            UPDATE DAILY_COUNTS SET ARTICLES = ARTICLES - 1, WORDS = WORDS - old.WORDCOUNT WHERE DATE = old.DATE;
+        END
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS ARTICLES_COUNT_UPDATE AFTER UPDATE OF DATE, WORDCOUNT ON ARTICLES
+        BEGIN
+            UPDATE DAILY_COUNTS SET ARTICLES = ARTICLES - 1, WORDS = WORDS - old.WORDCOUNT WHERE DATE = old.DATE;
+            INSERT OR IGNORE INTO DAILY_COUNTS VALUES (new.DATE, 0, 0);
+            UPDATE DAILY_COUNTS SET ARTICLES = ARTICLES + 1, WORDS = WORDS + new.WORDCOUNT WHERE DATE = new.DATE;
+        END
+        """)
+
+
+# Full-text index over TITLE and BODY for term filtered sub-indices. It is an external content FTS5 table, so the text
+# is not stored twice, kept in step with ARTICLES by triggers and built from the existing articles once. Its content is
+# the ARTICLE_TEXT view. While every body is plain text the view and triggers are built-in SQL only, so any client
+# (the sqlite3 shell, another script) can write to ARTICLES. unpack switches them to UNPACK_BODY for compressed bodies,
+# after which every connection writing to ARTICLES needs a BodyCodec (create_tables registers one), None keeps the
+# current form. An index built before bodies could be compressed is rebuilt in this form. Returns False when the
+# SQLite library was compiled without FTS5.
+def create_search_table(conn, unpack=None):
     try:
-        for i in range(len(incomplete_files)):
-            incomplete_files[i].unlink(missing_ok=True)
-    except (TypeError, ValueError) as ex:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        print(exc_type, exc_tb.tb_lineno)
-
-    print(f'Re-scraping recommended for url indicies:\n{", ".join(incomplete_uidx)}\n'
-          f'Incomplete download notification files have been deleted')
-
-# Create a dbase if it does not exist
-sql = """
-CREATE TABLE IF NOT EXISTS ARTICLES(
-ID INTEGER PRIMARY KEY AUTOINCREMENT, 
-TITLE TEXT NOT NULL,
-DATE TEXT NOT NULL, 
-PUBLISHER TEXT NOT NULL,
-AUTHOR TEXT, 
-BODY TEXT NOT NULL,
-WORDCOUNT INTEGER NOT NULL)
-"""
-execute_statement(sql)
+        with conn:
+            res = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='ARTICLES_FTS'").fetchall()
+            if res and 'ARTICLE_TEXT' not in res[0][0]:
+                for trigger in search_triggers:
+                    conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+                conn.execute("DROP TABLE ARTICLES_FTS")
+                res = []
+            current = search_unpacks_bodies(conn)
+            if unpack is None:
+                unpack = current
+            elif unpack != current:  # same text either way, so the index itself stays
+                for trigger in search_triggers:
+                    conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+                conn.execute("DROP VIEW IF EXISTS ARTICLE_TEXT")
+            conn.execute(f"""
+            CREATE VIEW IF NOT EXISTS ARTICLE_TEXT AS SELECT ID, TITLE, {body_text('ARTICLES', unpack)} AS BODY
+            FROM ARTICLES
+            """)
+            if not res:
+                conn.execute("""
+                CREATE VIRTUAL TABLE ARTICLES_FTS USING fts5(TITLE, BODY, content='ARTICLE_TEXT', content_rowid='ID')
+                """)
+            conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS ARTICLES_FTS_INSERT AFTER INSERT ON ARTICLES
+            BEGIN
+                INSERT INTO ARTICLES_FTS(rowid, TITLE, BODY) VALUES (new.ID, new.TITLE, {body_text('new', unpack)});
+            END
+            """)
+            conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS ARTICLES_FTS_DELETE AFTER DELETE ON ARTICLES
+            BEGIN
+                INSERT INTO ARTICLES_FTS(ARTICLES_FTS, rowid, TITLE, BODY)
+                VALUES ('delete', old.ID, old.TITLE, {body_text('old', unpack)});
+            END
+            """)
+            create_search_update_trigger(conn, unpack)
+            if not res:
+                conn.execute("INSERT INTO ARTICLES_FTS(ARTICLES_FTS) VALUES ('rebuild')")
+    except sqlite3.OperationalError as ex:
+        if 'fts5' not in str(ex):
+            raise
+        print('SQLite was built without FTS5, term filters are not available')
+        return False
+    return True
+
+
+search_triggers = ('ARTICLES_FTS_INSERT', 'ARTICLES_FTS_DELETE', 'ARTICLES_FTS_UPDATE')
+
+
+# SQL for the text of the BODY column of row, through UNPACK_BODY when bodies may be compressed
+def body_text(row, unpack):
+    return f'UNPACK_BODY({row}.BODY)' if unpack else f'{row}.BODY'
 
-# Loop through all the articles, parse and insert into database
-duplicate_count = 0
-all_article_files = list(data_path.rglob('*.txt'))
-for idx, filepath in enumerate(all_article_files):
+
+# True when the full-text triggers unpack bodies, i.e. the database has been set up for compressed bodies
+def search_unpacks_bodies(conn):
+    res = conn.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='ARTICLES_FTS_INSERT'").fetchall()
+    return bool(res) and 'UNPACK_BODY' in res[0][0]
+
+
+def create_search_update_trigger(conn, unpack):
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS ARTICLES_FTS_UPDATE AFTER UPDATE OF TITLE, BODY ON ARTICLES
+    BEGIN
+        INSERT INTO ARTICLES_FTS(ARTICLES_FTS, rowid, TITLE, BODY)
+        VALUES ('delete', old.ID, old.TITLE, {body_text('old', unpack)});
+        INSERT INTO ARTICLES_FTS(rowid, TITLE, BODY) VALUES (new.ID, new.TITLE, {body_text('new', unpack)});
+    END
+    """)
+
+
+# Refuse to add articles to a database filled by another parser version, an empty one is stamped with PARSER_VERSION.
+# Articles parsed again by a newer parser differ in the de-duplication fields, so every one of them would be stored a
+# second time next to its old copy. Runs before create_tables, so a refused database is left exactly as it was.
+def check_parser_version(conn, db_path=dbase_loc):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version == PARSER_VERSION:
+        return
+    res = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='ARTICLES'").fetchall()
+    if res and conn.execute("SELECT 1 FROM ARTICLES LIMIT 1").fetchall():
+        raise StaleDatabaseError(f'{db_path} was built by parser version {version:d}, this is version '
+                                 f'{PARSER_VERSION:d}. Move or delete it and run process.py again to rebuild it '
+                                 f'from the downloads.')
+    with conn:
+        conn.execute(f"PRAGMA user_version = {PARSER_VERSION:d}")
+
+
+# Rewrite every stored body in compression (None for plain text), e.g. to compress an existing database. Bodies are
+# unpacked and packed again in batch_size transactions, the full-text update trigger is dropped meanwhile since the
+# text itself does not change. The file only shrinks once it is vacuumed, which needs free disk space for a copy.
+def compress_bodies(conn, compression=BODY_COMPRESSION, batch_size=BATCH_SIZE, vacuum=True):
+    codec = create_tables(conn, compression)
+    ids = [row[0] for row in conn.execute("SELECT ID FROM ARTICLES ORDER BY ID").fetchall()]
+    if compression == 'zstd':
+        sample = conn.execute("SELECT UNPACK_BODY(BODY) FROM ARTICLES ORDER BY RANDOM() LIMIT ?",
+                              [DICTIONARY_SAMPLES]).fetchall()
+        codec.prepare([row[0] for row in sample])
+
+    unpack = search_unpacks_bodies(conn)
+    with conn:
+        conn.execute("DROP TRIGGER IF EXISTS ARTICLES_FTS_UPDATE")
+    changed = 0
     try:
-        with open(filepath) as f:
-            content = f.read().strip()
-            # Find header and extract
-            header = extract_header(content)
-            primary_meta = [line.rstrip() for line in extract_primary_metadata(header).splitlines() if line.strip()]
-            title = primary_meta[0].strip()
-            publisher = primary_meta[1].strip()
-            date = primary_meta[-1].strip()
-
-            # Parse author
-            author = [line for line in header if line.lower().startswith('byline')]
-            if author:
-                author = re.sub(re.compile(r'byline:', re.IGNORECASE), '', author[0])
-            else:
-                author = None
-
-            # Parse date
-            year = re.search(r'[0-9]{4}', date).group(0)
-            day = re.search(r'[0-9]{1,2}', date).group(0)
-            month_pattern = re.compile(r'(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)', flags=re.IGNORECASE)
-            month = re.search(month_pattern, date).group(0)
-            date_str = '-'.join([year, month, day])
-            date = dateparser(date_str, fuzzy=True).strftime('%Y-%m-%d')
-
-            # Cleanup the body and determine wordcount
-            body = extract_body(content)
-            pattern = re.compile(r'(\w+)(?:\n|\Z)', re.IGNORECASE)
-            match_idx = [m.span() for m in re.finditer(pattern, body)]
-            if match_idx:
-                first_match = match_idx[0]
-                body = body[0:first_match[0]].replace('\n', '')
-
-            word_count = len(body.split(' '))
-
-            # Determine if there is a duplicate
-            is_duplicate = False
-            sql = """
-            SELECT ID PUBLISHER, AUTHOR, WORDCOUNT FROM ARTICLES 
-            WHERE TITLE=? AND DATE=? AND PUBLISHER=? AND AUTHOR=? AND WORDCOUNT=?
-            """
-            res = execute_statement(sql, data=[title, date, publisher, author, word_count])
-            if res:
-                is_duplicate = True
-                duplicate_count += 1
-                break
+        for i in range(0, len(ids), batch_size):
+            chunk = ids[i:i + batch_size]
+            placeholders = ','.join(['?'] * len(chunk))
+            rows = conn.execute(f"SELECT ID, BODY FROM ARTICLES WHERE ID IN ({placeholders})", chunk).fetchall()
+            updates = []
+            for article_id, body in rows:
+                packed = codec.pack(codec.unpack(body))
+                if packed != body:
+                    updates.append((packed, article_id))
+            with conn:
+                conn.executemany("UPDATE ARTICLES SET BODY=? WHERE ID=?", updates)
+            changed += len(updates)
+            parse_metrics.progress(i + len(chunk), len(ids), prefix='Rewriting bodies: ', unit='articles')
+    finally:
+        with conn:
+            create_search_update_trigger(conn, unpack)
+    if compression is None:  # every body is plain text again, other clients can write without UNPACK_BODY
+        create_search_table(conn, unpack=False)
+
+    if vacuum:
+        conn.execute("VACUUM")
+    return changed
+
+
+# Archives whose articles are all in ARTICLES, with the checksum of the file that was read, so a rerun or a restarted
+# scrape never ingests an archive twice. A batch that is downloaded again (e.g. after a placeholder) has a different
+# checksum and is ingested again.
+def create_ingest_table(conn):
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS INGESTED_ARCHIVES(
+        FILENAME TEXT PRIMARY KEY,
+        CHECKSUM TEXT NOT NULL,
+        ARTICLES INTEGER NOT NULL,
+        INGESTED TEXT NOT NULL)
+        """)
+
+
+# Random token written once when a database is created. Files derived from its articles, such as the document-term
+# matrix of tone_index.py, record it and are rebuilt when it changes, since a rebuilt database numbers its articles
+# from 1 again and IDs alone would match the old rows.
+def create_identity_table(conn):
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS DATABASE_IDENTITY(TOKEN TEXT NOT NULL)")
+        if not conn.execute("SELECT 1 FROM DATABASE_IDENTITY").fetchall():
+            conn.execute("INSERT INTO DATABASE_IDENTITY VALUES (?)", [uuid.uuid4().hex])
+
+
+def database_identity(conn):
+    return conn.execute("SELECT TOKEN FROM DATABASE_IDENTITY").fetchone()[0]
+
+
+# Filename to checksum of every archive recorded in INGESTED_ARCHIVES
+def ingested_archives(db_path=dbase_loc):
+    if not os.path.exists(db_path):
+        return {}
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        try:
+            return dict(conn.execute("SELECT FILENAME, CHECKSUM FROM INGESTED_ARCHIVES").fetchall())
+        except sqlite3.OperationalError:  # table not created yet
+            return {}
+
+
+def downloaded_archives():
+    return sorted(f for f in raw_path.rglob('*') if is_archive(f))
+
+
+# SQL condition keeping articles that match an FTS5 query over title and body, e.g. '"hydraulic fracturing" OR opec*'.
+# Terms are case insensitive, quotes make a phrase and a trailing * a prefix, AND, OR, NOT and brackets combine them.
+def term_filter(query, id_column='ID'):
+    query = query.replace("'", "''")
+    return f"{id_column} IN (SELECT rowid FROM ARTICLES_FTS WHERE ARTICLES_FTS MATCH '{query}')"
+
+
+# Short file name friendly label for a term filter, used to keep sub-index outputs apart from the full index
+def term_filter_label(query):
+    return re.sub(r'\W+', '_', query).strip('_').lower()[:40]
+
+
+# Insert a batch of (title, date, publisher, author, body, word_count) records in one transaction, returns the number
+# of records rejected as duplicates. The cursor's rowcount only counts rows inserted into ARTICLES, unlike
+# total_changes which also counts the rows written by the count and full-text triggers. Bodies are packed by codec
+# when one is given. archives are IngestedArchive rows recorded in the same transaction, so an archive is only marked
+# as ingested once its last records are committed.
+def insert_articles(conn, records, codec=None, archives=()):
+    if codec is not None:
+        records = codec.pack_records(records)
+    with conn:
+        cursor = conn.executemany("INSERT OR IGNORE INTO ARTICLES VALUES (NULL, ?, ?, ?, ?, ?, ?)", records)
+        duplicates = len(records) - cursor.rowcount if records else 0
+        conn.executemany("INSERT OR REPLACE INTO INGESTED_ARCHIVES VALUES (?, ?, ?, datetime('now'))", archives)
+    return duplicates
+
+
+# Worker side of the parsing stage. Returns a (name, record, error) result for every document in lines, where error is
+# a list of (field, message) pairs. Parse failures are returned instead of raised so one unexpected layout does not stop
+# the run, they are collected into the error report at the end. Documents after the first in a file are named
+# <name>#<n>.
+def parse_content(name, lines):
+    results = []
+    for n, document in enumerate(split_documents(lines), start=1):
+        document_name = name if n == 1 else f'{name}#{n:d}'
+        try:
+            record = parse_article(document)
+        except ParseError as ex:
+            for field in ex.failures:
+                parse_metrics.count(f'parse_errors.{field}')
+            parse_metrics.count('parse_errors')
+            results.append((document_name, None, list(ex.failures.items())))
+            continue
+        parse_metrics.count('articles_parsed')
+        results.append((document_name, record, None))
+    if not results:
+        parse_metrics.count('parse_errors')
+        results.append((name, None, [('file', 'no articles found')]))
+    return results
+
+
+# Lines of a file read through a memory map, so large exports are never held in memory as a whole
+def mapped_lines(f, encoding=TXT_ENCODING):
+    if os.fstat(f.fileno()).st_size == 0:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in iter(mm.readline, b''):
+            yield line.decode(encoding, errors='replace').rstrip('\r\n')
+
+
+def parse_file(filepath):
+    try:
+        with open(filepath, 'rb') as f:
+            results = parse_content(str(filepath), mapped_lines(f))
+    except (OSError, ValueError) as ex:
+        parse_metrics.count('parse_errors')
+        return [(str(filepath), None, [('file', f'{type(ex).__name__}: {ex}')])]
+    parse_metrics.count('files_read')
+    return results
+
+
+# Stream the articles out of a downloaded archive without extracting it. RTF members are converted to the same plain
+# text layout DocFrac produces, placeholders are skipped (find_incomplete_downloads reports them).
+def parse_archive(filepath):
+    results = []
+    try:
+        with zipfile.ZipFile(filepath) as archive:
+            for info in archive.infolist():
+                name = f'{filepath}/{info.filename}'
+                if info.is_dir() or is_placeholder(info.filename):
+                    continue
+                suffix = Path(info.filename).suffix.lower()
+                if suffix not in ('.rtf', '.txt'):
+                    continue
+                with parse_metrics.stage('io.read'):
+                    data = archive.read(info)
+                if suffix == '.rtf':
+                    with parse_metrics.stage('parse.rtf'):
+                        content = rtf_to_text(data)
+                else:
+                    content = data.decode('utf-8', errors='replace')
+                parse_metrics.count('files_read')
+                results.extend(parse_content(name, content.splitlines()))
+        parse_metrics.count('archives_read')
+    except (zipfile.BadZipFile, OSError, EOFError, zlib.error, NotImplementedError) as ex:  # damaged or unsupported
+        parse_metrics.count('parse_errors')
+        results.append((str(filepath), None, [('file', f'{type(ex).__name__}: {ex}')]))
+    return results
+
+
+# Pool task wrapping a parse function, returns the results together with the metrics of this task for the main process
+def timed_parse(parse, source):
+    parse_metrics.reset()
+    results = parse(source)
+    return results, parse_metrics.snapshot()
+
+
+# Queued to the writer after the last record of an archive, see insert_articles
+IngestedArchive = collections.namedtuple('IngestedArchive', ['filename', 'checksum', 'articles'])
+
+
+# Single writer for the database. Records are queued by the parsing stage and inserted in BATCH_SIZE transactions from
+# this thread, which owns the only connection to articles.db. With commit_archives a batch is also committed early when
+# an IngestedArchive is pending and nothing else is queued, so archives arriving one at a time from the scraper are
+# stored right away instead of once BATCH_SIZE articles have come in.
+class ArticleWriter(threading.Thread):
+    def __init__(self, db_path=dbase_loc, batch_size=BATCH_SIZE, max_queued=4 * BATCH_SIZE,
+                 compression=BODY_COMPRESSION, commit_archives=False):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.compression = compression
+        self.commit_archives = commit_archives
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.duplicate_count = 0
+        self.record_count = 0
+        self.error = None
+        self.metrics = Metrics('writer')  # only touched by this thread, merged by process_files once it has finished
+
+    def put(self, record):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        record = True
+        try:
+            with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+                check_parser_version(conn, self.db_path)
+                codec = create_tables(conn, self.compression)
+                batch = []
+                archives = []
+                while record is not None:
+                    record = self.queue.get()
+                    if isinstance(record, IngestedArchive):
+                        archives.append(record)
+                    elif record is not None:
+                        batch.append(record)
+                    if (batch or archives) and (record is None or len(batch) >= self.batch_size or (
+                            self.commit_archives and archives and self.queue.empty())):
+                        with self.metrics.stage('sqlite.insert'):
+                            duplicates = insert_articles(conn, batch, codec, archives)
+                        self.duplicate_count += duplicates
+                        self.record_count += len(batch)
+                        self.metrics.count('duplicates_rejected', duplicates)
+                        self.metrics.count('articles_inserted', len(batch) - duplicates)
+                        self.metrics.count('archives_ingested', len(archives))
+                        batch = []
+                        archives = []
+        except Exception as ex:  # e.g. sqlite3.Error, or ImportError and ValueError from an unusable BODY_COMPRESSION
+            self.error = ex
+            # keep draining so the parsing stage is never blocked on a full queue
+            while record is not None:
+                record = self.queue.get()
+
+
+def write_error_report(errors, path=error_report_loc):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'field', 'error'])
+        writer.writerows(errors)
+
+
+# Parse every source (article file or archive) with a pool of PARSE_WORKERS processes and stream the records to the
+# writer thread. imap keeps the input order, so which copy of a duplicate is kept does not depend on the number of
+# workers. Stage times and counters of the workers and the writer are merged into metrics. Sources with a checksum in
+# checksums are recorded in INGESTED_ARCHIVES once their articles are stored, unless the file itself could not be read.
+def process_files(sources, parse=parse_file, workers=PARSE_WORKERS, chunk_size=PARSE_CHUNK_SIZE, metrics=None,
+                  checksums=None):
+    if metrics is None:
+        metrics = Metrics('process')
+    writer = ArticleWriter()
+    writer.start()
+    errors = []
+
+    task = functools.partial(timed_parse, parse)
+    if workers <= 1:
+        results = map(task, sources)
+    else:
+        pool = multiprocessing.Pool(processes=workers)
+        results = pool.imap(task, sources, chunksize=chunk_size)
+
+    try:
+        for idx, (source_results, snapshot) in enumerate(results, start=1):
+            metrics.merge(snapshot)
+            with metrics.stage('queue.put'):
+                for name, record, error in source_results:
+                    if error is None:
+                        writer.put(record)
+                    else:
+                        errors.extend((name, field, message) for field, message in error)
+                source = sources[idx - 1]
+                if checksums is not None and source in checksums and not unreadable(source_results):
+                    writer.put(IngestedArchive(Path(source).name, checksums[source], articles(source_results)))
+            metrics.progress(idx, len(sources), prefix='Processing files: ', counter='articles_parsed',
+                             unit='articles')
+    finally:
+        if workers > 1:
+            pool.close()
+            pool.join()
+        writer.close()
+        metrics.merge(writer.metrics.snapshot())
+
+    return writer.duplicate_count, writer.record_count, errors
+
+
+def articles(results):
+    return sum(1 for _, record, _ in results if record is not None)
+
+
+# True when the parse results of a source hold an error for the file itself, e.g. an archive that could not be opened
+def unreadable(results):
+    return any(field == 'file' for _, record, error in results if error for field, _ in error)
+
+
+# Checksum of every archive not yet recorded in INGESTED_ARCHIVES with the same checksum
+def pending_archives(paths, ingested):
+    checksums = {}
+    for path in paths:
+        checksum = file_checksum(path)
+        if ingested.get(Path(path).name) != checksum:
+            checksums[path] = checksum
+    return checksums
+
+
+# Background consumer of the overlapped scrape and ingest mode (scrape.py with INGEST_WHILE_SCRAPING). The scraper
+# submits every archive once it has been downloaded and checked, this thread parses it and streams its articles to an
+# ArticleWriter, so the database fills up while downloading goes on. The queue holds at most INGEST_QUEUE_SIZE
+# archives, a scraper that gets that far ahead waits in submit. Archives already on disk when it starts (downloaded
+# before a restart, or by urls that are complete) are worked through whenever no new archive is waiting. Archives
+# recorded in INGESTED_ARCHIVES with the same checksum are skipped.
+class ArchiveIngester(threading.Thread):
+    def __init__(self, backlog=(), db_path=dbase_loc, max_queued=INGEST_QUEUE_SIZE, compression=BODY_COMPRESSION):
+        super().__init__(daemon=True)
+        self.backlog = collections.deque(backlog)
+        self.db_path = db_path
+        self.compression = compression
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.ingested = {}
+        self.writer = None
+        self.errors = []
+        self.archive_count = 0
+        self.error = None
+        self.metrics = Metrics('ingest')
+
+    # Called from the scraper threads, never raises so a failed ingester cannot stop the downloads. After a fatal error
+    # the ingester keeps taking archives off the queue and drops them, the next run of process.py picks them up.
+    def submit(self, path):
+        if self.is_alive():
+            self.queue.put(Path(path))
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+        self.join()
+        duplicate_count = 0
+        if self.writer is not None:
+            self.metrics.merge(self.writer.metrics.snapshot())
+            duplicate_count = self.writer.duplicate_count
+        if self.errors:
+            write_error_report(self.errors)
+            print(f'{len({name for name, _, _ in self.errors}):d} articles could not be parsed, see {error_report_loc}')
+        print(f'Ingested {self.archive_count:d} archives while scraping, {duplicate_count:d} duplicates rejected.')
+        print(self.metrics.summary())
+        self.metrics.write(ingest_metrics_loc, source='ingest', archives=self.archive_count)
+        if self.error is not None:
+            raise self.error
+
+    # Parse one archive and queue its articles. An archive that cannot be read is recorded in the error report and
+    # skipped, only a failure of the writer stops the ingester.
+    def ingest(self, path):
+        try:
+            with self.metrics.stage('io.checksum'):
+                checksum = file_checksum(path)
+            if self.ingested.get(path.name) == checksum:
+                self.metrics.count('archives_skipped')
+                return
+            results, snapshot = timed_parse(parse_archive, path)
+        except Exception as ex:
+            self.metrics.count('archives_failed')
+            self.errors.append((str(path), 'file', f'{type(ex).__name__}: {ex}'))
+            print(f'[ingest] {path.name}: skipped <{type(ex).__name__}: {ex}>, left to process.py')
+            return
+        self.metrics.merge(snapshot)
+        with self.metrics.stage('queue.put'):
+            for name, record, error in results:
+                if error is None:
+                    self.writer.put(record)
+                else:
+                    self.errors.extend((name, field, message) for field, message in error)
+            if not unreadable(results):
+                self.writer.put(IngestedArchive(path.name, checksum, articles(results)))
+        self.ingested[path.name] = checksum
+        self.archive_count += 1
+        print(f'[ingest] {path.name}: {articles(results):d} articles')
+
+    def run(self):
+        try:
+            self.ingested = ingested_archives(self.db_path)
+            self.writer = ArticleWriter(self.db_path, compression=self.compression, commit_archives=True)
+            self.writer.start()
+        except Exception as ex:
+            print(f'[ingest] could not start <{ex}>, the archives are left to process.py')
+            self.error = ex
+        closed = False
+        while self.backlog or not closed:
+            try:  # archives from the scraper first, the backlog only when none is waiting
+                path = self.queue.get(block=not (self.backlog or closed))
+            except queue.Empty:
+                path = self.backlog.popleft()
+            if path is None:
+                closed = True
+            elif self.error is None:
+                try:
+                    self.ingest(path)
+                except Exception as ex:
+                    print(f'[ingest] stopped at {path.name} <{ex}>, the remaining archives are left to process.py')
+                    self.error = ex
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception as ex:
+                self.error = self.error or ex
+
+
+# Parse every downloaded source into the database, returns the path of the database
+def main(source=SOURCE):
+    metrics = Metrics('process')
+    with profiled(PROFILE, profile_loc):
+        with metrics.stage('find_incomplete_downloads'):
+            incomplete_uidx = find_incomplete_downloads()
+        metrics.count('incomplete_urls', len(incomplete_uidx))
 
-            # Insert data if it is not a duplicate
-            if not is_duplicate:
-                sql = """INSERT INTO ARTICLES VALUES (NULL, ?, ?, ?, ?, ?, ?)"""
-                res = execute_statement(sql, data=[title, date, publisher, author, body, word_count])
+        checksums = None
+        if source == 'zip':
+            archives = downloaded_archives()
+            with metrics.stage('io.checksum'):
+                checksums = pending_archives(archives, ingested_archives())
+            sources = list(checksums)
+            metrics.count('archives_skipped', len(archives) - len(sources))
+            print(f'{len(archives) - len(sources):d} of {len(archives):d} archives already ingested')
+            parse = parse_archive
+        else:
+            sources = sorted(data_path.rglob('*.txt'))
+            parse = parse_file
+        duplicate_count, record_count, parse_errors = process_files(sources, parse=parse, metrics=metrics,
+                                                                    checksums=checksums)
 
-            progress(idx, len(all_article_files), prefix='Processing files: ')
+    print(f"\nCompleted processing. Number of duplicates found {duplicate_count:d} "
+          f"[{100 * duplicate_count / max(record_count, 1):.1f}%].")
+    if parse_errors:
+        write_error_report(parse_errors)
+        print(f'{len({name for name, _, _ in parse_errors}):d} articles could not be parsed, see {error_report_loc}')
+    print(metrics.summary())
+    metrics.write(metrics_loc, source=source, workers=PARSE_WORKERS, sources=len(sources))
+    print(f'Metrics written to {metrics_loc}')
+    return dbase_loc
 
-    except (IndexError, AttributeError, TypeError) as ex:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        print(exc_type, exc_tb.tb_lineno, filepath.name)
-        print(header)
-        break
 
-print(f"\nCompleted processing. Number of duplicates found {duplicate_count:d} "
-      f"[{duplicate_count / len(all_article_files):.1f}%].")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""RTF to Plain Text
+
+A small RTF reader that turns the article files in Nexis Uni downloads into plain text with the same line layout that
+DocFrac produces: one line per paragraph, with empty paragraphs kept as blank lines. Formatting, fonts, colours,
+pictures and document metadata are dropped.
+"""
+import re
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# control word (with optional numeric parameter), control symbol, hex escape, group open/close or a run of plain text
+token_pattern = re.compile(r"\\([a-z]{1,32})(-?\d{1,10})? ?|\\'([0-9a-f]{2})|\\([^a-z])|([{}])|([^\\{}\r\n]+)|[\r\n]+",
+                           re.IGNORECASE)
+
+# destinations whose content is not part of the document text
+skip_destinations = {
+    'fonttbl', 'colortbl', 'stylesheet', 'info', 'pict', 'header', 'footer', 'headerl', 'headerr', 'headerf',
+    'footerl', 'footerr', 'footerf', 'listtable', 'listoverridetable', 'revtbl', 'rsidtbl', 'generator', 'xmlnstbl',
+    'themedata', 'colorschememapping', 'latentstyles', 'datastore', 'fldinst', 'object', 'filetbl', 'mmathPr',
+}
+
+special_words = {
+    'par': '\n', 'line': '\n', 'sect': '\n', 'page': '\n', 'row': '\n', 'cell': ' ', 'tab': '\t',
+    'emdash': '\u2014', 'endash': '\u2013', 'bullet': '\u2022', 'lquote': '\u2018', 'rquote': '\u2019',
+    'ldblquote': '\u201c', 'rdblquote': '\u201d', 'emspace': ' ', 'enspace': ' ', 'qmspace': ' ',
+}
+
+special_symbols = {'~': '\u00a0', '_': '\u2011', '-': '', '\\': '\\', '{': '{', '}': '}', '\n': '\n', '\r': '\n'}
+
+# halves of a UTF-16 surrogate pair, which \u writes characters outside the basic plane as
+surrogate_pattern = re.compile('[\ud800-\udfff]')
+
+
+def rtf_to_text(rtf, encoding='cp1252'):
+    if isinstance(rtf, bytes):
+        rtf = rtf.decode('latin-1')
+
+    out = []
+    stack = []
+    skip = False  # inside a destination that should be ignored
+    uc_skip = 1  # number of fallback characters following a \u escape
+    pending_skip = 0  # fallback characters still to be dropped
+    ignorable = False  # saw \* at the start of the current group
+    hex_bytes = bytearray()
+
+    def flush_hex():
+        if hex_bytes:
+            if not skip:
+                out.append(hex_bytes.decode(encoding, errors='replace'))
+            hex_bytes.clear()
+
+    for m in token_pattern.finditer(rtf):
+        word, param, hex_code, symbol, brace, text = m.groups()
+
+        if hex_code is not None:
+            if pending_skip > 0:
+                pending_skip -= 1
+            else:
+                hex_bytes.append(int(hex_code, 16))
+            continue
+        flush_hex()
+
+        if brace == '{':
+            stack.append((skip, uc_skip, ignorable))
+            ignorable = False
+        elif brace == '}':
+            if stack:
+                skip, uc_skip, ignorable = stack.pop()
+            pending_skip = 0
+        elif symbol is not None:
+            if symbol == '*':
+                ignorable = True
+            elif pending_skip > 0:
+                pending_skip -= 1
+            elif not skip and symbol in special_symbols:
+                out.append(special_symbols[symbol])
+        elif word is not None:
+            if ignorable or word in skip_destinations:
+                skip = True
+            elif word == 'uc':
+                uc_skip = int(param or 1)
+            elif word == 'u' and param is not None:  # a \u without a code is an unknown control word, ignored
+                if not skip:
+                    code = int(param) % 65536  # signed 16-bit, e.g. \u-3913
+                    out.append(chr(code))
+                pending_skip = uc_skip
+            elif not skip and word in special_words:
+                out.append(special_words[word])
+            ignorable = False
+        elif text is not None:
+            if pending_skip > 0:
+                dropped = min(pending_skip, len(text))
+                text = text[dropped:]
+                pending_skip -= dropped
+            if not skip:
+                out.append(text)
+    flush_hex()
+
+    text = ''.join(out)
+    if surrogate_pattern.search(text):
+        # characters outside the basic plane arrive as two \u surrogate halves, join them and replace any lone half
+        text = text.encode('utf-16-le', 'surrogatepass').decode('utf-16-le', 'replace')
+    return text
@@ -6,8 +6,12 @@ specified in the search_configuration.yaml file. This has been tested for data s
 download interval.
 """
 import os
+import json
 import yaml
 import time
+import hashlib
+import queue
+import threading
 import pandas as pd
 from pathlib import Path
 
@@ -18,6 +22,9 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.common.exceptions import WebDriverException
 
+from downloads import DownloadError, wait_for_download
+from manifest import ScrapeManifest, BATCH_PAGES, batch_first_page
+
 __author__ = 'Andre Bodo'
 __copyright__ = 'Copyright 2020, Andre Bodo'
 __credits__ = ['Andre Bodo']
@@ -29,68 +36,243 @@ __status__ = 'Development'
 
 # Control variables
 DOWNLOAD_TIMEOUT = 300
+CHECK_MEMBER_COUNT = True  # a downloaded batch must hold exactly the number of selected articles
 DRIVER_TIMEOUT = 60
 MAXIMUM_RETRIES = 20
+SCRAPE_WORKERS = 2  # browser sessions running at once
+URL_REQUEUES = 2  # times a failed url goes back on the queue
+REQUEUE_BACKOFF = 60  # seconds before the first requeue, doubled after every failure
+PLAN_WINDOWS = True  # split searches with too many results into shorter date windows
+PAGE_BUDGET = 100  # most result pages a single search window should have
+MIN_WINDOW_DAYS = 7  # windows are never split below this length
+PLAN_RETRIES = 5  # attempts at reading the page count of a window before planning gives up
+NO_RESULTS_TEXT = 'no documents found'  # shown in place of the result list by a search without results
+INGEST_WHILE_SCRAPING = False  # parse every finished archive into articles.db while the next ones are downloading
+LOGIN_URL = 'https://libproxy.wlu.ca/login?url=http://www.nexisuni.com'
 
 # Directories and filepaths needed
 base_path = Path(__file__).parent
-gecko_path = str(base_path) + '\\geckodriver.exe'
-download_path = str(base_path) + '\\data\\raw\\'
-Path(download_path).mkdir(parents=True, exist_ok=True)
+gecko_path = base_path / ('geckodriver.exe' if os.name == 'nt' else 'geckodriver')
+download_path = base_path / 'data' / 'raw'  # the folder process.py reads the archives from
+plan_loc = base_path / 'window_plan.json'
+credentials_loc = base_path / 'credentials_working.yaml'
+search_config_loc = base_path / 'search_config.yaml'
+url_data_loc = base_path / 'url_data.csv'
 
-# Load login credentials from file
-with open('credentials_working.yaml') as file:
-    credentials = yaml.load(file, Loader=yaml.FullLoader)
 
-# Build scraping urls
-with open('search_config.yaml') as file:
-    search_conf = yaml.load(file, Loader=yaml.FullLoader)
-url_list = []
-search_dates = pd.date_range(search_conf['start_date'], search_conf['end_date'], freq=search_conf['scraper_freq'])
-search_dates = [x.strftime('%Y-%m-%d') for x in search_dates]
-search_dates[0] = search_conf['start_date'].replace('/', '-')  # replace to ensure first date is respected.
-search_terms = ' or '.join([t for t in search_conf['terms']])
-search_sources = '&source='.join([s for s in search_conf['sources']])
-for i in range(len(search_dates) - 1):
+def load_yaml(path):
+    with open(path) as file:
+        return yaml.load(file, Loader=yaml.FullLoader)
+
+
+def build_url(search_conf, start_date, end_date):
+    search_terms = ' or '.join([t for t in search_conf['terms']])
+    search_sources = '&source='.join([s for s in search_conf['sources']])
     url = search_conf['base_url'] + f"?q={search_terms}" \
                                     f"&collection=news" \
                                     f"&qlang=bool" \
-                                    f"&startdate={search_dates[i]}" \
-                                    f"&enddate={search_dates[i + 1]}" \
+                                    f"&startdate={start_date}" \
+                                    f"&enddate={end_date}" \
                                     f"&source={search_sources}" \
                                     f"&context=1516831"
-    url_list.append(url.replace(' ', '+'))
-pd.DataFrame(data=url_list).to_csv('url_data.csv', index=True, header=False, mode='w')
+    return url.replace(' ', '+')
+
+
+# Search windows at the fixed scraper_freq from the search config
+def build_windows(search_conf):
+    search_dates = pd.date_range(search_conf['start_date'], search_conf['end_date'], freq=search_conf['scraper_freq'])
+    search_dates = [x.strftime('%Y-%m-%d') for x in search_dates]
+    search_dates[0] = search_conf['start_date'].replace('/', '-')  # replace to ensure first date is respected.
+    return [(search_dates[i], search_dates[i + 1]) for i in range(len(search_dates) - 1)]
+
+
+# Build scraping urls
+def build_urls(search_conf, windows=None):
+    if windows is None:
+        windows = build_windows(search_conf)
+    return [build_url(search_conf, start, end) for start, end in windows]
+
+
+# Halve a window (month -> half-month -> week with the default MIN_WINDOW_DAYS), None when it is already too short.
+# The halves do not overlap so splitting adds no duplicates.
+def split_window(start, end, min_days=MIN_WINDOW_DAYS):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    days = (end - start).days + 1
+    if days < 2 * min_days:
+        return None
+    mid = start + pd.Timedelta(days=days // 2 - 1)
+    return [(start.strftime('%Y-%m-%d'), mid.strftime('%Y-%m-%d')),
+            ((mid + pd.Timedelta(days=1)).strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))]
+
+
+# Split every window whose search returns more than page_budget result pages, count_pages(start, end) reads the page
+# count of a window. Returns the final windows in date order with their page counts.
+def plan_windows(windows, count_pages, page_budget=PAGE_BUDGET, min_days=MIN_WINDOW_DAYS):
+    plan = []
+    pending = list(reversed(windows))
+    while pending:
+        start, end = pending.pop()
+        pages = count_pages(start, end)
+        halves = split_window(start, end, min_days) if pages > page_budget else None
+        if halves:
+            pending.extend(reversed(halves))
+        else:
+            plan.append({'start': start, 'end': end, 'pages': pages})
+    return plan
+
+
+# A saved plan is only reused for the search config and budget it was made for. The window index is part of every
+# downloaded filename, so keeping the plan stable between runs is what lets a rerun find its earlier downloads.
+def plan_fingerprint(search_conf, page_budget=PAGE_BUDGET, min_days=MIN_WINDOW_DAYS):
+    conf = json.dumps(search_conf, sort_keys=True, default=str)
+    return hashlib.sha1(f'{conf};{page_budget};{min_days}'.encode()).hexdigest()
+
 
+def load_plan(search_conf, path=plan_loc):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        saved = json.load(f)
+    if saved.get('fingerprint') != plan_fingerprint(search_conf):
+        return None
+    return saved['windows']
 
-# Function to download one url
-def download_url(url, uidx):
-    # Setup webdriver
+
+def save_plan(search_conf, plan, path=plan_loc):
+    with open(path, 'w') as f:
+        json.dump({'fingerprint': plan_fingerprint(search_conf), 'windows': plan}, f, indent=1)
+
+
+# Downloads are named after their window index, so batches downloaded under another window layout would be adopted as
+# the wrong windows
+def has_downloads(path=download_path):
+    return any(Path(path).glob('idx_*_batch_*'))
+
+
+def new_firefox_driver(download_dir=download_path):
     profile = webdriver.FirefoxProfile()
     profile.set_preference('browser.download.folderList', 2)  # Don't use default dir
     profile.set_preference('browser.download.manager.showWhenStarting', False)
-    profile.set_preference('browser.download.dir', download_path)
+    profile.set_preference('browser.download.dir', str(Path(download_dir).resolve()))
     profile.set_preference('browser.helperApps.neverAsk.saveToDisk', 'application/x-zip-compressed')
-    driver = webdriver.Firefox(firefox_profile=profile, executable_path=gecko_path)
-    wait = WebDriverWait(driver, DRIVER_TIMEOUT)
+    return webdriver.Firefox(firefox_profile=profile, executable_path=str(gecko_path))
+
+
+class LoginError(WebDriverException):
+    pass
 
-    # Login
-    driver.maximize_window()
-    driver.get('https://libproxy.wlu.ca/login?url=http://www.nexisuni.com')
-    try:
-        e = wait.until(EC.presence_of_element_located((By.ID, 'username')))
-    except WebDriverException as e:
-        print('unable to login, quitting')
-        driver.quit()
-        quit()
 
-    e.send_keys(credentials['username'])
-    e = driver.find_element_by_id('password')
-    e.send_keys(credentials['password'])
-    e.send_keys(Keys.ENTER)
-    time.sleep(5)  # waits for login
+class BrowserSession:
+    """A logged in browser that is reused for every url.
 
-    driver.get(url)
+    The driver is started and logged in through the SSO page on first use. Each page load checks whether the proxy sent
+    us back to the login page, which is how an expired session shows up, and only then logs in again. driver_factory
+    and login_url can point at a stand-in driver or a local test site.
+    """
+
+    def __init__(self, credentials, login_url=LOGIN_URL, driver_factory=new_firefox_driver, timeout=DRIVER_TIMEOUT,
+                 download_dir=download_path):
+        self.credentials = credentials
+        self.login_url = login_url
+        self.driver_factory = driver_factory
+        self.download_dir = download_dir
+        self.timeout = timeout
+        self.driver = None
+        self.wait = None
+        self.logins = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.quit()
+
+    def start(self):
+        if self.driver is None:
+            Path(self.download_dir).mkdir(parents=True, exist_ok=True)
+            self.driver = self.driver_factory(self.download_dir)
+            self.wait = WebDriverWait(self.driver, self.timeout)
+            self.driver.maximize_window()
+            self.login()
+
+    def quit(self):
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
+
+    def on_login_page(self):
+        return len(self.driver.find_elements_by_id('username')) > 0
+
+    def login(self):
+        try:
+            self.driver.get(self.login_url)
+            e = self.wait.until(EC.presence_of_element_located((By.ID, 'username')))
+            e.send_keys(self.credentials['username'])
+            e = self.driver.find_element_by_id('password')
+            e.send_keys(self.credentials['password'])
+            e.send_keys(Keys.ENTER)
+
+            # wait for the login form to be replaced by the landing page instead of sleeping a fixed time
+            self.wait.until(EC.staleness_of(e))
+            self.wait.until(lambda driver: len(driver.find_elements_by_id('username')) == 0)
+        except WebDriverException as ex:
+            raise LoginError(f'unable to login: {str(ex).strip()}')
+        self.logins += 1
+
+    def get(self, url):
+        self.start()
+        self.driver.get(url)
+        if self.on_login_page():  # session expired
+            self.login()
+            self.driver.get(url)
+
+
+# Number of result pages for a search, read from the pagination bar (a single page has no page links), 0 when the
+# search has no results. A page that fails to load is retried like a download, up to PLAN_RETRIES times.
+def count_result_pages(session, url, retries=PLAN_RETRIES):
+    select_all = "//input[@data-action='selectall']"
+    no_results = "//*[contains(translate(normalize-space(text()), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', " \
+                 f"'abcdefghijklmnopqrstuvwxyz'), '{NO_RESULTS_TEXT}')]"
+    for attempt in range(retries):
+        try:
+            session.get(url)
+            session.wait.until(EC.invisibility_of_element_located((By.XPATH, "//div[@class='box']")))
+            session.wait.until(lambda driver: driver.find_elements_by_xpath(select_all) or
+                               driver.find_elements_by_xpath(no_results))
+            if not session.driver.find_elements_by_xpath(select_all):
+                return 0
+            links = session.driver.find_elements_by_xpath("//nav[@class='pagination']/ol/li/a")
+            return max([int(e.text) for e in links if e.text.strip().isdigit()], default=1)
+        except WebDriverException as ex:
+            if attempt == retries - 1:
+                raise
+            print(f'[plan] <{str(ex).strip()}>, retrying')
+            time.sleep(2.5)
+
+
+# Move through the pagination bar to a result page without selecting anything on the way, clicking the target page
+# when it is visible and otherwise the furthest page link shown
+def jump_to_page(driver, wait, target):
+    while True:
+        wait.until(EC.invisibility_of_element_located((By.XPATH, "//div[@class='box']")))
+        current = int(driver.find_element_by_xpath("//nav[@class='pagination']/ol/li[@class='current']/span").text)
+        if current == target:
+            return
+        links = {int(e.text): e for e in driver.find_elements_by_xpath("//nav[@class='pagination']/ol/li/a")
+                 if e.text.strip().isdigit()}
+        ahead = [p for p in links if current < p <= target]
+        if not ahead:
+            raise WebDriverException(f'could not navigate to page {target}')
+        driver.execute_script('arguments[0].click();', links[max(ahead)])
+
+
+# Function to download one url. With a manifest, batches recorded as complete are never revisited, a retry or restart
+# jumps straight to the first result page of the first incomplete batch. on_archive is called with the path of every
+# archive once it has been downloaded and checked.
+def download_url(session, url, uidx, manifest=None, on_archive=None):
+    session.get(url)
+    driver = session.driver
+    wait = session.wait
 
     for attempt in range(MAXIMUM_RETRIES):
         try:
@@ -107,6 +289,15 @@ def download_url(url, uidx):
             n_selected = 0
             page = 1
             batch = 1
+            if manifest is not None:
+                manifest.record_url(uidx, url, total_pages)
+                batch = manifest.first_incomplete_batch(uidx, total_pages)
+                if batch is None:
+                    return True
+                page = batch_first_page(batch)
+                if page > 1:
+                    jump_to_page(driver, wait, page)
+
             while page <= total_pages:
                 # select everything
                 wait.until(EC.invisibility_of_element_located((By.XPATH, "//div[@class='box']")))
@@ -118,10 +309,18 @@ def download_url(url, uidx):
                                                             str(n_selected)))
 
                 # download
-                if page % 10 == 0 or page == total_pages:
+                if page % BATCH_PAGES == 0 or page == total_pages:
                     filename = f'idx_{uidx}_batch_{batch:d}'
+                    final_path = str(download_path / (filename + '.ZIP'))
 
-                    if not Path(str(download_path) + filename + '.ZIP').is_file():  # if file D.N.E try downloading
+                    # the manifest decides whether a batch is done, files without a manifest record are adopted
+                    complete = manifest.batch_complete(uidx, batch) if manifest is not None else None
+                    if complete is None:
+                        complete = Path(final_path).is_file()
+                        if complete and manifest is not None:
+                            manifest.record_batch(uidx, batch, page, filename, final_path)
+
+                    if not complete:  # if file D.N.E try downloading
                         # click download button
                         wait.until(EC.invisibility_of_element_located((By.XPATH, "//div[@class='box']")))
                         wait.until(EC.element_to_be_clickable(
@@ -170,14 +369,15 @@ def download_url(url, uidx):
                         driver.execute_script('arguments[0].click();',
                                               driver.find_element_by_xpath("//button[@data-action='download']"))
 
-                        start_time = time.time()
-                        while True:
-                            if os.path.exists(str(download_path) + filename + '.ZIP'):
-                                if not os.path.exists(str(download_path) + filename + '.ZIP.part'):
-                                    break
-                            time.sleep(2)
-                            if time.time() - start_time > DOWNLOAD_TIMEOUT:
-                                raise WebDriverException('download timeout')
+                        # wait for the archive and check it holds every selected article before moving it out of
+                        # the session's own download directory
+                        expected = n_selected if CHECK_MEMBER_COUNT else None
+                        archive = wait_for_download(str(session.download_dir), filename, DOWNLOAD_TIMEOUT, expected)
+                        os.replace(archive, final_path)
+                        if manifest is not None:
+                            manifest.record_batch(uidx, batch, page, filename, final_path)
+                        if on_archive is not None:
+                            on_archive(final_path)
                         n_selected = 0
                         batch += 1
 
@@ -191,7 +391,6 @@ def download_url(url, uidx):
                         batch += 1
 
                 if page == total_pages:
-                    driver.quit()
                     return True
 
                 # navigate to next page
@@ -206,7 +405,7 @@ def download_url(url, uidx):
                     page += 1
                 else:
                     raise WebDriverException('did not navigate to next page')
-        except (WebDriverException, ValueError, TypeError) as ex:
+        except (WebDriverException, DownloadError, ValueError, TypeError) as ex:
             # make sure nothing is selected, this can occur if there is an exception and part of page is selected
             try:
                 wait.until(EC.invisibility_of_element_located((By.XPATH, "//div[@class='box']")))
@@ -222,31 +421,168 @@ def download_url(url, uidx):
             except WebDriverException as wex_inner:
                 pass
             print(f'[{uidx}] <{str(ex).strip()}>')
-            driver.get(url)
+            session.get(url)
+            driver = session.driver
             time.sleep(2.5)
         else:  # If there were no exceptions this block gets executed
-            driver.quit()
             return True
     else:
-        driver.quit()
         print(f'[{uidx}] max retry failed: aborting url')
         return False
 
 
-failed_urls = []
-failed_url_idx = []
-uidx = 0
-while uidx < len(url_list):
-    url = url_list[uidx]
-    print(f'processing: [{uidx}] of [{len(url_list) - 1}]: ')
-    res = download_url(url, uidx)
-    if not res:
-        failed_urls = failed_urls.append(url)
-        failed_url_idx = failed_url_idx.append(uidx)
-        print('...failed.')
-    else:
-        print('...success.')
-    uidx += 1
-print('Failed urls:')
-print([str(f) + '\n' for f in failed_urls])
-print(failed_url_idx)
\ No newline at end of file
+# Runs several browser sessions at once against a shared queue of (uidx, url) jobs. Each worker downloads into its own
+# directory so partially downloaded files with the same name can never collide, completed archives are moved into
+# the shared download directory. A url that fails all of its attempts in download_url is put back on the queue with
+# an exponential backoff, up to URL_REQUEUES times, before it is reported as failed.
+class ScrapeScheduler:
+    def __init__(self, jobs, session_factory, n_workers=SCRAPE_WORKERS, download=download_url,
+                 max_requeues=URL_REQUEUES, backoff=REQUEUE_BACKOFF):
+        self.session_factory = session_factory
+        self.n_workers = n_workers
+        self.download = download
+        self.max_requeues = max_requeues
+        self.backoff = backoff
+        self.jobs = queue.PriorityQueue()  # (not before time, uidx, url, attempt)
+        for uidx, url in jobs:
+            self.jobs.put((0.0, uidx, url, 0))
+        self.remaining = len(jobs)
+        self.succeeded = []
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def finish(self, uidx, url, attempt, success):
+        with self.lock:
+            if success:
+                self.succeeded.append(uidx)
+                self.remaining -= 1
+                print(f'[{uidx}] ...success.')
+            elif attempt < self.max_requeues:
+                delay = self.backoff * 2 ** attempt
+                self.jobs.put((time.time() + delay, uidx, url, attempt + 1))
+                print(f'[{uidx}] ...failed, retrying in {delay:.0f}s.')
+            else:
+                self.failed[uidx] = url
+                self.remaining -= 1
+                print(f'[{uidx}] ...failed.')
+
+    def worker(self, n):
+        with self.session_factory(n) as session:
+            while True:
+                with self.lock:
+                    if self.remaining == 0:
+                        return
+                try:
+                    job = self.jobs.get(timeout=1)
+                except queue.Empty:
+                    continue
+                not_before, uidx, url, attempt = job
+                if not_before > time.time():  # still backing off, let another job go first
+                    self.jobs.put(job)
+                    time.sleep(min(not_before - time.time(), 1))
+                    continue
+
+                print(f'[worker {n}] processing: [{uidx}]')
+                # every job taken off the queue is either put back or finished, otherwise remaining never reaches 0
+                # and the other workers wait for it forever
+                success = False
+                requeued = False
+                try:
+                    success = self.download(session, url, uidx)
+                except LoginError as ex:
+                    self.jobs.put(job)
+                    requeued = True
+                    print(f'[worker {n}] {str(ex).strip()}, stopping worker')
+                    return
+                except WebDriverException as ex:  # the browser itself failed, start a fresh one for the next job
+                    print(f'[{uidx}] <{str(ex).strip()}>')
+                    session.quit()
+                except Exception as ex:  # e.g. OSError moving the archive or sqlite3.Error from the manifest
+                    print(f'[{uidx}] <{type(ex).__name__}: {str(ex).strip()}>')
+                finally:
+                    if not requeued:
+                        self.finish(uidx, url, attempt, success)
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker, args=(n,), daemon=True) for n in range(self.n_workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # anything still queued was left behind by workers that could not log in
+        while not self.jobs.empty():
+            _, uidx, url, _ = self.jobs.get()
+            self.failed[uidx] = url
+        return sorted(self.failed.items())
+
+
+# Download every search url not yet complete in the manifest, returns the (uidx, url) pairs that failed. With ingest
+# the archives are parsed into articles.db by a process.ArchiveIngester as they arrive, starting with any already
+# downloaded that are not in the database yet.
+def main(ingest=INGEST_WHILE_SCRAPING):
+    download_path.mkdir(parents=True, exist_ok=True)
+
+    # Load login credentials from file
+    credentials = load_yaml(credentials_loc)
+
+    search_conf = load_yaml(search_config_loc)
+
+    def session_factory(n):
+        return BrowserSession(credentials, login_url=search_conf.get('login_url', LOGIN_URL),
+                              download_dir=download_path / f'worker_{n}')
+
+    # Split oversized searches before downloading anything, or reuse the plan from an earlier run. Existing downloads
+    # are only resumed under the layout they were made with.
+    windows = build_windows(search_conf)
+    empty = set()
+    if PLAN_WINDOWS:
+        plan = load_plan(search_conf)
+        if plan is None:
+            if has_downloads():
+                raise SystemExit(f'{download_path} holds downloads made without the current window plan, their indices '
+                                 f'would point at other windows. Move them elsewhere to plan a fresh scrape, or set '
+                                 f'PLAN_WINDOWS to False to resume them with the fixed scraper_freq windows.')
+            with session_factory('plan') as session:
+                plan = plan_windows(windows, lambda start, end: count_result_pages(
+                    session, build_url(search_conf, start, end)))
+            save_plan(search_conf, plan)
+            print(f'Planned {len(plan):d} search windows from {len(windows):d}, saved to {plan_loc}')
+        windows = [(w['start'], w['end']) for w in plan]
+        empty = {uidx for uidx, w in enumerate(plan) if w['pages'] == 0}
+    elif os.path.exists(plan_loc) and has_downloads():
+        raise SystemExit(f'{download_path} holds downloads made with the window plan in {plan_loc}, set PLAN_WINDOWS '
+                         f'to True to resume them or move both elsewhere to scrape with fixed windows.')
+    url_list = build_urls(search_conf, windows)
+    pd.DataFrame(data=url_list).to_csv(url_data_loc, index=True, header=False, mode='w')
+
+    ingester = None
+    if ingest:
+        import process
+        ingester = process.ArchiveIngester(backlog=process.downloaded_archives())
+        ingester.start()
+
+    # urls the manifest already has every batch of are not opened at all
+    try:
+        with ScrapeManifest() as manifest:
+            jobs = [(uidx, url) for uidx, url in enumerate(url_list)
+                    if uidx not in empty and not manifest.url_complete(uidx, url)]
+            print(f'{len(url_list) - len(jobs):d} of {len(url_list):d} urls already complete or without results')
+            on_archive = ingester.submit if ingester is not None else None
+            scheduler = ScrapeScheduler(jobs, session_factory, download=lambda session, url, uidx: download_url(
+                session, url, uidx, manifest, on_archive))
+            failed = scheduler.run()
+    finally:
+        if ingester is not None:
+            ingester.close()
+    failed_url_idx = [uidx for uidx, _ in failed]
+    failed_urls = [url for _, url in failed]
+
+    print('Failed urls:')
+    print([str(f) + '\n' for f in failed_urls])
+    print(failed_url_idx)
+    return failed
+
+
+if __name__ == '__main__':
+    main()
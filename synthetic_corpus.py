@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""Synthetic Nexis Uni Corpus Generator
+
+A script to write made up news articles in the Nexis Uni download layout that process.py parses, so the pipeline can be
+tested and benchmarked without the licensed corpus. Articles are grouped into batches like the scraper's downloads and
+written either as DocFrac style .txt files or as .ZIP archives of .RTF files. The corpus includes the awkward cases
+seen in real downloads: byline variants, missing bylines, "Correction Appended" headers, exact and lightly edited
+duplicates and delivery notification placeholders in place of a batch.
+"""
+import sys
+import random
+import zipfile
+from datetime import date, timedelta
+
+from pathlib import Path
+
+from metrics import Metrics
+
+__author__ = 'Andre Bodo'
+__copyright__ = 'Copyright 2020, Andre Bodo'
+__credits__ = ['Andre Bodo']
+__license__ = 'MIT'
+__version__ = ''
+__maintainer__ = 'Andre Bodo'
+__email__ = 'bodo1184@mylaurier.ca'
+__status__ = 'Prototype'
+
+# Control variables
+N_ARTICLES = 10000
+ARTICLES_PER_BATCH = 100  # the scraper selects 10 pages of 10 results into each download
+FORMAT = 'txt'  # 'txt' for extracted DocFrac output, 'zip' for archives of RTF files as downloaded
+DUPLICATE_RATE = 0.05  # share of articles that repeat an earlier one word for word
+NEAR_DUPLICATE_RATE = 0.03  # share of articles that repeat an earlier one with a few words changed
+CORRECTION_RATE = 0.02
+NO_BYLINE_RATE = 0.3
+PLACEHOLDER_RATE = 0.01  # share of batches delivered as a notification placeholder
+SEED = 1
+
+# Directories and file paths needed
+base_path = Path(__file__).parent
+output_path = base_path / 'data' / 'synthetic'
+
+publishers = ['The Globe and Mail', 'Financial Post', 'The Wall Street Journal', 'Reuters News', 'Calgary Herald',
+              'The Houston Chronicle', 'Platts Oilgram News', 'Oil Daily']
+sections = ['BUSINESS; Pg. B1', 'NEWS; Pg. A4', 'ENERGY', 'MARKETS; Pg. 12', 'Section B; Column 3; Business Desk']
+first_names = ['John', 'Jane', 'Carlos', 'Wei', 'Priya', 'Ahmed', 'Olga', 'Sam', 'Kenji', 'Fatima']
+last_names = ['Smith', 'Tremblay', 'Garcia', 'Chen', 'Patel', 'Hassan', 'Ivanova', 'Brown', 'Sato', 'Okafor']
+title_words = ['Oil', 'Crude', 'OPEC', 'Prices', 'Output', 'Shale', 'Pipeline', 'Supply', 'Demand', 'Futures',
+               'Refiners', 'Drillers', 'Rally', 'Slump', 'Cuts', 'Surge', 'Outlook', 'Sands', 'Exports', 'Glut']
+# Mix of neutral text and words carrying positive or negative tone in general purpose dictionaries
+body_words = [
+    'the', 'oil', 'price', 'of', 'crude', 'barrel', 'market', 'and', 'to', 'in', 'production', 'supply', 'demand',
+    'said', 'analysts', 'week', 'company', 'investors', 'energy', 'a', 'on', 'for', 'with', 'billion', 'million',
+    'gain', 'rise', 'strong', 'growth', 'recovery', 'improve', 'benefit', 'confident', 'success', 'stable', 'profit',
+    'loss', 'fall', 'weak', 'decline', 'risk', 'concern', 'crisis', 'fear', 'volatile', 'uncertain', 'threat',
+    'pipeline', 'refinery', 'drilling', 'exports', 'inventories', 'futures', 'traders', 'government', 'sanctions',
+    'output', 'quota', 'cartel', 'shale', 'sands', 'hydraulic', 'fracturing', 'gasoline', 'diesel', 'storage',
+]
+
+
+def random_name(rng):
+    return f'{rng.choice(first_names)} {rng.choice(last_names)}'
+
+
+# Byline formats seen in downloads, including a missing byline
+def random_byline(rng):
+    if rng.random() < NO_BYLINE_RATE:
+        return None
+    style = rng.randrange(5)
+    if style == 0:
+        return f'Byline: {random_name(rng)}'
+    if style == 1:
+        return f'BYLINE: {random_name(rng).upper()}'
+    if style == 2:
+        return f'Byline: {random_name(rng)} and {random_name(rng)}'
+    if style == 3:
+        return f'Byline: By {random_name(rng)}, Staff Writer'
+    return f'Byline: {random_name(rng)}; Reuters'
+
+
+def random_sentence(rng):
+    words = [rng.choice(body_words) for _ in range(rng.randint(8, 25))]
+    if rng.random() < 0.3:
+        words.insert(rng.randrange(len(words)), f'${rng.randint(1, 150)}.{rng.randint(0, 99):02d}')
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + '.'
+
+
+def random_body(rng):
+    paragraphs = [' '.join(random_sentence(rng) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(2, 8))]
+    return '\n\n'.join(paragraphs)
+
+
+# One article as a dict of the fields that make up the layout
+def random_article(rng, start=date(2007, 5, 10), days=5000):
+    published = start + timedelta(days=rng.randrange(days))
+    return {
+        'title': ' '.join(rng.choice(title_words) for _ in range(rng.randint(3, 8))),
+        'publisher': rng.choice(publishers),
+        'date': published,
+        'correction': rng.random() < CORRECTION_RATE,
+        'section': rng.choice(sections),
+        'byline': random_byline(rng),
+        'body': random_body(rng),
+    }
+
+
+# Copy of an article with a few words of the body replaced, as a wire story rewritten by another paper
+def edit_article(rng, article):
+    words = article['body'].split(' ')
+    for _ in range(max(1, len(words) // 50)):
+        words[rng.randrange(len(words))] = rng.choice(body_words)
+    return dict(article, body=' '.join(words), publisher=rng.choice(publishers))
+
+
+# Plain text in the layout DocFrac produces from a Nexis Uni RTF
+def article_text(article):
+    published = article['date']
+    lines = [article['title'], article['publisher'], f"{published:%B} {published.day}, {published:%Y %A}"]
+    if article['correction']:
+        lines += ['', 'Correction Appended']
+    lines += [f"Copyright {published:%Y} {article['publisher']}", 'All Rights Reserved', '',
+              f"Section: {article['section']}", f"Length: {len(article['body'].split())} words"]
+    if article['byline'] is not None:
+        lines.append(article['byline'])
+    lines += ['', '', '', '', article['body'], '', f"Load-Date: {published:%B} {published.day}, {published:%Y}",
+              '', 'Language: ENGLISH', '', 'Publication-Type: Newspaper', '', 'Classification', '',
+              'Subject: OIL & GAS PRICES (90%)', '', 'End of Document', '']
+    return '\n'.join(lines)
+
+
+def rtf_escape(text):
+    out = []
+    for c in text:
+        if c in '\\{}':
+            out.append('\\' + c)
+        elif ord(c) > 127:
+            out.append(f'\\u{ord(c) if ord(c) < 32768 else ord(c) - 65536}?')
+        else:
+            out.append(c)
+    return ''.join(out)
+
+
+def article_rtf(article):
+    paragraphs = ''.join(f'\\pard {rtf_escape(line)}\\par\n' for line in article_text(article).split('\n'))
+    return '{\\rtf1\\ansi\\deff0{\\fonttbl{\\f0 Times New Roman;}}\n' + paragraphs + '}'
+
+
+def placeholder_text(uidx, batch):
+    return (f'Your delivery of idx_{uidx}_batch_{batch} could not be completed as requested. The documents will be '
+            f'sent by email when they are ready.\n')
+
+
+# Draw the articles. Duplicates reuse an earlier article so they land in a later batch like repeated search results.
+def generate_articles(n_articles=N_ARTICLES, seed=SEED):
+    rng = random.Random(seed)
+    articles = []
+    for _ in range(n_articles):
+        r = rng.random()
+        if articles and r < DUPLICATE_RATE:
+            articles.append(rng.choice(articles))
+        elif articles and r < DUPLICATE_RATE + NEAR_DUPLICATE_RATE:
+            articles.append(edit_article(rng, rng.choice(articles)))
+        else:
+            articles.append(random_article(rng))
+    return articles
+
+
+# Write the corpus under path as idx_0_batch_<n> batches and return the number of articles and placeholders written
+def write_corpus(path=output_path, n_articles=N_ARTICLES, fmt=FORMAT, seed=SEED):
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed + 1)
+    metrics = Metrics('synthetic_corpus')
+    articles = generate_articles(n_articles, seed)
+    n_placeholders = 0
+
+    for start in range(0, len(articles), ARTICLES_PER_BATCH):
+        batch = start // ARTICLES_PER_BATCH + 1
+        filename = f'idx_0_batch_{batch:d}'
+        batch_articles = articles[start:start + ARTICLES_PER_BATCH]
+        placeholder = rng.random() < PLACEHOLDER_RATE
+        n_placeholders += placeholder
+
+        if fmt == 'zip':
+            with zipfile.ZipFile(path / (filename + '.ZIP'), 'w', zipfile.ZIP_DEFLATED) as archive:
+                if placeholder:
+                    archive.writestr(filename + '_deliverynotification.txt', placeholder_text(0, batch))
+                    continue
+                for n, article in enumerate(batch_articles, start=1):
+                    archive.writestr(f'{n:03d}_{article["title"][:30]}.RTF', article_rtf(article))
+        else:
+            if placeholder:
+                (path / (filename + '_deliverynotification.txt')).write_text(placeholder_text(0, batch))
+                continue
+            batch_path = path / filename
+            batch_path.mkdir(exist_ok=True)
+            for n, article in enumerate(batch_articles, start=1):
+                with open(batch_path / f'{n:03d}.txt', 'w') as f:
+                    f.write(article_text(article))
+
+        metrics.progress(min(start + ARTICLES_PER_BATCH, len(articles)), len(articles), prefix='Writing articles: ',
+                         unit='articles')
+
+    return len(articles), n_placeholders
+
+
+if __name__ == '__main__':
+    n_articles = int(sys.argv[1]) if len(sys.argv) > 1 else N_ARTICLES
+    n_written, n_placeholders = write_corpus(n_articles=n_articles)
+    print(f'Wrote {n_written:d} articles ({n_placeholders:d} batches as placeholders) to {output_path}')
@@ -0,0 +1,87 @@
+import os
+import zipfile
+import threading
+
+import pytest
+
+import downloads
+from downloads import DownloadError, check_archive, wait_for_download
+
+
+def write_archive(path, members):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name in members:
+            archive.writestr(name, '{\\rtf1 article}')
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(downloads, 'POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(downloads, 'EVENT_SAFETY_INTERVAL', 0.05)
+
+
+def test_valid_archive_passes(tmp_path):
+    path = write_archive(tmp_path / 'idx_0_batch_1.ZIP', ['001.RTF', '002.RTF', '003.RTF'])
+    check_archive(path)
+    check_archive(path, expected_members=3)
+
+
+def test_member_count_must_match(tmp_path):
+    path = write_archive(tmp_path / 'idx_0_batch_1.ZIP', ['001.RTF', '002.RTF'])
+    with pytest.raises(DownloadError, match='expected 3'):
+        check_archive(path, expected_members=3)
+
+
+def test_corrupt_archive_fails(tmp_path):
+    path = write_archive(tmp_path / 'idx_0_batch_1.ZIP', ['001.RTF', '002.RTF'])
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    with pytest.raises(DownloadError):
+        check_archive(path)
+
+
+def test_placeholder_member_fails(tmp_path):
+    path = write_archive(tmp_path / 'idx_0_batch_1.ZIP', ['001.RTF', 'idx_0_batch_1_deliverynotification.txt'])
+    with pytest.raises(DownloadError, match='placeholder'):
+        check_archive(path)
+
+
+def test_wait_returns_a_finished_archive(tmp_path):
+    write_archive(tmp_path / 'idx_0_batch_1.ZIP', ['001.RTF'])
+    assert wait_for_download(str(tmp_path), 'idx_0_batch_1', 5, 1) == os.path.join(tmp_path, 'idx_0_batch_1.ZIP')
+
+
+def test_wait_holds_off_while_part_file_exists(tmp_path):
+    write_archive(tmp_path / 'idx_0_batch_1.ZIP', ['001.RTF'])
+    part = tmp_path / 'idx_0_batch_1.ZIP.part'
+    part.write_bytes(b'')
+    timer = threading.Timer(0.3, part.unlink)
+    timer.start()
+    try:
+        assert wait_for_download(str(tmp_path), 'idx_0_batch_1', 5)
+    finally:
+        timer.cancel()
+    assert not part.exists()
+
+
+def test_wait_removes_a_corrupt_archive(tmp_path):
+    (tmp_path / 'idx_0_batch_1.ZIP').write_bytes(b'PK\x03\x04 not really a zip')
+    with pytest.raises(DownloadError):
+        wait_for_download(str(tmp_path), 'idx_0_batch_1', 5)
+    assert not (tmp_path / 'idx_0_batch_1.ZIP').exists()
+
+
+def test_wait_fails_fast_on_a_placeholder(tmp_path):
+    placeholder = tmp_path / 'idx_0_batch_1_deliverynotification.txt'
+    placeholder.write_text('Your download could not be delivered')
+    with pytest.raises(DownloadError, match='placeholder'):
+        wait_for_download(str(tmp_path), 'idx_0_batch_1', 5)
+    assert not placeholder.exists()
+
+
+def test_wait_times_out(tmp_path):
+    with pytest.raises(DownloadError, match='timeout'):
+        wait_for_download(str(tmp_path), 'idx_0_batch_1', 0.2)
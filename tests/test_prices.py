@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+import prices
+
+
+@pytest.fixture
+def requests(tmp_path, monkeypatch):
+    monkeypatch.setattr(prices, 'prices_path', tmp_path)
+    made = []
+
+    # Yahoo has not published the last close yet, so the cache stays one weekday behind
+    def fetch_yahoo(symbol, start):
+        made.append(pd.Timestamp(start))
+        end = pd.Timestamp.today().normalize() - pd.offsets.BDay(2)
+        dates = pd.bdate_range(min(pd.Timestamp(start), end - pd.offsets.BDay(5)), end, name='date')
+        return pd.Series(20.0, index=dates, name='Adj Close')
+
+    monkeypatch.setattr(prices, 'fetch_yahoo', fetch_yahoo)
+    return made
+
+
+def test_latest_prices_are_requested_once_a_day(requests):
+    start = pd.Timestamp.today().normalize() - pd.DateOffset(days=30)
+    prices.load_prices(start)
+    prices.load_prices(start)
+    prices.load_prices(start)
+    assert requests == [start]
+
+
+def test_earlier_dates_are_still_requested(requests):
+    start = pd.Timestamp.today().normalize() - pd.DateOffset(days=30)
+    prices.load_prices(start)
+    prices.load_prices(start - pd.DateOffset(days=30))
+    assert requests == [start, start - pd.DateOffset(days=30)]
+
+
+def test_failed_request_counts_for_the_day(requests, monkeypatch):
+    start = pd.Timestamp.today().normalize() - pd.DateOffset(days=30)
+    prices.load_prices(start)
+
+    def offline(symbol, start):
+        requests.append(pd.Timestamp(start))
+        raise OSError('no network')
+
+    monkeypatch.setattr(prices, 'fetch_yahoo', offline)
+    prices.cache_path(prices.SYMBOL).with_suffix('.requested').write_text('2000-01-03\n')
+    assert len(prices.load_prices(start)) > 0
+    assert len(prices.load_prices(start)) > 0
+    assert len(requests) == 2
@@ -0,0 +1,208 @@
+import sqlite3
+import zipfile
+import contextlib
+import threading
+
+import pytest
+
+import process
+import synthetic_corpus
+
+RECORD = ('Oil Rallies', '2020-01-02', 'Wire', 'Jane Doe', 'Prices rose.', 2)
+
+
+def test_writer_inserts_and_rejects_duplicates(tmp_path):
+    db = str(tmp_path / 'articles.db')
+    writer = process.ArticleWriter(db, batch_size=2)
+    writer.start()
+    for record in (RECORD, RECORD, RECORD[:3] + (None,) + RECORD[4:]):
+        writer.put(record)
+    writer.close()
+    assert (writer.record_count, writer.duplicate_count) == (3, 1)
+    with sqlite3.connect(db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM ARTICLES").fetchall() == [(2,)]
+
+
+# A codec that cannot be set up fails before the first record is read, close has to report that error and the thread
+# must not fail on top of it
+@pytest.mark.filterwarnings('error::pytest.PytestUnhandledThreadExceptionWarning')
+def test_writer_reports_setup_error(tmp_path):
+    writer = process.ArticleWriter(str(tmp_path / 'articles.db'), compression='lz4')
+    writer.start()
+    writer.queue.put(RECORD)
+    with pytest.raises(ValueError, match='unknown body compression'):
+        writer.close()
+
+
+# A body paragraph that merely starts with one of the words of the metadata block must not end the body
+def test_parse_article_keeps_paragraphs_starting_with_metadata_words():
+    article = dict(synthetic_corpus.generate_articles(1)[0])
+    article['body'] = ('OPEC cut output again.\n\nLanguage barriers slowed the talks.\n\n'
+                       'Classification of the grades is disputed.')
+    title, date, publisher, author, body, word_count = process.parse_article(
+        synthetic_corpus.article_text(article).split('\n'))
+    assert body == article['body']
+    assert word_count == 15
+
+
+def write_records(db, records, compression=None):
+    writer = process.ArticleWriter(db, compression=compression)
+    writer.start()
+    for record in records:
+        writer.put(record)
+    writer.close()
+    return writer
+
+
+def test_writer_stamps_a_new_database_with_the_parser_version(tmp_path):
+    db = str(tmp_path / 'articles.db')
+    write_records(db, [RECORD])
+    write_records(db, [RECORD])
+    with sqlite3.connect(db) as conn:
+        assert conn.execute("PRAGMA user_version").fetchall() == [(process.PARSER_VERSION,)]
+        assert conn.execute("SELECT COUNT(*) FROM ARTICLES").fetchall() == [(1,)]
+
+
+# A database filled before the parser version was recorded holds articles that the current parser would store again.
+# It is refused before anything is changed, not even the duplicates an old database may hold are removed.
+def test_writer_refuses_a_database_from_another_parser(tmp_path):
+    db = tmp_path / 'articles.db'
+    with contextlib.closing(sqlite3.connect(db)) as conn, conn:
+        conn.execute("""
+        CREATE TABLE ARTICLES(ID INTEGER PRIMARY KEY AUTOINCREMENT, TITLE TEXT NOT NULL, DATE TEXT NOT NULL,
+        PUBLISHER TEXT NOT NULL, AUTHOR TEXT, BODY TEXT NOT NULL, WORDCOUNT INTEGER NOT NULL)
+        """)
+        conn.executemany("INSERT INTO ARTICLES VALUES (NULL, ?, ?, ?, ?, ?, ?)", [RECORD] * 3)
+    before = db.read_bytes()
+    with pytest.raises(process.StaleDatabaseError, match='rebuild'):
+        write_records(str(db), [RECORD[:3] + (None,) + RECORD[4:]])
+    assert db.read_bytes() == before
+
+
+
+def insert_without_codec(db, title):
+    with contextlib.closing(sqlite3.connect(db)) as conn, conn:
+        conn.execute("INSERT INTO ARTICLES VALUES (NULL, ?, '2020-01-03', 'Wire', NULL, 'Refiners cut runs.', 3)",
+                     [title])
+
+
+def search(db, query):
+    with contextlib.closing(sqlite3.connect(db)) as conn:
+        process.create_tables(conn)
+        return [title for title, in conn.execute(f"SELECT TITLE FROM ARTICLES WHERE {process.term_filter(query)}")]
+
+
+# With plain bodies the full-text triggers are built-in SQL, so a connection without UNPACK_BODY can still write
+def test_plain_database_accepts_writes_from_any_client(tmp_path):
+    db = str(tmp_path / 'articles.db')
+    write_records(db, [RECORD])
+    insert_without_codec(db, 'Refinery Runs')
+    assert search(db, 'refiners') == ['Refinery Runs']
+    assert search(db, 'prices') == ['Oil Rallies']
+
+
+def test_compressed_bodies_switch_the_triggers_and_back(tmp_path):
+    db = str(tmp_path / 'articles.db')
+    write_records(db, [RECORD], compression='zlib')
+    with pytest.raises(sqlite3.OperationalError, match='UNPACK_BODY'):
+        insert_without_codec(db, 'Refinery Runs')
+    assert search(db, 'prices') == ['Oil Rallies']
+
+    with contextlib.closing(sqlite3.connect(db)) as conn:
+        assert process.compress_bodies(conn, None, vacuum=False) == 1
+    insert_without_codec(db, 'Refinery Runs')
+    assert search(db, 'refiners') == ['Refinery Runs']
+    assert search(db, 'prices') == ['Oil Rallies']
+
+def write_archive(path, articles):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for n, article in enumerate(articles, start=1):
+            archive.writestr(f'{n:03d}.RTF', synthetic_corpus.article_rtf(article))
+    return path
+
+
+@pytest.fixture
+def ingest_outputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(process, 'metrics_loc', str(tmp_path / 'process_metrics.json'))
+    monkeypatch.setattr(process, 'ingest_metrics_loc', str(tmp_path / 'ingest_metrics.json'))
+    monkeypatch.setattr(process, 'error_report_loc', str(tmp_path / 'parse_errors.csv'))
+    monkeypatch.setattr(process.write_error_report, '__defaults__', (str(tmp_path / 'parse_errors.csv'),))
+
+
+# Submit paths the way the scraper does and close the ingester, failing instead of hanging when it blocks the caller
+def run_ingester(ingester, paths):
+    raised = []
+
+    def scrape():
+        try:
+            ingester.start()
+            for path in paths:
+                ingester.submit(path)
+            ingester.close()
+        except Exception as ex:
+            raised.append(ex)
+
+    thread = threading.Thread(target=scrape, daemon=True)
+    thread.start()
+    thread.join(20)
+    assert not thread.is_alive(), 'the ingester blocked the scraper'
+    if raised:
+        raise raised[0]
+
+
+def ingested_names(db):
+    with sqlite3.connect(db) as conn:
+        return {name for name, in conn.execute("SELECT FILENAME FROM INGESTED_ARCHIVES").fetchall()}
+
+
+# A damaged deflate stream makes zipfile raise zlib.error or EOFError rather than BadZipFile
+def test_parse_archive_reports_a_damaged_member(tmp_path):
+    path = write_archive(tmp_path / 'idx_0_batch_1.ZIP', synthetic_corpus.generate_articles(1))
+    data = bytearray(path.read_bytes())
+    data[40:80] = bytes(40)
+    path.write_bytes(data)
+    [(name, record, error)] = process.parse_archive(path)
+    assert record is None and error[0][0] == 'file'
+
+
+# One unreadable archive must not stop the ingester, the archives after it are still stored
+def test_ingester_skips_an_archive_that_raises(tmp_path, monkeypatch, ingest_outputs):
+    db = str(tmp_path / 'articles.db')
+    articles = synthetic_corpus.generate_articles(4, seed=3)
+    paths = [write_archive(tmp_path / f'idx_0_batch_{n:d}.ZIP', articles[n - 1:n]) for n in (1, 2, 3)]
+    parse_archive = process.parse_archive
+
+    def failing_parse(path):
+        if path.name == 'idx_0_batch_2.ZIP':
+            raise EOFError('compressed file ended before the end-of-stream marker was reached')
+        return parse_archive(path)
+
+    monkeypatch.setattr(process, 'parse_archive', failing_parse)
+    (tmp_path / 'process_metrics.json').write_text('{"source": "zip"}')  # the report of a process.py run
+    ingester = process.ArchiveIngester(db_path=db)
+    run_ingester(ingester, paths)
+    assert (tmp_path / 'process_metrics.json').read_text() == '{"source": "zip"}'
+    assert (tmp_path / 'ingest_metrics.json').exists()
+    assert ingester.error is None
+    assert ingester.archive_count == 2
+    assert [field for _, field, _ in ingester.errors] == ['file']
+    assert ingested_names(db) == {'idx_0_batch_1.ZIP', 'idx_0_batch_3.ZIP'}
+
+
+# After the writer has failed every archive is dropped, so the scraper never blocks on a full queue
+@pytest.mark.filterwarnings('error::pytest.PytestUnhandledThreadExceptionWarning')
+def test_failed_ingester_keeps_draining(tmp_path, ingest_outputs):
+    path = write_archive(tmp_path / 'idx_0_batch_1.ZIP', synthetic_corpus.generate_articles(1))
+    ingester = process.ArchiveIngester(db_path=str(tmp_path / 'articles.db'), max_queued=1, compression='lz4')
+    with pytest.raises(ValueError, match='unknown body compression'):
+        run_ingester(ingester, [path] * 10)
+
+
+@pytest.mark.filterwarnings('error::pytest.PytestUnhandledThreadExceptionWarning')
+def test_ingester_that_could_not_start_closes(tmp_path, ingest_outputs):
+    db = tmp_path / 'articles.db'
+    db.write_bytes(b'not a database' * 100)
+    ingester = process.ArchiveIngester(db_path=str(db), max_queued=1)
+    with pytest.raises(sqlite3.DatabaseError):
+        run_ingester(ingester, [tmp_path / 'idx_0_batch_1.ZIP'] * 5)
+    assert ingester.writer is None
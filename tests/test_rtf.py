@@ -0,0 +1,18 @@
+from rtf import rtf_to_text
+
+
+def test_unicode_escapes_skip_their_fallback():
+    assert rtf_to_text(r'{\rtf1 caf\u233?, na\uc2\u239 xxve}') == 'café, naïve'
+
+
+def test_negative_unicode_escape():
+    assert rtf_to_text(r'{\rtf1 \u-3913?}') == '\uf0b7'
+
+
+# \u without a number is not a unicode escape and used to fail with int(None)
+def test_unicode_escape_without_a_code_is_ignored():
+    assert rtf_to_text(r'{\rtf1 a\u b}') == 'ab'
+
+
+def test_surrogate_pairs_are_joined():
+    assert rtf_to_text(r'{\rtf1 \u-10179?\u-8704? and \u-10179?}') == '\U0001f600 and \ufffd'
@@ -0,0 +1,473 @@
+import zipfile
+import threading
+from collections import Counter
+
+import pytest
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+
+import scrape
+from scrape import ScrapeScheduler, LoginError
+from manifest import ScrapeManifest
+
+JOBS = [(uidx, f'https://example.test/search?window={uidx}') for uidx in range(5)]
+
+
+class FakeSession:
+    def __init__(self, n):
+        self.n = n
+        self.quits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.quit()
+
+    def quit(self):
+        self.quits += 1
+
+
+# Run the scheduler in a thread so a hang fails the test instead of blocking the suite
+def run_scheduler(scheduler, timeout=20):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(failed=scheduler.run()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'scheduler did not finish'
+    return result['failed']
+
+
+def test_every_url_downloaded_once():
+    calls = Counter()
+    lock = threading.Lock()
+
+    def download(session, url, uidx):
+        with lock:
+            calls[uidx] += 1
+        return True
+
+    scheduler = ScrapeScheduler(JOBS, FakeSession, n_workers=3, download=download, backoff=0)
+    assert run_scheduler(scheduler) == []
+    assert sorted(scheduler.succeeded) == [uidx for uidx, _ in JOBS]
+    assert set(calls.values()) == {1}
+
+
+def test_failed_url_is_requeued_then_succeeds():
+    attempts = Counter()
+
+    def download(session, url, uidx):
+        attempts[uidx] += 1
+        return uidx != 2 or attempts[uidx] > 1
+
+    scheduler = ScrapeScheduler(JOBS, FakeSession, n_workers=2, download=download, backoff=0)
+    assert run_scheduler(scheduler) == []
+    assert attempts[2] == 2
+
+
+def test_url_failing_every_requeue_is_reported():
+    attempts = Counter()
+
+    def download(session, url, uidx):
+        attempts[uidx] += 1
+        return uidx != 3
+
+    scheduler = ScrapeScheduler(JOBS, FakeSession, n_workers=2, download=download, max_requeues=2, backoff=0)
+    assert run_scheduler(scheduler) == [JOBS[3]]
+    assert attempts[3] == 3
+
+
+@pytest.mark.parametrize('error', [OSError('disk full'), EOFError(), KeyError('uidx')])
+def test_unexpected_error_fails_the_url_without_hanging(error):
+    def download(session, url, uidx):
+        if uidx == 1:
+            raise error
+        return True
+
+    scheduler = ScrapeScheduler(JOBS, FakeSession, n_workers=2, download=download, max_requeues=1, backoff=0)
+    assert run_scheduler(scheduler) == [JOBS[1]]
+    assert sorted(scheduler.succeeded) == [0, 2, 3, 4]
+
+
+def test_browser_failure_restarts_the_session():
+    sessions = []
+
+    def session_factory(n):
+        sessions.append(FakeSession(n))
+        return sessions[-1]
+
+    def download(session, url, uidx):
+        if uidx == 0 and session.quits == 0:
+            raise scrape.WebDriverException('browser crashed')
+        return True
+
+    scheduler = ScrapeScheduler(JOBS, session_factory, n_workers=1, download=download, backoff=0)
+    assert run_scheduler(scheduler) == []
+    assert sessions[0].quits >= 1
+
+
+def test_workers_that_cannot_login_leave_their_urls_failed():
+    def download(session, url, uidx):
+        raise LoginError('unable to login')
+
+    scheduler = ScrapeScheduler(JOBS, FakeSession, n_workers=2, download=download, backoff=0)
+    assert run_scheduler(scheduler) == sorted(JOBS)
+
+
+class FakeElement:
+    def __init__(self, driver, element_id):
+        self.driver = driver
+        self.element_id = element_id
+        self.page_load = driver.page_loads
+
+    def send_keys(self, keys):
+        if keys == scrape.Keys.ENTER:
+            self.driver.submit()
+        else:
+            self.driver.typed[self.element_id] = keys
+
+    def is_enabled(self):
+        if self.page_load != self.driver.page_loads:
+            raise StaleElementReferenceException('element is gone')
+        return True
+
+
+class FakeDriver:
+    """Stand-in for the proxy: every page redirects to the login form until valid credentials are submitted."""
+
+    def __init__(self, login_url, credentials):
+        self.login_url = login_url
+        self.credentials = credentials
+        self.logged_in = False
+        self.page = None
+        self.page_loads = 0
+        self.typed = {}
+        self.visited = []
+        self.quit_called = False
+
+    def load(self, page):
+        self.page = page
+        self.page_loads += 1
+
+    def get(self, url):
+        self.visited.append(url)
+        self.load(url if self.logged_in and url != self.login_url else 'login')
+
+    def submit(self):
+        if self.typed == self.credentials:
+            self.logged_in = True
+            self.load('landing')
+
+    def expire(self):
+        self.logged_in = False
+
+    def find_elements_by_id(self, element_id):
+        if self.page == 'login' and element_id in ('username', 'password'):
+            return [FakeElement(self, element_id)]
+        return []
+
+    def find_element_by_id(self, element_id):
+        elements = self.find_elements_by_id(element_id)
+        if not elements:
+            raise NoSuchElementException(element_id)
+        return elements[0]
+
+    def find_element(self, by, value):
+        return self.find_element_by_id(value)
+
+    def maximize_window(self):
+        pass
+
+    def quit(self):
+        self.quit_called = True
+
+
+CREDENTIALS = {'username': 'analyst', 'password': 'secret'}
+
+
+def fake_session(tmp_path, credentials=CREDENTIALS, timeout=5):
+    drivers = []
+
+    def driver_factory(download_dir):
+        drivers.append(FakeDriver('https://login.test', CREDENTIALS))
+        return drivers[-1]
+
+    session = scrape.BrowserSession(credentials, login_url='https://login.test', driver_factory=driver_factory,
+                                    timeout=timeout, download_dir=tmp_path / 'worker_0')
+    return session, drivers
+
+
+def test_session_logs_in_once_and_again_after_expiry(tmp_path):
+    session, drivers = fake_session(tmp_path)
+    with session:
+        session.get('https://search.test/1')
+        session.get('https://search.test/2')
+        assert session.logins == 1
+        assert drivers[0].page == 'https://search.test/2'
+
+        drivers[0].expire()
+        session.get('https://search.test/3')
+        assert session.logins == 2
+        assert drivers[0].page == 'https://search.test/3'
+    assert len(drivers) == 1
+    assert drivers[0].quit_called
+    assert (tmp_path / 'worker_0').is_dir()
+
+
+def test_rejected_credentials_raise_login_error(tmp_path):
+    session, drivers = fake_session(tmp_path, credentials={'username': 'analyst', 'password': 'wrong'}, timeout=0.5)
+    with session:
+        with pytest.raises(LoginError):
+            session.get('https://search.test/1')
+
+
+class ResultsDriver:
+    """Search result page with pages result pages, or the no results message when pages is 0."""
+
+    def __init__(self, pages, failures=0):
+        self.pages = pages
+        self.failures = failures
+
+    def find_element(self, by, value):  # the loading box is never shown
+        raise NoSuchElementException(value)
+
+    def find_elements_by_xpath(self, xpath):
+        if 'selectall' in xpath:
+            return [object()] if self.pages else []
+        if scrape.NO_RESULTS_TEXT in xpath:
+            return [] if self.pages else [object()]
+        if 'pagination' in xpath:
+            return [FakeLink(str(p)) for p in range(1, min(self.pages, 5) + 1)] + [FakeLink(str(self.pages)),
+                                                                                  FakeLink('Next')]
+        return []
+
+
+class FakeLink:
+    def __init__(self, text):
+        self.text = text
+
+
+class ResultsSession:
+    def __init__(self, driver):
+        self.driver = driver
+        self.wait = scrape.WebDriverWait(driver, 1)
+        self.loads = 0
+
+    def get(self, url):
+        self.loads += 1
+        if self.driver.failures:
+            self.driver.failures -= 1
+            raise scrape.WebDriverException('page load timed out')
+
+
+def test_count_result_pages(monkeypatch):
+    monkeypatch.setattr(scrape.time, 'sleep', lambda seconds: None)
+    assert scrape.count_result_pages(ResultsSession(ResultsDriver(42)), 'url') == 42
+    assert scrape.count_result_pages(ResultsSession(ResultsDriver(1)), 'url') == 1
+
+
+def test_count_result_pages_of_an_empty_window_is_zero():
+    assert scrape.count_result_pages(ResultsSession(ResultsDriver(0)), 'url') == 0
+
+
+def test_count_result_pages_retries_failed_loads(monkeypatch):
+    monkeypatch.setattr(scrape.time, 'sleep', lambda seconds: None)
+    session = ResultsSession(ResultsDriver(7, failures=2))
+    assert scrape.count_result_pages(session, 'url', retries=3) == 7
+    assert session.loads == 3
+
+    with pytest.raises(scrape.WebDriverException):
+        scrape.count_result_pages(ResultsSession(ResultsDriver(7, failures=3)), 'url', retries=3)
+
+
+def test_plan_keeps_empty_windows_unsplit():
+    pages = {('2020-01-01', '2020-01-31'): 0, ('2020-02-01', '2020-02-29'): 150, ('2020-02-01', '2020-02-14'): 70,
+             ('2020-02-15', '2020-02-29'): 80}
+    plan = scrape.plan_windows(list(pages)[:2], lambda start, end: pages[(start, end)], page_budget=100)
+    assert [(w['start'], w['end'], w['pages']) for w in plan] == [
+        ('2020-01-01', '2020-01-31', 0), ('2020-02-01', '2020-02-14', 70), ('2020-02-15', '2020-02-29', 80)]
+
+
+def test_has_downloads(tmp_path):
+    (tmp_path / 'worker_0').mkdir()
+    assert not scrape.has_downloads(tmp_path)
+    (tmp_path / 'idx_3_batch_1.ZIP').write_bytes(b'')
+    assert scrape.has_downloads(tmp_path)
+
+
+class NexisElement:
+    def __init__(self, driver, key, text=''):
+        self.driver = driver
+        self.key = key
+        self.text = text
+
+    def click(self):
+        self.driver.click(self.key)
+
+    def clear(self):
+        self.driver.typed[self.key] = ''
+
+    def send_keys(self, keys):
+        self.driver.typed[self.key] = keys
+
+    def get_attribute(self, name):
+        return 'false'
+
+    def is_displayed(self):
+        return True
+
+    def is_enabled(self):
+        return True
+
+
+class NexisDriver:
+    """Stand-in for a Nexis Uni result list of documents spread over pages of 10. The pagination bar links the pages
+    within four of the current one, the last page and Next. Selected documents go to the tray until they are
+    downloaded or the tray is cleared."""
+
+    pagination = "//nav[@class='pagination']/ol"
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.pages = -(-documents // 10)
+        self.current = 1
+        self.tray = 0
+        self.selected_pages = []
+        self.downloads = []
+        self.typed = {}
+
+    def get(self, url):
+        self.current = 1
+
+    def documents_on(self, page):
+        return min(10, self.documents - 10 * (page - 1))
+
+    def page_links(self):
+        shown = sorted(set(range(max(1, self.current - 4), min(self.pages, self.current + 4) + 1)) | {self.pages})
+        return [NexisElement(self, ('page', p), str(p)) for p in shown if p != self.current]
+
+    def click(self, key):
+        if key == 'selectall':
+            self.selected_pages.append(self.current)
+            self.tray += self.documents_on(self.current)
+        elif key == 'next':
+            self.current += 1
+        elif key[0] == 'page':
+            self.current = key[1]
+        elif key == 'download':
+            self.downloads.append((self.typed['FileName'], self.tray))
+            self.tray = 0
+        elif key == 'confirm':
+            self.tray = 0
+
+    def find_element(self, by, value):
+        if value == "//div[@class='box']":  # the loading box is never shown
+            raise NoSuchElementException(value)
+        if value == f'{self.pagination}/li[6]/a':
+            return NexisElement(self, 'last', str(self.pages))
+        if value == f"{self.pagination}/li[@class='current']/span":
+            return NexisElement(self, 'current', str(self.current))
+        if value == f'{self.pagination}/li[last()]/a':
+            return NexisElement(self, 'next', 'Next')
+        if value == "//button[@data-action='viewtray']/span[1]":
+            return NexisElement(self, 'tray', str(self.tray) if self.tray else '')
+        for action in ('selectall', 'download', 'confirm'):
+            if f"@data-action='{action}'" in value:
+                return NexisElement(self, action)
+        return NexisElement(self, value)
+
+    def find_element_by_xpath(self, xpath):
+        return self.find_element(scrape.By.XPATH, xpath)
+
+    def find_element_by_id(self, element_id):
+        return self.find_element(scrape.By.ID, element_id)
+
+    def find_elements_by_xpath(self, xpath):
+        if xpath == f'{self.pagination}/li/a':
+            return self.page_links() + [NexisElement(self, 'next', 'Next')]
+        return [self.find_element(scrape.By.XPATH, xpath)]
+
+    def find_elements_by_css_selector(self, selector):
+        return [object()] * (self.documents_on(self.current) if self.current in self.selected_pages else 0)
+
+    def execute_script(self, script, element):
+        element.click()
+
+
+class NexisSession:
+    def __init__(self, driver, download_dir):
+        self.driver = driver
+        self.wait = scrape.WebDriverWait(driver, 1)
+        self.download_dir = download_dir
+        download_dir.mkdir()
+
+    def get(self, url):
+        self.driver.get(url)
+
+
+@pytest.fixture
+def nexis_downloads(tmp_path, monkeypatch):
+    monkeypatch.setattr(scrape, 'download_path', tmp_path / 'raw')
+    (tmp_path / 'raw').mkdir()
+
+    # the browser's download: an archive of the expected number of documents in the session's own folder
+    def wait_for_download(download_dir, filename, timeout, expected_members):
+        path = scrape.Path(download_dir) / (filename + '.ZIP')
+        with zipfile.ZipFile(path, 'w') as archive:
+            for n in range(expected_members):
+                archive.writestr(f'{n:03d}.RTF', '{\\rtf1 article}')
+        return str(path)
+
+    monkeypatch.setattr(scrape, 'wait_for_download', wait_for_download)
+    return tmp_path
+
+
+def test_jump_to_page_lands_on_the_target_without_selecting():
+    driver = NexisDriver(400)
+    scrape.jump_to_page(driver, scrape.WebDriverWait(driver, 1), 23)
+    assert driver.current == 23
+    assert driver.selected_pages == [] and driver.tray == 0
+
+    scrape.jump_to_page(driver, scrape.WebDriverWait(driver, 1), 23)
+    assert driver.current == 23
+    with pytest.raises(scrape.WebDriverException, match='page 41'):
+        scrape.jump_to_page(driver, scrape.WebDriverWait(driver, 1), 41)
+
+
+def test_download_url_downloads_every_batch(nexis_downloads):
+    driver = NexisDriver(245)
+    session = NexisSession(driver, nexis_downloads / 'worker_0')
+    with ScrapeManifest(str(nexis_downloads / 'manifest.db')) as manifest:
+        assert scrape.download_url(session, 'url', 0, manifest)
+        assert manifest.url_complete(0, 'url')
+    assert driver.downloads == [('idx_0_batch_1', 100), ('idx_0_batch_2', 100), ('idx_0_batch_3', 45)]
+    assert sorted(f.name for f in (nexis_downloads / 'raw').iterdir()) == [
+        'idx_0_batch_1.ZIP', 'idx_0_batch_2.ZIP', 'idx_0_batch_3.ZIP']
+
+
+# Batches 1 and 3 were stored by an earlier run: the scraper jumps past batch 1 and only downloads batch 2
+def test_download_url_resumes_from_the_manifest(nexis_downloads):
+    driver = NexisDriver(245)
+    session = NexisSession(driver, nexis_downloads / 'worker_0')
+    with ScrapeManifest(str(nexis_downloads / 'manifest.db')) as manifest:
+        manifest.record_url(0, 'url', 25)
+        for batch in (1, 3):
+            path = nexis_downloads / 'raw' / f'idx_0_batch_{batch:d}.ZIP'
+            path.write_bytes(b'stored earlier')
+            manifest.record_batch(0, batch, 10 * batch, path.stem, str(path))
+
+        assert scrape.download_url(session, 'url', 0, manifest)
+        assert manifest.url_complete(0, 'url')
+    assert driver.downloads == [('idx_0_batch_2', 100)]
+    assert min(driver.selected_pages) == 11
+    assert driver.tray == 0
+
+
+def test_download_url_skips_a_url_the_manifest_has_complete(nexis_downloads):
+    driver = NexisDriver(95)
+    session = NexisSession(driver, nexis_downloads / 'worker_0')
+    with ScrapeManifest(str(nexis_downloads / 'manifest.db')) as manifest:
+        path = nexis_downloads / 'raw' / 'idx_0_batch_1.ZIP'
+        path.write_bytes(b'stored earlier')
+        manifest.record_batch(0, 1, 10, path.stem, str(path))
+        assert scrape.download_url(session, 'url', 0, manifest)
+    assert driver.downloads == [] and driver.selected_pages == []
@@ -0,0 +1,327 @@
+import re
+import json
+import sqlite3
+import contextlib
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import process
+import tone_index
+from tone_index import HarvardLexicon, Lexicon
+
+# Harvard IV-4 layout: Entry, Source, Positiv, Negativ. Sense suffixes are stripped, 'gain' is listed twice and
+# 'mixed' is both positive and negative.
+LEXICON_CSV = """Entry,Source,Positiv,Negativ
+GAIN#1,H4Lvd,Positiv,
+GAIN#2,H4Lvd,,Negativ
+RALLY,H4Lvd,Positiv,
+STRONG,H4Lvd,Positiv,
+LOSS,H4Lvd,,Negativ
+CRISIS,H4Lvd,,Negativ
+MIXED,H4Lvd,Positiv,Negativ
+BARREL,H4Lvd,,
+"""
+
+DOCS = [
+    'oil prices rally on a strong gain as opec cuts output',
+    'crisis deepens with a loss for producers and another loss for refiners',
+    'barrel prices hold steady',
+    'mixed signals in a mixed market after the rally and the crisis',
+    'no dictionary words here at all',
+    '',
+]
+
+
+def tokenize(s):
+    return re.findall(r'\w+', s)
+
+
+# The per-term loop the scorer started from, kept here as the reference the vectorized Lexicon has to agree with
+def baseline_sentiment(s, hiv_loc):
+    words = tokenize(s)
+    freq_dict = {w: words.count(w) for w in set(words)}
+    df = pd.DataFrame(data=freq_dict.items(), columns=['terms', 'freq'])
+
+    h_four = pd.read_csv(hiv_loc, usecols=[0, 2, 3])
+    h_four.columns = [c.lower() for c in h_four.columns]
+    h_four['entry'] = h_four['entry'].apply(lambda x: re.sub(r'\#\d+', '', x).lower())
+    h_four = h_four.drop_duplicates(subset=['entry'])
+
+    pos_terms = list(h_four.loc[~h_four['positiv'].isnull(), 'entry'].apply(str.lower))
+    neg_terms = list(h_four.loc[~h_four['negativ'].isnull(), 'entry'].apply(str.lower))
+
+    for i in range(len(df)):
+        term = df.loc[df.index[i], 'terms']
+        if term not in list(h_four['entry']):
+            df.loc[df.index[i], 'freq'] = np.nan
+    df = df.dropna()
+
+    df['sentiment'] = 0
+    for i in range(len(df)):
+        term = df.loc[df.index[i], 'terms']
+        if term in pos_terms:
+            df.loc[df.index[i], 'sentiment'] = 1
+        elif term in neg_terms:
+            df.loc[df.index[i], 'sentiment'] = -1
+
+    df['weights'] = df['freq'] / df['freq'].sum()
+    return float((df['sentiment'] * df['weights']).sum())
+
+
+@pytest.fixture
+def hiv_loc(tmp_path, monkeypatch):
+    monkeypatch.setattr(tone_index, 'word_tokenize', tokenize)
+    path = tmp_path / 'HIV-4.csv'
+    path.write_text(LEXICON_CSV)
+    return str(path)
+
+
+def test_score_matches_baseline(hiv_loc):
+    lexicon = HarvardLexicon(hiv_loc)
+    for doc in DOCS:
+        assert lexicon.score(doc) == pytest.approx(baseline_sentiment(doc, hiv_loc))
+
+
+def test_score_batch_matches_baseline(hiv_loc):
+    scores = HarvardLexicon(hiv_loc).score_batch(DOCS)
+    assert scores == pytest.approx([baseline_sentiment(doc, hiv_loc) for doc in DOCS])
+
+
+def test_compute_sentiment_matches_baseline(hiv_loc):
+    lexicon = HarvardLexicon(hiv_loc)
+    doc = DOCS[0]
+    assert tone_index.compute_sentiment(doc, lexicon) == pytest.approx(baseline_sentiment(doc, hiv_loc))
+
+
+
+# The default lexicon is read once, not for every article scored
+def test_compute_sentiment_reads_the_default_lexicon_once(hiv_loc, monkeypatch):
+    loaded = []
+
+    def lexicon():
+        loaded.append(hiv_loc)
+        return HarvardLexicon(hiv_loc)
+
+    monkeypatch.setattr(tone_index, 'HarvardLexicon', lexicon)
+    tone_index.default_lexicon.cache_clear()
+    try:
+        scores = [tone_index.compute_sentiment(doc) for doc in DOCS]
+    finally:
+        tone_index.default_lexicon.cache_clear()
+    assert scores == pytest.approx([baseline_sentiment(doc, hiv_loc) for doc in DOCS])
+    assert len(loaded) == 1
+
+def test_word_list_lexicon_prefers_positive():
+    lexicon = Lexicon.from_word_lists(['Rally', 'mixed'], ['loss', 'mixed'])
+    assert lexicon.score_tokens(['rally', 'loss', 'mixed', 'barrel']) == pytest.approx(1 / 3)
+    assert lexicon.score_tokens(['barrel']) == 0.0
+
+
+
+CORPUS = [
+    'Oil prices rallied 5% to $80 a barrel. OPEC said output of 1.2-million barrels would be cut! See www.opec.org',
+    'The 3-day talks ended. Producers were losing money and the losses grew by $2.5-billion in 2020.',
+    '',
+    'Refiners cut runs. Nothing else happened at https://example.com/oil today.',
+]
+SCOWL_WORDS = ['oil', 'price', 'prices', 'rallied', 'a', 'barrel', 'barrels', 'said', 'output', 'of', 'would', 'be',
+               'cut', 'see', 'the', 'talks', 'ended', 'producers', 'were', 'losing', 'money', 'and', 'losses', 'grew',
+               'by', 'in', 'refiners', 'runs', 'nothing', 'else', 'happened', 'at', 'today', 'to']
+
+
+class FakeStopwords:
+    @staticmethod
+    def words(language):
+        return ['a', 'the', 'and', 'of', 'at', 'to', 'by', 'in', 'were', 'be', 'would']
+
+
+class FakeLemmatizer:
+    def lemmatize(self, word):
+        return word[:-1] if word.endswith('s') and len(word) > 3 else word
+
+
+# The per-sentence loop the cleaner started from, with the module level dictionary passed in as usa_dict
+def baseline_prepare_for_sentiment(corpus, usa_dict):
+    s = corpus.lower().strip()
+    cleaned = []
+
+    for sent in tone_index.sent_tokenize(s):
+        words = tone_index.word_tokenize(sent)
+        p1 = re.compile(r'\$?[0-9]{1,}.?[0-9]{0,}-b?m?illion', re.IGNORECASE)  # $number.number-billions
+        p2 = re.compile(r'\$[0-9]{1,}', re.IGNORECASE)  # $number
+        p3 = re.compile(r'\d+-\w', re.IGNORECASE)  # remove number-words
+        p4 = re.compile(r'\d+\w', re.IGNORECASE)  # remove numberwords
+        p5 = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)  # urls
+        p6 = re.compile(r'\d+', re.IGNORECASE)  # remove numbers
+
+        words = [re.sub(p1, '', w) for w in words]  # billion/million
+        words = [re.sub(p2, '', w) for w in words]  # $ number
+        words = [re.sub(p3, '', w) for w in words]  # remove number-words
+        words = [re.sub(p4, '', w) for w in words]  # remove numberwords
+
+        words = ' '.join(words).split()
+        words = [re.sub(p5, '', w) for w in words]  # urls
+        words = [re.sub(p6, '', w) for w in words]  # remove numbers
+        words = [w.strip() for w in words]
+
+        words = [w for w in words if w in usa_dict]
+
+        lemma = tone_index.WordNetLemmatizer()
+        words = [lemma.lemmatize(w) for w in words]
+
+        stopwords_nltk = list(tone_index.stopwords.words('english'))
+        words = [w for w in words if w not in stopwords_nltk]
+
+        cleaned.append(' '.join(words))
+
+    cleaned = ' '.join(cleaned)
+
+    return cleaned
+
+
+# NLTK data is not needed: sentence and word splitting, stopwords and lemmas are simple stand-ins used by both sides
+@pytest.fixture
+def scowl_loc(tmp_path, monkeypatch):
+    monkeypatch.setattr(tone_index, 'sent_tokenize', lambda s: re.split(r'(?<=[.!?])\s+', s) if s else [])
+    monkeypatch.setattr(tone_index, 'word_tokenize', lambda s: re.findall(r'[$\w.:/%-]+|[^\w\s]', s))
+    monkeypatch.setattr(tone_index, 'stopwords', FakeStopwords)
+    monkeypatch.setattr(tone_index, 'WordNetLemmatizer', FakeLemmatizer)
+    path = tmp_path / '2of12inf.txt'
+    path.write_text('\n'.join(SCOWL_WORDS) + '\n')
+    return str(path)
+
+
+def test_cleaner_matches_baseline(scowl_loc):
+    cleaner = tone_index.TextCleaner(scowl_loc, lemma_cache_size=4)
+    for doc in CORPUS:
+        assert cleaner.clean(doc) == baseline_prepare_for_sentiment(doc, set(SCOWL_WORDS))
+    assert cleaner.clean(CORPUS[0]).split()[:3] == ['oil', 'price', 'rallied']
+
+
+def test_prepare_for_sentiment_sets_up_the_default_cleaner_once(scowl_loc, monkeypatch):
+    built = []
+    text_cleaner = tone_index.TextCleaner
+
+    def cleaner():
+        built.append(scowl_loc)
+        return text_cleaner(scowl_loc)
+
+    monkeypatch.setattr(tone_index, 'TextCleaner', cleaner)
+    tone_index.default_cleaner.cache_clear()
+    try:
+        cleaned = [tone_index.prepare_for_sentiment(doc) for doc in CORPUS]
+    finally:
+        tone_index.default_cleaner.cache_clear()
+    assert cleaned == [baseline_prepare_for_sentiment(doc, set(SCOWL_WORDS)) for doc in CORPUS]
+    assert len(built) == 1
+
+COUNTS = [
+    (1, '2020-01-02', {'rally': 2, 'oil': 1}),
+    (2, '2020-01-02', {'loss': 1, 'crisis': 1, 'oil': 3}),
+    (3, '2020-01-05', {'barrel': 1}),
+    (4, '2020-02-01', {'gain': 1, 'loss': 2, 'opec': 1}),
+    (5, '2020-02-03', {'rally': 1, 'strong': 1, 'output': 2}),
+]
+LEXICON = Lexicon.from_word_lists(['rally', 'gain', 'strong'], ['loss', 'crisis'])
+
+
+def expected_scores():
+    return [LEXICON.score_tokens([t for t, n in counts.items() for _ in range(n)]) for _, _, counts in COUNTS]
+
+
+def test_dtm_scores_match_lexicon(tmp_path):
+    dtm = tone_index.DocumentTermMatrix('fp')
+    dtm.append(COUNTS[:2])
+    dtm.append(COUNTS[2:])
+    assert dtm.score(LEXICON) == pytest.approx(expected_scores())
+    assert dtm.dot(np.ones(len(dtm.vocab)), block_rows=2).tolist() == [3, 5, 1, 4, 4]
+
+
+def test_dtm_refresh_writes_only_a_new_segment(tmp_path):
+    dtm = tone_index.DocumentTermMatrix('fp')
+    dtm.append(COUNTS[:3])
+    dtm.save(tmp_path)
+    first = {f.name: f.stat().st_mtime_ns for f in tmp_path.glob('*.npy')}
+
+    loaded = tone_index.DocumentTermMatrix.load('fp', tmp_path)
+    assert isinstance(loaded.segments[0]['ids'], np.memmap)
+    loaded.append(COUNTS[3:])
+    loaded.save(tmp_path)
+    assert {f.name: f.stat().st_mtime_ns for f in tmp_path.glob('*.npy') if f.name in first} == first
+    assert len(list(tmp_path.glob('*.npy'))) == 2 * len(first)
+
+    reloaded = tone_index.DocumentTermMatrix.load('fp', tmp_path)
+    assert len(reloaded) == len(COUNTS)
+    assert reloaded.ids.tolist() == [1, 2, 3, 4, 5]
+    assert reloaded.vocab == loaded.vocab
+    assert reloaded.score(LEXICON) == pytest.approx(expected_scores())
+    assert tone_index.DocumentTermMatrix.load('other', tmp_path) is None
+
+
+def test_dtm_interrupted_save_keeps_the_previous_matrix(tmp_path):
+    dtm = tone_index.DocumentTermMatrix('fp')
+    dtm.append(COUNTS[:3])
+    dtm.save(tmp_path)
+    with open(tmp_path / 'vocab.txt', 'a', encoding='utf-8') as f:  # terms of a save that never wrote meta.json
+        f.write('\nhalf\nwritten')
+
+    loaded = tone_index.DocumentTermMatrix.load('fp', tmp_path)
+    assert len(loaded) == 3
+    loaded.append(COUNTS[3:])
+    loaded.save(tmp_path)
+    reloaded = tone_index.DocumentTermMatrix.load('fp', tmp_path)
+    assert 'half' not in reloaded.vocab
+    assert reloaded.score(LEXICON) == pytest.approx(expected_scores())
+
+
+def test_dtm_reads_a_matrix_saved_before_segments(tmp_path):
+    dtm = tone_index.DocumentTermMatrix('fp')
+    dtm.append(COUNTS)
+    dtm.consolidate()
+    segment = dtm.segments[0]
+    for name in dtm.arrays:
+        np.save(tmp_path / f'{name}.npy', segment[name])
+    (tmp_path / 'vocab.txt').write_text('\n'.join(dtm.vocab), encoding='utf-8')
+    (tmp_path / 'meta.json').write_text(json.dumps({'fingerprint': 'fp', 'documents': len(COUNTS),
+                                                    'nnz': dtm.nnz, 'terms': len(dtm.vocab)}))
+
+    loaded = tone_index.DocumentTermMatrix.load('fp', tmp_path)
+    assert loaded.score(LEXICON) == pytest.approx(expected_scores())
+    loaded.append([(6, '2020-03-01', {'crisis': 1})])
+    loaded.save(tmp_path)
+    assert tone_index.DocumentTermMatrix.load('fp', tmp_path).score(LEXICON)[-1] == -1
+
+
+def write_database(db, bodies):
+    writer = process.ArticleWriter(db)
+    writer.start()
+    for n, body in enumerate(bodies):
+        writer.put((f'Story {n:d}', '2020-01-02', 'Wire', None, body, len(body.split())))
+    writer.close()
+
+
+# Tokenize what the matrix is missing the way main does, with the tokenizer standing in for the cleaning
+def refreshed_scores(db, path):
+    with contextlib.closing(sqlite3.connect(db)) as conn:
+        process.create_tables(conn)
+        dtm, missing = tone_index.stored_matrix(conn, 'fp', path)
+        bodies = dict(conn.execute("SELECT ID, BODY FROM ARTICLES").fetchall())
+    dtm.append([(i, '2020-01-02', Counter(tokenize(bodies[i]))) for i in missing])
+    dtm.save(path)
+    return dtm.score(LEXICON).tolist()
+
+
+# A rebuilt articles.db numbers its articles from 1 again, the matrix of the old file must not be reused for it
+def test_dtm_is_rebuilt_with_the_database(tmp_path):
+    db, path = tmp_path / 'articles.db', tmp_path / 'dtm'
+    assert refreshed_scores(str(db), path) == []
+    write_database(str(db), ['a rally and a gain', 'loss upon loss'])
+    assert refreshed_scores(str(db), path) == [1.0, -1.0]
+    assert refreshed_scores(str(db), path) == [1.0, -1.0]
+
+    db.unlink()
+    write_database(str(db), ['crisis and loss', 'strong rally'])
+    assert refreshed_scores(str(db), path) == [-1.0, 1.0]
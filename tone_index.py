@@ -5,20 +5,29 @@ A script to create a sentiment index which is simply the number of news articles
 """
 import os
 import re
-import sys
+import time
 import pandas as pd
 import numpy as np
+import json
+import hashlib
 import contextlib
-from datetime import datetime
+import multiprocessing
+from functools import lru_cache
+from collections import Counter
 
 import sqlite3
 from pathlib import Path
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
-from dateutil.relativedelta import relativedelta
 from nltk.tokenize import sent_tokenize, word_tokenize
 from nltk.probability import FreqDist
 
+from periods import daily_frame, period_frames, with_benchmark, write_frames
+from process import create_tables as create_article_tables, database_identity, term_filter, term_filter_label
+from bodies import BodyCodec
+from metrics import Metrics, profiled, hit_rate, peak_memory_mb
+from near_duplicates import near_duplicate_filter, create_tables as create_duplicate_tables
+
 __author__ = 'Andre Bodo'
 __copyright__ = 'Copyright 2020, Andre Bodo'
 __credits__ = ['Andre Bodo']
@@ -28,154 +37,662 @@ __maintainer__ = 'Andre Bodo'
 __email__ = 'bodo1184@mylaurier.ca'
 __status__ = 'Prototype'
 
+# Control variables
+WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 64
+READ_BATCH_SIZE = 10000
+SCORING_VERSION = 1
+DROP_NEAR_DUPLICATES = True  # leave out articles flagged by near_duplicates.py
+TERM_FILTER = None  # FTS5 query for a sub-index of one theme, e.g. '"tar sands" OR "oil sands"', None for all articles
+# 'W' (weeks ending sunday), 'M' (calendar months) or 'Q' (calendar quarters), optionally preceded by a window
+# length for rolling sums, e.g. ['M', 'Q', '3M'] for monthly, quarterly and rolling three month indices
+PERIODS = ['M']
+SCORE_FROM_DTM = True  # score the stored document-term matrix instead of storing per-article scores in TONE_SCORES
+PROFILE = False  # run under cProfile and save the stats next to the metrics report
+
 # Directories and file paths needed
 base_path = Path(__file__).parent
-dbase_loc = str(base_path) + '\\articles.db'
-scowl_2of12dict = str(base_path) + '\\2of12inf.txt'
-hiv_loc = str(base_path) + '\\HIV-4.csv'
-
-
-# Text based progress bar from StackOverflow user Vladimir Ignatyev: https://stackoverflow.com/a/27871113 If you are
-# using pycharm this function may not work as expected. To ensure it prints correctly, go to Run and make sure the
-# Emulate terminal in output console is selected
-def progress(count, total, prefix=''):
-    bar_len = 60
-    filled_len = int(round(bar_len * count / float(total)))
-
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
-
-    sys.stdout.write(f'{prefix}[{bar}] {percents}%\r')
-    sys.stdout.flush()  # As suggested by Rom Ruben
-
-
-# Load up the american word dictionary
-with open(scowl_2of12dict, "r") as f:
-    usa_dict = f.readlines()
-usa_dict = [w.strip() for w in usa_dict]
-
-
-def prepare_for_sentiment(corpus):
-    s = corpus.lower().strip()
-    cleaned = []
-
-    for sent in sent_tokenize(s):
-        words = word_tokenize(sent)
-        p1 = re.compile(r'\$?[0-9]{1,}.?[0-9]{0,}-b?m?illion', re.IGNORECASE)  # $number.number-billions
-        p2 = re.compile(r'\$[0-9]{1,}', re.IGNORECASE)  # $number
-        p3 = re.compile(r'\d+-\w', re.IGNORECASE)  # remove number-words
-        p4 = re.compile(r'\d+\w', re.IGNORECASE)  # remove numberwords
-        p5 = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)  # urls
-        p6 = re.compile(r'\d+', re.IGNORECASE)  # remove numbers
-
-        words = [re.sub(p1, '', w) for w in words]  # billion/million
-        words = [re.sub(p2, '', w) for w in words]  # $ number
-        words = [re.sub(p3, '', w) for w in words]  # remove number-words
-        words = [re.sub(p4, '', w) for w in words]  # remove numberwords
-
-        words = ' '.join(words).split()
-        words = [re.sub(p5, '', w) for w in words]  # urls
-        words = [re.sub(p6, '', w) for w in words]  # remove numbers
-        words = [w.strip() for w in words]
+dbase_loc = str(base_path / 'articles.db')
+scowl_2of12dict = str(base_path / '2of12inf.txt')
+hiv_loc = str(base_path / 'HIV-4.csv')
+dtm_path = base_path / 'data' / 'dtm'
+metrics_loc = str(base_path / 'tone_index_metrics.json')
+profile_loc = str(base_path / 'tone_index.prof')
+
+
+class TextCleaner:
+    """Reusable version of the sentence cleaning pipeline used to prepare articles for dictionary scoring.
+
+    Patterns are compiled once, the SCOWL dictionary and NLTK stopwords are held as sets and lemma results are kept in
+    a bounded LRU cache since news vocabulary repeats heavily. Output is identical to the original per-sentence loop.
+    """
+
+    p1 = re.compile(r'\$?[0-9]{1,}.?[0-9]{0,}-b?m?illion', re.IGNORECASE)  # $number.number-billions
+    p2 = re.compile(r'\$[0-9]{1,}', re.IGNORECASE)  # $number
+    p3 = re.compile(r'\d+-\w', re.IGNORECASE)  # remove number-words
+    p4 = re.compile(r'\d+\w', re.IGNORECASE)  # remove numberwords
+    p5 = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)  # urls
+    p6 = re.compile(r'\d+', re.IGNORECASE)  # remove numbers
+
+    def __init__(self, dict_path=scowl_2of12dict, lemma_cache_size=2 ** 16, metrics=None):
+        # Load up the american word dictionary
+        with open(dict_path, "r") as f:
+            self.usa_dict = {w.strip() for w in f.readlines()}
+        self.stopwords = set(stopwords.words('english'))
+        self.lemmatize = lru_cache(maxsize=lemma_cache_size)(WordNetLemmatizer().lemmatize)
+        self.metrics = Metrics('clean') if metrics is None else metrics
+        self.tokens = 0
+        self.elapsed = 0.0
+
+    @property
+    def tokens_per_second(self):
+        return self.tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+    def lemma_cache_info(self):
+        return self.lemmatize.cache_info()
+
+    def clean_sentence(self, sent):
+        metrics = self.metrics
+        with metrics.stage('clean.word_tokenize'):
+            words = word_tokenize(sent)
+        self.tokens += len(words)
+        metrics.count('tokens', len(words))
+
+        with metrics.stage('clean.regex'):
+            words = [self.p4.sub('', self.p3.sub('', self.p2.sub('', self.p1.sub('', w)))) for w in words]
+            words = ' '.join(words).split()
+            words = [self.p6.sub('', self.p5.sub('', w)).strip() for w in words]
 
         # remove non-american words scowl_2of12dict
         # Word Power: A New Approach for Content Analysis
         # Narasimhan Jegadeesh
-        words = [w for w in words if w in usa_dict]
-
-        # lemmatization
-        lemma = WordNetLemmatizer()
-        words = [lemma.lemmatize(w) for w in words]
+        with metrics.stage('clean.scowl_filter'):
+            kept = [w for w in words if w in self.usa_dict]
+        metrics.count('tokens_dropped_scowl', len(words) - len(kept))
+        with metrics.stage('clean.lemmatize'):
+            words = [self.lemmatize(w) for w in kept]
 
         # remove stopwords
-        stopwords_nltk = list(stopwords.words('english'))
-        words = [w for w in words if w not in stopwords_nltk]
-
-        cleaned.append(' '.join(words))
-
-    cleaned = ' '.join(cleaned)
-
-    return cleaned
-
-
-def term_freq(word_list):
-    word_freq = {}
-    for unique_word in list(set(word_list)):
-        word_freq.update({unique_word: word_list.count(unique_word)})
-    return word_freq
-
-
-def compute_sentiment(s):
-    words = word_tokenize(s)
-    freq_dict = term_freq(words)
-    df = pd.DataFrame(data=freq_dict.items(), columns=['terms', 'freq'])
-
-    # sentiment score h-iv-4
-    h_four = pd.read_csv(hiv_loc, usecols=[0, 2, 3])
-    h_four.columns = [c.lower() for c in h_four.columns]
-    h_four['entry'] = h_four['entry'].apply(lambda x: re.sub(r'\#\d+', '', x).lower())
-    h_four = h_four.drop_duplicates(subset=['entry'])
-
-    pos_terms = list(h_four.loc[~h_four['positiv'].isnull(), 'entry'].apply(str.lower))
-    neg_terms = list(h_four.loc[~h_four['negativ'].isnull(), 'entry'].apply(str.lower))
-
-    # freq (only consider the values which exist in the harvard dictionary)
-    for i in range(len(df)):
-        term = df.loc[df.index[i], 'terms']
-        if term not in list(h_four['entry']):
-            df.loc[df.index[i], 'freq'] = np.nan
-    df = df.dropna()
-
-    # sentiment (positive or negative)
-    df['sentiment'] = 0
-    for i in range(len(df)):
-        term = df.loc[df.index[i], 'terms']
-        if term in pos_terms:
-            df.loc[df.index[i], 'sentiment'] = 1
-        elif term in neg_terms:
-            df.loc[df.index[i], 'sentiment'] = -1
-
-    # weights
-    df['weights'] = df['freq'] / df['freq'].sum()
-
-    # sentiment score
-    score = df['sentiment'] * df['weights']
-    score = score.sum()
-
-    return score
-
-
-score_data = []
-with contextlib.closing(sqlite3.connect(dbase_loc)) as conn:
-    with conn:  # auto-commit
-        with contextlib.closing(conn.cursor()) as cursor:
-            # Count number of rows
-            cursor.execute("SELECT COUNT(*) FROM ARTICLES")
-            total_rows = int(cursor.fetchall()[0][0])
-            # Get data and process it
-            cursor.execute("SELECT DATE, BODY FROM ARTICLES")
-            row_count = 0
-            for row in cursor.fetchall():
-                clean_text = prepare_for_sentiment(row[1])
-                score_data.append([datetime.strptime(row[0], '%Y-%m-%d'), compute_sentiment(clean_text)])
-                row_count += 1
-                progress(row_count, total_rows, prefix='Processing files: ')
-
-df = pd.DataFrame(data=score_data, columns=['date', 'score'])
-df = df.groupby(by=['date'], as_index=False).sum()
-df.set_index('date', inplace=True, drop=True)
-df = df.resample('M').sum()
-
-# download OVX data from yahoo finance
-period1 = int(datetime.timestamp(pd.Timestamp(df.index.values[0]) - relativedelta(months=1)))
-period2 = '9999999999'
-base_url = 'https://query1.finance.yahoo.com/v7/finance/download'
-url = f'{base_url}/^OVX?period1={period1}&period2=9999999999&interval=1d&events=history'
-ovx_data = pd.read_csv(url, parse_dates=['Date'], index_col=['Date'], usecols=['Date', 'Adj Close'])
-ovx_data.index.names = ['date']
-ovx_data.columns = ['OVX']
-ovx_data.sort_index(inplace=True)
-ovx_data = ovx_data.reindex(df.index, method='ffill')
-
-df = df.merge(ovx_data, how='inner', left_index=True, right_index=True).dropna()
-df.to_excel('harvard_dict_based_index.xlsx')
\ No newline at end of file
+        with metrics.stage('clean.stopwords'):
+            kept = [w for w in words if w not in self.stopwords]
+        metrics.count('tokens_dropped_stopwords', len(words) - len(kept))
+
+        return ' '.join(kept)
+
+    def clean(self, corpus):
+        start_time = time.perf_counter()
+        s = corpus.lower().strip()
+        with self.metrics.stage('clean.sent_tokenize'):
+            sentences = sent_tokenize(s)
+        cleaned = ' '.join([self.clean_sentence(sent) for sent in sentences])
+        elapsed = time.perf_counter() - start_time
+        self.elapsed += elapsed
+        self.metrics.seconds['clean'] += elapsed
+        self.metrics.calls['clean'] += 1
+        return cleaned
+
+
+# TextCleaner over the SCOWL dictionary at scowl_2of12dict, set up on first use and shared by every caller that does not
+# pass its own
+@lru_cache(maxsize=None)
+def default_cleaner():
+    return TextCleaner()
+
+
+def prepare_for_sentiment(corpus, cleaner=None):
+    if cleaner is None:
+        cleaner = default_cleaner()
+    return cleaner.clean(corpus)
+
+
+class Lexicon:
+    """Polarity lookup over a list of terms (+1 positive, -1 negative), built once per run.
+
+    Terms are mapped to an integer index so that a document can be scored with one dictionary lookup per token and a
+    single numpy reduction, or the whole corpus at once against a DocumentTermMatrix.
+    """
+
+    def __init__(self, terms, polarity):
+        self.terms = list(terms)
+        self.index = {term: i for i, term in enumerate(self.terms)}
+        self.polarity = np.asarray(polarity).astype(np.int8)
+
+    # Any word list lexicon, e.g. Loughran-McDonald or a custom oil lexicon. Terms are lowercased and a term in both
+    # lists counts as positive.
+    @classmethod
+    def from_word_lists(cls, positive, negative):
+        polarity = {}
+        for term in negative:
+            polarity[term.lower()] = -1
+        for term in positive:
+            polarity[term.lower()] = 1
+        return cls(polarity.keys(), list(polarity.values()))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def lookup(self, words):
+        ids = np.fromiter((self.index.get(w, -1) for w in words), dtype=np.int64)
+        return ids[ids >= 0]
+
+    def score_tokens(self, words):
+        # Frequency weighted polarity over the terms found in the dictionary: sum(sentiment * freq / total freq)
+        # which reduces to the mean polarity of the matched tokens.
+        ids = self.lookup(words)
+        if ids.size == 0:
+            return 0.0
+        return float(self.polarity[ids].sum() / ids.size)
+
+    def score(self, s):
+        return self.score_tokens(word_tokenize(s))
+
+    def score_batch(self, docs):
+        ids = [self.lookup(word_tokenize(s)) for s in docs]
+        sizes = np.array([i.size for i in ids], dtype=np.int64)
+        scores = np.zeros(len(ids), dtype=np.float64)
+        if sizes.sum() == 0:
+            return scores
+        flat = self.polarity[np.concatenate(ids)].astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        has_terms = sizes > 0
+        sums = np.add.reduceat(flat, offsets[has_terms])
+        scores[has_terms] = sums / sizes[has_terms]
+        return scores
+
+    # Polarity and membership of each vocabulary term, for scoring a DocumentTermMatrix
+    def vocabulary_vectors(self, vocab):
+        ids = np.fromiter((self.index.get(w, -1) for w in vocab), dtype=np.int64, count=len(vocab))
+        matched = ids >= 0
+        polarity = np.zeros(len(ids), dtype=np.float64)
+        polarity[matched] = self.polarity[ids[matched]]
+        return polarity, matched.astype(np.float64)
+
+
+class HarvardLexicon(Lexicon):
+    """Harvard IV-4 polarity lookup.
+
+    Entries are cleaned the same way as the original per-article loader (sense suffixes such as '#1' removed,
+    lowercased, first occurrence kept).
+    """
+
+    def __init__(self, path=hiv_loc):
+        h_four = pd.read_csv(path, usecols=[0, 2, 3])
+        h_four.columns = [c.lower() for c in h_four.columns]
+        h_four['entry'] = h_four['entry'].apply(lambda x: re.sub(r'\#\d+', '', x).lower())
+        h_four = h_four.drop_duplicates(subset=['entry'])
+
+        # positive takes precedence over negative, as in the original scorer
+        polarity = np.where(~h_four['positiv'].isnull(), 1, np.where(~h_four['negativ'].isnull(), -1, 0))
+        super().__init__(h_four['entry'], polarity)
+
+
+# The Harvard lexicon at hiv_loc, read on first use and shared by every caller that does not pass its own
+@lru_cache(maxsize=None)
+def default_lexicon():
+    return HarvardLexicon()
+
+
+def compute_sentiment(s, lexicon=None):
+    if lexicon is None:
+        lexicon = default_lexicon()
+    return lexicon.score(s)
+
+
+# Fingerprint of everything that determines an article's score: the cleaning patterns, stopword list, SCOWL dictionary,
+# Harvard lexicon and SCORING_VERSION (bump it when the cleaning or scoring code changes). Stored scores are keyed by it
+# so a change to any of these invalidates the cached scores. Without a lexicon_path it covers the cleaning alone, which
+# is what the document-term matrix depends on.
+def scoring_fingerprint(dict_path=scowl_2of12dict, lexicon_path=hiv_loc):
+    h = hashlib.sha1(f'v{SCORING_VERSION:d}'.encode())
+    for p in (TextCleaner.p1, TextCleaner.p2, TextCleaner.p3, TextCleaner.p4, TextCleaner.p5, TextCleaner.p6):
+        h.update(p.pattern.encode())
+    h.update('\n'.join(stopwords.words('english')).encode())
+    for path in (dict_path, lexicon_path):
+        if path is None:
+            continue
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class DocumentTermMatrix:
+    """Token counts of every cleaned article as a CSR sparse matrix (one row per article, one column per term).
+
+    The rows are stored in dtm_path as segments of .npy arrays, one segment per run that added articles, together with
+    the article IDs and dates and the vocabulary. Segments are never rewritten, a refresh only writes the rows of the
+    new articles and appends their new terms to the vocabulary, and loading memory-maps every segment. Scoring any
+    lexicon is then a sparse matrix-vector product over the stored counts, with no re-cleaning of the corpus. The
+    matrix is tied to the cleaning fingerprint and to the identity of the database it was read from, and rebuilt when
+    either changes.
+    """
+
+    arrays = ('indptr', 'indices', 'data', 'ids', 'dates')
+
+    def __init__(self, fingerprint, vocab=(), segments=None, database=None):
+        self.fingerprint = fingerprint
+        self.database = database
+        self.vocab = list(vocab)
+        self.segments = [] if segments is None else segments  # dicts of arrays, indptr starts at 0 in each
+        self.stored_segments = len(self.segments)
+        self.stored_terms = len(self.vocab)
+        self.term_index = None
+        self.pending = []
+
+    def __len__(self):
+        self.consolidate()
+        return sum(len(segment['ids']) for segment in self.segments)
+
+    @property
+    def nnz(self):
+        return sum(int(segment['indptr'][-1]) for segment in self.segments)
+
+    @property
+    def ids(self):
+        return self.concatenated('ids', np.int64)
+
+    @property
+    def dates(self):
+        return self.concatenated('dates', 'datetime64[D]')
+
+    def concatenated(self, name, dtype):
+        self.consolidate()
+        if not self.segments:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate([segment[name] for segment in self.segments])
+
+    # Files of one array of a segment. A matrix saved before segments existed is read as a single unnamed segment.
+    @staticmethod
+    def segment_file(path, segment, name):
+        return path / (f'{segment}.{name}.npy' if segment else f'{name}.npy')
+
+    # Returns None when nothing is stored, the files are incomplete, or they were built under other cleaning rules or
+    # from another database
+    @classmethod
+    def load(cls, fingerprint, path=None, database=None):
+        path = Path(dtm_path if path is None else path)
+        try:
+            with open(path / 'meta.json') as f:
+                meta = json.load(f)
+            if meta['fingerprint'] != fingerprint or meta.get('database') != database:
+                return None
+            with open(path / 'vocab.txt', encoding='utf-8') as f:
+                vocab = f.read().split('\n')[:meta['terms']]
+            if 'segments' in meta:
+                listed = meta['segments']
+            else:
+                listed = [{'name': '', 'documents': meta['documents'], 'nnz': meta['nnz']}]
+            segments = []
+            for entry in listed:
+                segment = {name: np.load(cls.segment_file(path, entry['name'], name), mmap_mode='r')
+                           for name in cls.arrays}
+                if len(segment['ids']) != entry['documents'] or int(segment['indptr'][-1]) != entry['nnz']:
+                    return None
+                segment['name'] = entry['name']
+                segments.append(segment)
+        except (OSError, ValueError, KeyError):
+            return None
+        if len(vocab) != meta['terms']:
+            return None
+        return cls(fingerprint, vocab, segments, database)
+
+    # Writes the segments added since the matrix was loaded and appends the new terms to vocab.txt. meta.json is
+    # replaced last, so a save that was interrupted part way leaves the previous matrix intact: the vocabulary is cut
+    # back to the terms it lists and unlisted segment files are overwritten by the next save.
+    def save(self, path=None):
+        self.consolidate()
+        path = Path(dtm_path if path is None else path)
+        path.mkdir(parents=True, exist_ok=True)
+        if self.stored_segments == 0:  # a new matrix, clear out one built under other cleaning rules
+            for f in path.glob('*.npy'):
+                f.unlink()
+
+        for number, segment in enumerate(self.segments[self.stored_segments:], start=self.stored_segments + 1):
+            segment['name'] = f'segment_{number:05d}'
+            for name in self.arrays:
+                tmp = path / f'{segment["name"]}.{name}.tmp.npy'
+                np.save(tmp, np.asarray(segment[name]))
+                os.replace(tmp, self.segment_file(path, segment['name'], name))
+
+        stored_bytes = len('\n'.join(self.vocab[:self.stored_terms]).encode('utf-8'))
+        with open(path / 'vocab.txt', 'r+b' if (path / 'vocab.txt').exists() else 'w+b') as f:
+            f.truncate(stored_bytes)
+            f.seek(stored_bytes)
+            new_terms = self.vocab[self.stored_terms:]
+            if new_terms:
+                f.write((('\n' if self.stored_terms else '') + '\n'.join(new_terms)).encode('utf-8'))
+
+        meta = {'fingerprint': self.fingerprint, 'database': self.database, 'terms': len(self.vocab),
+                'segments': [{'name': segment['name'], 'documents': len(segment['ids']),
+                              'nnz': int(segment['indptr'][-1])} for segment in self.segments]}
+        with open(path / 'meta.tmp.json', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path / 'meta.tmp.json', path / 'meta.json')
+        self.stored_segments = len(self.segments)
+        self.stored_terms = len(self.vocab)
+
+    # Add rows for (id, date, token counts) documents. New terms extend the vocabulary, existing rows are unchanged.
+    # Rows are buffered per call and turned into one new segment by consolidate.
+    def append(self, documents):
+        if self.term_index is None:
+            self.term_index = {term: i for i, term in enumerate(self.vocab)}
+        ids, dates, lengths, indices, data = [], [], [], [], []
+        for article_id, date, counts in documents:
+            ids.append(article_id)
+            dates.append(date)
+            lengths.append(len(counts))
+            for term, count in counts.items():
+                indices.append(self.term_index.setdefault(term, len(self.term_index)))
+                data.append(count)
+        self.pending.append((np.array(ids, dtype=np.int64), np.array(dates, dtype='datetime64[D]'),
+                             np.array(lengths, dtype=np.int64), np.array(indices, dtype=np.int32),
+                             np.array(data, dtype=np.int32)))
+
+    def consolidate(self):
+        if not self.pending:
+            return
+        ids, dates, lengths, indices, data = (np.concatenate(parts) for parts in zip(*self.pending))
+        self.pending = []
+        self.vocab = list(self.term_index)
+        self.segments.append({'indptr': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+                              'indices': indices, 'data': data, 'ids': ids, 'dates': dates})
+
+    # Matrix-vector product with a vector over the vocabulary, computed block_rows rows of a segment at a time so only
+    # a slice of the memory-mapped arrays is paged in at once
+    def dot(self, vector, block_rows=READ_BATCH_SIZE):
+        self.consolidate()
+        out = np.zeros(len(self), dtype=np.float64)
+        offset = 0
+        for segment in self.segments:
+            indptr, indices, data = segment['indptr'], segment['indices'], segment['data']
+            n_rows = len(segment['ids'])
+            for start in range(0, n_rows, block_rows):
+                stop = min(start + block_rows, n_rows)
+                lo, hi = indptr[start], indptr[stop]
+                values = data[lo:hi] * vector[indices[lo:hi]]
+                rows = np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1]))
+                out[offset + start:offset + stop] = np.bincount(rows, weights=values, minlength=stop - start)
+            offset += n_rows
+        return out
+
+    # Mean polarity of the lexicon terms in each article, the same score Lexicon.score gives the cleaned text
+    def score(self, lexicon):
+        self.consolidate()
+        polarity, matched = lexicon.vocabulary_vectors(self.vocab)
+        totals = self.dot(polarity)
+        n_matched = self.dot(matched)
+        scores = np.zeros(len(self), dtype=np.float64)
+        np.divide(totals, n_matched, out=scores, where=n_matched > 0)
+        return scores
+
+    # Daily totals of the articles in article_ids, with their word counts from word_counts: number of articles, sum of
+    # their scores and sum of their words, as a frame indexed by date like periods.daily_frame builds
+    def daily_totals(self, lexicon, article_ids, word_counts):
+        scores = self.score(lexicon)
+        keep = np.isin(self.ids, article_ids)
+        words = pd.Series(word_counts, index=article_ids).reindex(self.ids[keep]).to_numpy()
+        daily = pd.DataFrame({'articles': 1, 'score': scores[keep], 'words': words},
+                             index=pd.DatetimeIndex(self.dates[keep], name='date'))
+        return daily.groupby(level=0).sum()
+
+
+def create_score_table(conn):
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS TONE_SCORES(
+        ID INTEGER NOT NULL,
+        FINGERPRINT TEXT NOT NULL,
+        SCORE REAL NOT NULL,
+        PRIMARY KEY (ID, FINGERPRINT))
+        """)
+
+
+def iter_rows(cursor, batch_size=READ_BATCH_SIZE):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def article_filter(id_column='a.ID', term_query=TERM_FILTER):
+    conditions = ['1']
+    if DROP_NEAR_DUPLICATES:
+        conditions.append(near_duplicate_filter(id_column))
+    if term_query is not None:
+        conditions.append(term_filter(term_query, id_column))
+    return ' AND '.join(conditions)
+
+
+# IDs of articles without a stored score for this fingerprint, i.e. new articles or ones scored under other rules
+def unscored_ids(conn, fingerprint, term_query=TERM_FILTER):
+    cursor = conn.execute(f"""
+    SELECT a.ID FROM ARTICLES a
+    WHERE NOT EXISTS (SELECT 1 FROM TONE_SCORES s WHERE s.ID = a.ID AND s.FINGERPRINT=?)
+    AND {article_filter('a.ID', term_query)}
+    ORDER BY a.ID
+    """, [fingerprint])
+    return [row[0] for row in iter_rows(cursor)]
+
+
+# IDs of articles that are not in the document-term matrix yet
+def untokenized_ids(conn, dtm):
+    cursor = conn.execute("SELECT ID FROM ARTICLES ORDER BY ID")
+    known = set(dtm.ids.tolist())
+    return [row[0] for row in iter_rows(cursor) if row[0] not in known]
+
+
+# The document-term matrix stored for the database on conn, or a new one when none is stored for it under these
+# cleaning rules. Returns it with the IDs of the articles it is missing.
+def stored_matrix(conn, fingerprint, path=None):
+    database = database_identity(conn)
+    dtm = DocumentTermMatrix.load(fingerprint, path, database) or DocumentTermMatrix(fingerprint, database=database)
+    return dtm, untokenized_ids(conn, dtm)
+
+
+# IDs and word counts of the articles that go into the index
+def indexed_articles(conn, term_query=TERM_FILTER):
+    cursor = conn.execute(f"""
+    SELECT a.ID, a.WORDCOUNT FROM ARTICLES a WHERE {article_filter('a.ID', term_query)} ORDER BY a.ID
+    """)
+    rows = np.array(list(iter_rows(cursor)), dtype=np.int64).reshape(-1, 2)
+    return rows[:, 0], rows[:, 1]
+
+
+def store_scores(conn, fingerprint, score_data):
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO TONE_SCORES VALUES (?, ?, ?)",
+                         [(article_id, fingerprint, score) for article_id, _, score in score_data])
+
+
+# Daily totals from the stored scores: number of articles, sum of their scores and sum of their words. The sums are
+# done by SQLite, so memory depends on the number of days rather than the number of articles.
+def load_daily_totals(conn, fingerprint, term_query=TERM_FILTER):
+    return conn.execute(f"""
+    SELECT a.DATE, COUNT(*), TOTAL(s.SCORE), SUM(a.WORDCOUNT) FROM TONE_SCORES s JOIN ARTICLES a ON a.ID = s.ID
+    WHERE s.FINGERPRINT=? AND {article_filter('a.ID', term_query)} GROUP BY a.DATE ORDER BY a.DATE
+    """, [fingerprint]).fetchall()
+
+
+# Each worker process loads the NLTK data, SCOWL dictionary and Harvard lexicon once in the pool initializer and keeps
+# its own read-only connection to the database, so tasks only carry article IDs.
+worker_state = {}
+
+
+def init_worker(db_path=dbase_loc):
+    worker_state['metrics'] = Metrics('tone worker')
+    worker_state['cleaner'] = TextCleaner(metrics=worker_state['metrics'])
+    worker_state['lexicon'] = HarvardLexicon()
+    worker_state['conn'] = sqlite3.connect(db_path)
+    BodyCodec(worker_state['conn'])  # registers UNPACK_BODY for compressed bodies
+
+
+def read_bodies(ids):
+    placeholders = ','.join(['?'] * len(ids))
+    with worker_state['metrics'].stage('sqlite.read'):
+        with contextlib.closing(worker_state['conn'].cursor()) as cursor:
+            cursor.execute(f"SELECT ID, DATE, UNPACK_BODY(BODY) FROM ARTICLES WHERE ID IN ({placeholders}) ORDER BY ID",
+                           list(ids))
+            return cursor.fetchall()
+
+
+# Counters and lemma cache statistics of the task that just ran, the worker's metrics are reset for the next one
+def task_metrics(cache_before):
+    metrics = worker_state['metrics']
+    cache_after = worker_state['cleaner'].lemma_cache_info()
+    metrics.count('lemma_cache_hits', cache_after.hits - cache_before.hits)
+    metrics.count('lemma_cache_misses', cache_after.misses - cache_before.misses)
+    snapshot = metrics.snapshot()
+    metrics.reset()
+    return snapshot
+
+
+def score_ids(ids):
+    cleaner = worker_state['cleaner']
+    lexicon = worker_state['lexicon']
+    metrics = worker_state['metrics']
+    cache_before = cleaner.lemma_cache_info()
+
+    results = []
+    for article_id, date, body in read_bodies(ids):
+        cleaned = cleaner.clean(body)
+        with metrics.stage('lexicon.score'):
+            results.append((article_id, date, lexicon.score(cleaned)))
+    metrics.count('articles', len(results))
+    return results, task_metrics(cache_before)
+
+
+# Same as score_ids but returns the token counts of each cleaned article, for the document-term matrix
+def count_ids(ids):
+    cleaner = worker_state['cleaner']
+    metrics = worker_state['metrics']
+    cache_before = cleaner.lemma_cache_info()
+
+    results = []
+    for article_id, date, body in read_bodies(ids):
+        cleaned = cleaner.clean(body)
+        with metrics.stage('dtm.count_terms'):
+            results.append((article_id, date, Counter(word_tokenize(cleaned))))
+    metrics.count('articles', len(results))
+    return results, task_metrics(cache_before)
+
+
+def chunked(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+# Scores every article and returns (id, date, score) tuples ordered by ID. Chunks are handed out with imap, which
+# preserves submission order, so the output is identical for any number of workers. When on_chunk is given it is
+# called with each chunk's scores as they arrive instead, and nothing is accumulated, so memory stays bounded by the
+# chunk size however large the corpus. task=count_ids returns token counts instead of scores. Worker stage times and
+# counters are merged into metrics.
+def score_articles(ids, workers=WORKERS, chunk_size=CHUNK_SIZE, on_chunk=None, task=score_ids, metrics=None):
+    if metrics is None:
+        metrics = Metrics('tone_index')
+    score_data = []
+    n_chunks = -(-len(ids) // chunk_size)
+    if n_chunks == 0:
+        return score_data
+    chunks = chunked(ids, chunk_size)
+
+    if workers <= 1:
+        init_worker()
+        results = map(task, chunks)
+    else:
+        pool = multiprocessing.Pool(processes=workers, initializer=init_worker)
+        results = pool.imap(task, chunks)
+
+    try:
+        for n, (chunk_scores, snapshot) in enumerate(results, start=1):
+            metrics.merge(snapshot)
+            if on_chunk is not None:
+                with metrics.stage('on_chunk'):
+                    on_chunk(chunk_scores)
+            else:
+                score_data.extend(chunk_scores)
+            metrics.progress(n, n_chunks, prefix='Processing articles: ', counter='articles', unit='articles')
+    finally:
+        if workers > 1:
+            pool.close()
+            pool.join()
+        else:
+            worker_state['conn'].close()
+
+    tokens, elapsed = metrics.counters['tokens'], metrics.seconds['clean']
+    print(f'Cleaned {tokens:d} tokens at {tokens / elapsed if elapsed > 0 else 0.0:,.0f} tokens/sec per worker '
+          f'({workers:d} workers)')
+    score_data.sort(key=lambda x: x[0])
+    return score_data
+
+
+def output_loc(term_query=TERM_FILTER):
+    if term_query is None:
+        return str(base_path / 'harvard_dict_based_index.xlsx')
+    return str(base_path / f'harvard_dict_based_index_{term_filter_label(term_query)}.xlsx')
+
+
+# Build the tone index at every period in periods and write them side by side next to this script, returns the path
+# of the output
+def main(term_query=TERM_FILTER, periods=PERIODS):
+    metrics = Metrics('tone_index')
+    with profiled(PROFILE, profile_loc):
+        if SCORE_FROM_DTM:
+            # Only articles missing from the stored document-term matrix are cleaned and tokenized, the lexicon is then
+            # applied to all articles at once. A different lexicon costs a matrix-vector product, not a corpus pass.
+            dtm_fingerprint = scoring_fingerprint(lexicon_path=None)
+            with contextlib.closing(sqlite3.connect(dbase_loc)) as conn:
+                create_article_tables(conn)
+                create_duplicate_tables(conn)
+                with metrics.stage('dtm.load'):
+                    dtm, article_ids = stored_matrix(conn, dtm_fingerprint)
+                print(f'Tokenizing {len(article_ids):d} new articles (fingerprint {dtm_fingerprint[:12]})')
+                score_articles(article_ids, on_chunk=dtm.append, task=count_ids, metrics=metrics)
+                included_ids, word_counts = indexed_articles(conn, term_query)
+            if article_ids:
+                with metrics.stage('dtm.save'):
+                    dtm.save()
+            print(f'Document-term matrix: {len(dtm):d} articles, {len(dtm.vocab):d} terms, {dtm.nnz:d} non-zero '
+                  f'counts')
+            with metrics.stage('dtm.score'):
+                daily = dtm.daily_totals(HarvardLexicon(), included_ids, word_counts)
+            metrics.count('articles_indexed', len(included_ids))
+        else:
+            # Only articles that are new, or were scored under different cleaning rules or lexicon, get scored.
+            # Everything else is read back from TONE_SCORES, so monthly refreshes only pay for the newly processed
+            # articles.
+            fingerprint = scoring_fingerprint()
+            with contextlib.closing(sqlite3.connect(dbase_loc)) as conn:
+                create_score_table(conn)
+                create_article_tables(conn)
+                create_duplicate_tables(conn)
+                article_ids = unscored_ids(conn, fingerprint, term_query)
+                print(f'Scoring {len(article_ids):d} new or invalidated articles (fingerprint {fingerprint[:12]})')
+                score_articles(article_ids, on_chunk=lambda chunk_scores: store_scores(conn, fingerprint, chunk_scores),
+                               metrics=metrics)
+                with metrics.stage('sqlite.daily_totals'):
+                    totals = load_daily_totals(conn, fingerprint, term_query)
+                daily = daily_frame(totals, ['articles', 'score', 'words'])
+
+        # Every period is summed from the same daily totals, the mean score of a period is weighted by its articles
+        with metrics.stage('periods'):
+            frames = period_frames(daily, periods, ratios={'mean_score': ('score', 'articles')})
+
+        # OVX prices from the local cache, topped up from yahoo finance when it is out of date
+        with metrics.stage('ovx'):
+            frames = with_benchmark(frames)
+        with metrics.stage('excel'):
+            write_frames(frames, output_loc(term_query))
+
+    peak_main, peak_workers = peak_memory_mb()
+    if peak_main is not None:
+        print(f'Peak memory: {peak_main:,.0f} MB (main), {peak_workers:,.0f} MB (largest worker)')
+    print(metrics.summary())
+    metrics.write(metrics_loc, workers=WORKERS, score_from_dtm=SCORE_FROM_DTM, term_filter=term_query, periods=periods,
+                  lemma_cache_hit_rate=hit_rate(metrics, 'lemma_cache_hits', 'lemma_cache_misses'),
+                  peak_memory_mb={'main': peak_main, 'workers': peak_workers})
+    print(f'Metrics written to {metrics_loc}')
+    return output_loc(term_query)
+
+
+if __name__ == '__main__':
+    main()